@@ -23,9 +23,11 @@ somewhere in the main program before this module's initialize() method.
 #
 # This project is hosted at sdss3.org and tops.googlecode.com
 
+import os.path
+
 import tops.core.network.logging.producer as logging
 
-from tops.core.network.client import Client,ClientException
+from tops.core.network.client import Client,ClientException,getOptions
 from record import ArchiveRecord
 
 from tops.core.network.naming import ResourceName
@@ -41,8 +43,8 @@ class ArchiveClient(Client):
 	Header = archiving_pb2.Header
 	Message = archiving_pb2.Update
 
-	def __init__(self,name,unix_path,tcp_host,tcp_port):
-		Client.__init__(self,unix_path,tcp_host,tcp_port)
+	def __init__(self,name,unix_path,tcp_host,tcp_port,**options):
+		Client.__init__(self,unix_path,tcp_host,tcp_port,**options)
 		self.name = name
 		self.records = { }
 		self.started = False
@@ -59,7 +61,7 @@ class ArchiveClient(Client):
 		# describe each record that we will provide updates for
 		for record in self.records.itervalues():
 			record.appendToHeader(hdr)
-			self.sendHeader(hdr)
+		self.sendHeader(hdr)
 		self.started = True
 			
 	def sendUpdate(self,timestamp,record_name,channels):
@@ -83,13 +85,25 @@ def initialize(name):
 	
 	The name provided must be a valid and unique network service name.
 	See tops.core.network.naming for details.
+	
+	If the archiver's buffered option is set, updates are queued and
+	sent from a background thread so that update() never blocks on the
+	network. See tops.core.network.client for details.
+	
+	If the archiver's spool option is set, updates are stored on disk
+	while the archiving server is unreachable, in a directory named
+	after this producer, and replayed when it returns.
 	"""
 	global theArchive
 	assert(theArchive is None)
+	options = getOptions('archiver')
+	if 'spool_dir' in options:
+		options['spool_dir'] = os.path.join(options['spool_dir'],str(name))
 	theArchive = ArchiveClient(name,
 		config.get('archiver','unix_addr'),
 		config.get('archiver','tcp_host'),
-		config.get('archiver','tcp_port')
+		config.getint('archiver','tcp_port'),
+		**options
 	)
 
 def addMonitor(name,channels):
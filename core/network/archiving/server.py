@@ -65,6 +65,15 @@ class ArchiveManager(object):
 		(types,channels) = self.sessions[hdr.name][msg.record_id]
 		for (cindex,value) in enumerate(msg.values):
 			channels[cindex] = types[cindex].unpack(value)
+		return channels
+
+	def setPlainValues(self,hdr,record_id,values):
+		"""
+		Updates the channels of one record from values of builtin types.
+		"""
+		(types,channels) = self.sessions[hdr.name][record_id]
+		for (cindex,value) in enumerate(values):
+			channels[cindex] = types[cindex](value)
 		
 	def getValues(self,channels):
 		"""
@@ -106,6 +115,15 @@ class ArchiveQuery(WebQuery):
 
 from tops.core.network.server import Server
 
+def plain(value):
+	"""
+	Returns a channel value as an instance of its builtin base type so that it can be marshalled.
+	"""
+	for base in (float,int,long,str):
+		if isinstance(value,base):
+			return base(value)
+	return value
+
 class ArchiveServer(Server):
 	
 	Header = archiving_pb2.Header
@@ -118,6 +136,20 @@ class ArchiveServer(Server):
 	def handleMessage(self,msg):
 		self.factory.manager.setValues(self.hdr,msg)
 
+	def summarizeHeader(self,hdr):
+		# an ingest worker keeps its own sessions to unpack values
+		self.hdr = hdr
+		self.factory.manager.createSession(hdr)
+		return hdr.SerializeToString()
+
+	def summarizeMessage(self,msg):
+		values = self.factory.manager.setValues(self.hdr,msg)
+		return (msg.record_id,[plain(value) for value in values])
+
+	def applyMessage(self,summary):
+		(record_id,values) = summary
+		self.factory.manager.setPlainValues(self.hdr,record_id,values)
+
 
 def initialize():
 	"""
@@ -129,13 +161,18 @@ def initialize():
 
 	# load our run-time configuration
 	import tops.core.utility.config as config
+	import tops.core.utility.options as options
+	import tops.core.network.ingest as ingest
 	verbose = config.initialize()
+	worker = options.get('worker')
 
 	# use file-based logging for ourself (print statements are automatically redirected)
 	logpath = config.getfilename('archiver','logfile')
 	if not logpath or logpath == 'stdout':
 		log.startLogging(sys.stdout)
 	else:
+		if worker is not None:
+			logpath += '-worker%d' % worker
 		(logpath,logfile) = os.path.split(logpath)
 		log.startLogging(LogFile(logfile,logpath))
 
@@ -144,11 +181,24 @@ def initialize():
 		# create an archive manager to connect our consumers to our producers
 		manager = ArchiveManager()
 
-		# initialize a TCP server to listen for local or network clients producing log messages
 		factory = Factory()
 		factory.protocol = ArchiveServer
+		factory.section = 'archiver'
+		factory.shm_dir = config.get('archiver','shm_dir')
 		factory.manager = manager
-		reactor.listenTCP(config.getint('archiver','tcp_port'),factory)
+
+		# an ingest worker only decodes updates for our coordinator
+		if worker is not None:
+			ingest.startWorker('archiver',factory,worker)
+			reactor.run()
+			return
+
+		# initialize a TCP server to listen for local or network clients producing log messages
+		workers = config.getint('archiver','workers')
+		if workers:
+			ingest.startCoordinator('archiver',factory,workers)
+		else:
+			reactor.listenTCP(config.getint('archiver','tcp_port'),factory)
 		reactor.listenUNIX(config.getfilename('archiver','unix_addr'),factory)
 
 		# initialize an HTTP server to handle archive monitoring queries via http
@@ -0,0 +1,219 @@
+"""
+Benchmarks the core logging and archiving servers
+
+Measures how many messages per second the logging and archiving servers
+can decode and handle from an in-memory stream, without any socket or
+reactor overhead. Each server is timed with the original receive path,
+based on twisted's Int16StringReceiver, and with the receive path of
+tops.core.network.server, using both legacy and wide batched framing.
+Also measures the memory used by a logging FeedBuffer full of records.
+
+Run this module to print the results, e.g.
+
+  python -m tops.core.network.benchmark --messages 200000 --records 1000000
+"""
+
+## @package tops.core.network.benchmark
+# Benchmarks the core logging and archiving servers
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import sys
+import time
+import gc
+
+from tops.core.network import framing
+
+# the size of each simulated socket read
+chunkSize = 65536
+
+class NullWriter(object):
+	"""
+	Discards anything printed while a benchmark is running.
+	"""
+	def write(self,text):
+		pass
+
+def legacy(cls):
+	"""
+	Returns a variant of a Server subclass using the original receive path.
+	"""
+	from twisted.protocols.basic import Int16StringReceiver
+	from tops.core.network.server import Server
+	class LegacyServer(Int16StringReceiver,cls):
+		stringReceived = Server.stringReceived.im_func
+	return LegacyServer
+
+class FramingOnly(object):
+	"""
+	A Server mixin that counts frames without parsing or handling them.
+	"""
+	Header = Message = object
+	def __init__(self):
+		from tops.core.network.server import Server
+		if isinstance(self,Server):
+			Server.__init__(self)
+		self.msgcount = 0
+		self.framing = None
+		self.buffer = bytearray()
+	def stringReceived(self,raw):
+		self.msgcount += 1
+
+def logStream():
+	"""
+	Returns a header and a list of typical serialized log messages.
+	"""
+	from tops.core.network.logging import logging_pb2
+	hdr = logging_pb2.Header()
+	hdr.name = 'tcc.listener'
+	messages = [ ]
+	for index in range(100):
+		msg = logging_pb2.Message()
+		msg.levelno = 10
+		msg.source = 'proxy.tcc'
+		msg.body = 'Action "got_packet" enters the state LISTENING after %d packets' % index
+		messages.append(msg.SerializeToString())
+	return (hdr.SerializeToString(),messages)
+
+def archiveStream():
+	"""
+	Returns a header and a list of serialized TCC broadcast updates.
+	"""
+	from datetime import timedelta
+	from tops.core.network.archiving import archiving_pb2
+	from tops.core.network.archiving.record import ArchiveRecord
+	import tops.core.utility.data as data
+	names = ['channel%c' % (ord('A') + index) for index in range(25)]
+	record = ArchiveRecord('broadcast',[(name,data.double) for name in names])
+	hdr = archiving_pb2.Header()
+	hdr.name = 'tcc.listener'
+	hdr.timestamp_origin = int(time.time())
+	record.appendToHeader(hdr)
+	messages = [ ]
+	for index in range(100):
+		values = dict([(name,0.1*index + cindex) for (cindex,name) in enumerate(names)])
+		elapsed = timedelta(seconds=index,microseconds=1000*index)
+		messages.append(record.getUpdate(elapsed,values).SerializeToString())
+	return (hdr.SerializeToString(),messages)
+
+def encodeStream(wire,hdr,messages,count,batch=False,batchSize=100):
+	"""
+	Returns a stream of count messages framed for transmission.
+	"""
+	pieces = [framing.preamble(wire)]
+	pieces.extend(framing.encodeFrames(wire,[hdr]))
+	for offset in xrange(0,count,batchSize):
+		chunk = [messages[index % len(messages)] for index in xrange(offset,min(count,offset+batchSize))]
+		pieces.extend(framing.encodeFrames(wire,chunk,batch))
+	return ''.join(pieces)
+
+def run(protocol,factory,stream):
+	"""
+	Returns the time in seconds for a protocol to consume a stream.
+	"""
+	from twisted.test.proto_helpers import StringTransport
+	server = protocol()
+	server.factory = factory
+	stdout = sys.stdout
+	sys.stdout = NullWriter()
+	try:
+		server.makeConnection(StringTransport())
+		chunks = [stream[offset:offset+chunkSize] for offset in xrange(0,len(stream),chunkSize)]
+		start = time.time()
+		for chunk in chunks:
+			server.dataReceived(chunk)
+		elapsed = time.time() - start
+	finally:
+		sys.stdout = stdout
+	return (elapsed,server.msgcount)
+
+def benchmark(count):
+	"""
+	Prints the message rates achieved by each server and receive path.
+	"""
+	from twisted.internet.protocol import Factory
+	from twisted.protocols.basic import Int16StringReceiver
+	from tops.core.network.server import Server
+	from tops.core.network.logging.server import LogServer,FeedBuffer
+	from tops.core.network.archiving.server import ArchiveServer,ArchiveManager
+
+	logFactory = Factory()
+	logFactory.feed = FeedBuffer()
+	archiveFactory = Factory()
+	archiveFactory.manager = ArchiveManager()
+
+	class FramingOnlyServer(FramingOnly,Server):
+		pass
+	class LegacyFramingOnlyServer(FramingOnly,Int16StringReceiver):
+		pass
+
+	print '%-14s %-22s %12s %12s' % ('server','receive path','messages','msgs/sec')
+	for (name,cls,legacyCls,factory,stream) in (
+		('framing only',FramingOnlyServer,LegacyFramingOnlyServer,None,logStream()),
+		('LogServer',LogServer,legacy(LogServer),logFactory,logStream()),
+		('ArchiveServer',ArchiveServer,legacy(ArchiveServer),archiveFactory,archiveStream())):
+		(hdr,messages) = stream
+		legacyStream = encodeStream(framing.legacy,hdr,messages,count)
+		batchStream = encodeStream(framing.get('varint'),hdr,messages,count,batch=True)
+		for (label,protocol,data) in (
+			('Int16StringReceiver',legacyCls,legacyStream),
+			('bytearray int16',cls,legacyStream),
+			('bytearray varint batch',cls,batchStream)):
+			(elapsed,received) = run(protocol,factory,data)
+			assert(received == count + 1)
+			print '%-14s %-22s %12d %12.0f' % (name,label,received,received/elapsed)
+
+def residentBytes():
+	"""
+	Returns the resident memory size of this process in bytes.
+	"""
+	try:
+		pages = int(open('/proc/self/statm').read().split()[1])
+		import resource
+		return pages*resource.getpagesize()
+	except (IOError,IndexError,ValueError):
+		import resource
+		# ru_maxrss is a peak in kilobytes, which is close enough while we only grow
+		return 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def memory(count):
+	"""
+	Prints the memory used by a logging FeedBuffer holding count records.
+	"""
+	from tops.core.network.logging import logging_pb2
+	from tops.core.network.logging.server import FeedBuffer
+	from tops.core.network.logging.record import LogRecord
+	(hdr,messages) = logStream()
+	header = logging_pb2.Header()
+	header.ParseFromString(hdr)
+	decoded = [ ]
+	for raw in messages:
+		msg = logging_pb2.Message()
+		msg.ParseFromString(raw)
+		decoded.append(msg)
+	feed = FeedBuffer(count)
+	gc.collect()
+	before = residentBytes()
+	start = time.time()
+	for index in xrange(count):
+		feed.add(LogRecord(decoded[index % len(decoded)],header))
+	elapsed = time.time() - start
+	gc.collect()
+	used = residentBytes() - before
+	print '%-14s %-22s %12d %12.0f' % ('FeedBuffer','records added',count,count/elapsed)
+	print '%-14s %-22s %12.1f %12.0f' % ('FeedBuffer','MB resident, bytes/rec',used/1048576.,used/float(count))
+
+if __name__ == '__main__':
+	from optparse import OptionParser
+	parser = OptionParser()
+	parser.add_option('--messages',type='int',default=100000,
+		help='number of messages to send to each server')
+	parser.add_option('--records',type='int',default=1000000,
+		help='number of records to buffer for the memory benchmark (0 to skip)')
+	(options,args) = parser.parse_args()
+	benchmark(options.messages)
+	if options.records:
+		memory(options.records)
@@ -7,6 +7,22 @@ and archiving. The implementation is intended for Header and Message
 classes that correspond to Google protocol buffers, but any classes that
 provide a SerializeToString() method can be used. There is a
 corresponding server class in this package.
+
+A client normally sends each packet with a blocking socket write in the
+caller's thread. In buffered mode, packets are instead appended to a
+bounded in-memory queue that a background flusher thread drains with
+large writes, so that the caller never waits on the network. The flusher
+can also wait for a short coalescing window so that packets produced in
+a burst share a single write.
+
+A client connected to a server on the same host, via a UNIX socket, can
+instead write its packets to a shared memory ring that the server polls,
+so that sending a packet does not need any system call. See
+tops.core.network.shmring for details.
+
+A client with a spool keeps running when its server is unreachable or
+restarts, by storing its packets on disk until it can reconnect. See
+tops.core.network.spool for details.
 """
 
 ## @package tops.core.network.client
@@ -18,38 +34,593 @@ corresponding server class in this package.
 # This project is hosted at sdss3.org and tops.googlecode.com
 
 import socket
+import select
 import struct
+import threading
+import time
+import tempfile
+
+from collections import deque
+
+import framing
+from framing import get as getFraming,Compressor
+from shmring import RingBuffer,RingException
+from spool import Spool
 
 class ClientException(Exception):
 	pass
 
+def sendPieces(sock,pieces):
+	"""
+	Writes a list of strings to a socket with as few system calls as possible.
+	
+	The pieces are joined and written with one sendall(). Python 2
+	sockets have no vectored sendmsg(), so the pieces are always copied
+	into a single string first.
+	"""
+	sock.sendall(''.join(pieces))
+
+
+class BoundedQueue(object):
+	"""
+	A bounded FIFO queue shared between producer threads and one consumer.
+	
+	When the queue is full, put() applies one of three overflow
+	policies: DROP_OLDEST discards the oldest queued item to make room,
+	DROP_NEWEST discards the item being added, and BLOCK waits until the
+	consumer has made room. The queued and dropped attributes count the
+	items accepted and discarded over the lifetime of the queue.
+	
+	The optional size function measures each item (in bytes, for
+	example) so that a consumer can wait for enough data to accumulate.
+	Otherwise, each item has unit size.
+	
+	A consumer calls done() for the items it has finished with, so that
+	join() can wait for every item accepted so far to be handled. The
+	maxDepth attribute records the most items ever held at once.
+	"""
+	DROP_OLDEST = 'drop-oldest'
+	DROP_NEWEST = 'drop-newest'
+	BLOCK = 'block'
+	policies = (DROP_OLDEST,DROP_NEWEST,BLOCK)
+
+	def __init__(self,maxsize=1000,overflow=DROP_OLDEST,size=None):
+		if overflow not in self.policies:
+			raise ClientException('unknown overflow policy "%s"' % overflow)
+		if maxsize < 1:
+			raise ClientException('queue size must be positive')
+		self.maxsize = maxsize
+		self.overflow = overflow
+		self.size = size
+		self.items = deque()
+		self.nbytes = 0
+		self.wakeBytes = None
+		self.queued = 0
+		self.dropped = 0
+		self.unfinished = 0
+		self.maxDepth = 0
+		self.closed = False
+		lock = threading.Lock()
+		self.notEmpty = threading.Condition(lock)
+		self.notFull = threading.Condition(lock)
+		self.allDone = threading.Condition(lock)
+
+	def __len__(self):
+		return len(self.items)
+
+	def put(self,item):
+		"""
+		Adds an item to the queue, applying our overflow policy if necessary.
+		
+		Returns True if the item was queued or False if it was dropped.
+		"""
+		self.notFull.acquire()
+		try:
+			if self.closed:
+				raise ClientException('cannot put items into a closed queue')
+			while len(self.items) >= self.maxsize:
+				if self.overflow == self.DROP_NEWEST:
+					self.dropped += 1
+					return False
+				elif self.overflow == self.DROP_OLDEST:
+					oldest = self.items.popleft()
+					self.nbytes -= self.size(oldest) if self.size else 1
+					self.dropped += 1
+					self.unfinished -= 1
+				else:
+					self.notFull.wait()
+					if self.closed:
+						self.dropped += 1
+						raise ClientException('cannot put items into a closed queue')
+			self.items.append(item)
+			self.nbytes += self.size(item) if self.size else 1
+			self.queued += 1
+			self.unfinished += 1
+			if len(self.items) > self.maxDepth:
+				self.maxDepth = len(self.items)
+			# wake up a consumer waiting for its first item, for enough
+			# data to coalesce, or for us to fill the queue
+			if (len(self.items) == 1 or len(self.items) >= self.maxsize or
+				(self.wakeBytes is not None and self.nbytes >= self.wakeBytes)):
+				self.notEmpty.notify()
+			return True
+		finally:
+			self.notFull.release()
+
+	def getAll(self,timeout=None,delay=0,minbytes=0):
+		"""
+		Removes and returns a list of all queued items.
+		
+		Waits for at least one item to be queued unless the timeout (in
+		seconds) expires first, or the queue is closed. Returns an empty
+		list if no items are available. If delay is positive, continues
+		to wait for up to delay seconds after the first item arrives
+		until items of total size minbytes are queued, so that items
+		produced close together in time can be coalesced.
+		"""
+		self.notEmpty.acquire()
+		try:
+			if not self.items and not self.closed:
+				self.notEmpty.wait(timeout)
+			if self.items and delay > 0 and self.nbytes < minbytes:
+				deadline = time.time() + delay
+				self.wakeBytes = minbytes
+				while (not self.closed and self.nbytes < minbytes and
+					len(self.items) < self.maxsize):
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					self.notEmpty.wait(remaining)
+				self.wakeBytes = None
+			items = list(self.items)
+			self.items.clear()
+			self.nbytes = 0
+			self.notFull.notifyAll()
+			return items
+		finally:
+			self.notEmpty.release()
+
+	def done(self,count):
+		"""
+		Records that the consumer has finished with count items.
+		"""
+		self.allDone.acquire()
+		try:
+			self.unfinished -= count
+			if self.unfinished <= 0:
+				self.allDone.notifyAll()
+		finally:
+			self.allDone.release()
+
+	def join(self,timeout=None):
+		"""
+		Waits until the consumer has finished with every item accepted so far.
+		
+		Returns False if the timeout (in seconds) expires first.
+		"""
+		self.allDone.acquire()
+		try:
+			if timeout is not None:
+				deadline = time.time() + timeout
+			while self.unfinished > 0:
+				if timeout is None:
+					self.allDone.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self.allDone.wait(remaining)
+			return True
+		finally:
+			self.allDone.release()
+
+	def close(self):
+		"""
+		Closes the queue to new items and wakes up any waiting threads.
+		
+		Items already queued remain available to getAll().
+		"""
+		self.notEmpty.acquire()
+		try:
+			self.closed = True
+			self.notEmpty.notifyAll()
+			self.notFull.notifyAll()
+		finally:
+			self.notEmpty.release()
+
+
+class Flusher(threading.Thread):
+	"""
+	Drains a BoundedQueue in a background thread.
+	
+	Each batch of queued items is passed to the write method provided,
+	which should return False to stop flushing. The thread runs until
+	the queue is closed and empty, or the write method fails. A positive
+	delay coalesces items that arrive within delay seconds of the first
+	item in a batch, until minbytes are queued. When the write method
+	fails, the queue is closed and any items left in it are passed to
+	the discard method, if one is provided.
+	"""
+	def __init__(self,queue,write,delay=0,minbytes=0,discard=None):
+		threading.Thread.__init__(self,name='flusher')
+		self.setDaemon(True)
+		self.queue = queue
+		self.write = write
+		self.delay = delay
+		self.minbytes = minbytes
+		self.discard = discard
+		self.start()
+
+	def run(self):
+		try:
+			while True:
+				items = self.queue.getAll(None,self.delay,self.minbytes)
+				if not items:
+					if self.queue.closed:
+						break
+					continue
+				try:
+					if not self.write(items):
+						break
+				finally:
+					self.queue.done(len(items))
+		finally:
+			# nobody is left to write any new items
+			self.queue.close()
+			items = self.queue.getAll(0)
+			self.queue.done(len(items))
+			if items and self.discard is not None:
+				self.discard(items)
+
+
+class FlowControl(object):
+	"""
+	Paces the packets sent on one connection with credit granted by a server.
+	
+	Our window of frames and bytes (or no limit on bytes if zero) is
+	announced in the connection header and is also our initial credit.
+	Each packet sent uses up credit, and the server sends more as it
+	handles them. When we run out, pace() waits for more credit with
+	the BLOCK overflow policy and otherwise sheds the packets it has no
+	credit for. The throttled, shed and throttleTime attributes count
+	the number of times we ran out of credit, the packets shed and the
+	seconds spent waiting for credit.
+	
+	Control frames with other opcodes are passed to any handler
+	registered for them in the handlers dictionary. When a ControlReader
+	is reading our connection, we wait for it to grant credit instead of
+	reading control frames ourselves.
+	"""
+	def __init__(self,frames,nbytes=0,overflow=BoundedQueue.BLOCK):
+		self.window = (frames,nbytes)
+		self.overflow = overflow
+		self.handlers = { framing.CONTROL_CREDIT: self.grant }
+		self.reader = None
+		self.credit = threading.Condition()
+		self.grants = 0
+		self.throttled = 0
+		self.shed = 0
+		self.throttleTime = 0
+		self.start()
+
+	def start(self):
+		"""
+		Resets our credit for a new connection.
+		"""
+		self.credit.acquire()
+		(self.frames,self.nbytes) = self.window
+		self.credit.release()
+		self.controls = ''
+		self.reader = None
+
+	def announce(self,hdr):
+		"""
+		Requests flow control in a connection header.
+		"""
+		(hdr.credit_frames,hdr.credit_bytes) = self.window
+		self.start()
+
+	def grant(self,payload):
+		(frames,nbytes) = framing.credit.unpack(payload)
+		self.credit.acquire()
+		self.frames += frames
+		self.nbytes += nbytes
+		self.grants += 1
+		self.credit.notifyAll()
+		self.credit.release()
+
+	def allowance(self,packets):
+		"""
+		Returns how many of the packets we currently have credit to send.
+		
+		A packet can overdraw our byte credit as long as some is left,
+		so that a packet larger than our window can still be sent.
+		"""
+		count = min(len(packets),self.frames)
+		if self.window[1]:
+			remaining = self.nbytes
+			for index in xrange(count):
+				if remaining <= 0:
+					return index
+				remaining -= len(packets[index])
+		return count
+
+	def pace(self,sock,packets,write):
+		"""
+		Passes each chunk of packets that we have credit for to write.
+		"""
+		while packets:
+			count = self.allowance(packets)
+			if count < len(packets):
+				# check for new credit before throttling
+				self.receive(sock,0)
+				count = self.allowance(packets)
+			if count == 0:
+				self.throttled += 1
+				if self.overflow != BoundedQueue.BLOCK:
+					self.shed += len(packets)
+					return
+				start = time.time()
+				while count == 0:
+					self.receive(sock,None)
+					count = self.allowance(packets)
+				self.throttleTime += time.time() - start
+			(chunk,packets) = (packets[:count],packets[count:])
+			self.credit.acquire()
+			self.frames -= len(chunk)
+			self.nbytes -= sum([len(packet) for packet in chunk])
+			self.credit.release()
+			write(chunk)
+
+	def receive(self,sock,timeout):
+		"""
+		Reads and handles any control frames sent by the server.
+		
+		Waits up to timeout seconds for data to arrive, or indefinitely
+		if timeout is None. Raises socket.error if the connection fails.
+		"""
+		reader = self.reader
+		if reader is not None:
+			self.credit.acquire()
+			try:
+				if not reader.alive:
+					raise socket.error('connection closed by server')
+				if timeout != 0:
+					self.credit.wait(reader.pollInterval if timeout is None else min(timeout,reader.pollInterval))
+			finally:
+				self.credit.release()
+			return
+		try:
+			(readable,writable,errors) = select.select([sock],[],[],timeout)
+			if not readable:
+				return
+			data = sock.recv(65536)
+		except select.error,e:
+			raise socket.error(str(e))
+		if not data:
+			raise socket.error('connection closed by server')
+		(controls,self.controls) = framing.decodeControls(self.controls + data)
+		for (opcode,payload) in controls:
+			handler = self.handlers.get(opcode)
+			if handler is not None:
+				handler(payload)
+
+
+class ControlReader(threading.Thread):
+	"""
+	Reads the control frames that a server sends on a connection.
+	
+	Runs as a daemon thread until the connection fails or is closed, or
+	until stop() is called, passing each control frame to the handler
+	registered for its opcode in the handlers dictionary. A FlowControl
+	for the same connection waits for us to grant it credit. Our alive
+	attribute is False once we stop reading.
+	"""
+	# seconds between checks that we have not been stopped
+	pollInterval = 0.5
+
+	def __init__(self,sock,handlers,flow=None):
+		threading.Thread.__init__(self,name='ControlReader')
+		self.setDaemon(True)
+		self.sock = sock
+		self.handlers = handlers
+		self.flow = flow
+		self.alive = True
+		self.stopped = False
+		if flow is not None:
+			flow.reader = self
+		self.start()
+
+	def run(self):
+		controls = ''
+		try:
+			while not self.stopped:
+				try:
+					(readable,writable,errors) = select.select([self.sock],[],[],self.pollInterval)
+					if not readable:
+						continue
+					data = self.sock.recv(65536)
+				except (select.error,socket.error,ValueError):
+					break
+				if not data:
+					break
+				try:
+					(frames,controls) = framing.decodeControls(controls + data)
+				except framing.FramingException:
+					break
+				for (opcode,payload) in frames:
+					handler = self.handlers.get(opcode)
+					if handler is not None:
+						handler(payload)
+		finally:
+			self.alive = False
+			if self.flow is not None:
+				# wake a sender waiting for credit that will never arrive
+				self.flow.credit.acquire()
+				self.flow.credit.notifyAll()
+				self.flow.credit.release()
+
+	def stop(self):
+		self.stopped = True
+
+
 class Client(object):
 	"""
 	Manages the client side of a write-only socket protocol.
 	
 	Uses a UNIX socket when a path is provided and can be connected to.
 	Otherwise, falls back to a TCP streams socket using the specified
-	host and port. Data is sent in binary packets prefixed with an
-	unsigned 16-bit length. The first packet is a Header object and all
-	subsequent packets are Message objects. The Header and Message types
-	must be defined by the superclass.
+	host and port. Data is sent in binary packets prefixed with their
+	length. The first packet is a Header object and all subsequent
+	packets are Message objects. The Header and Message types must be
+	defined by the superclass.
+	
+	The framing names one of the tops.core.network.framing prefixes.
+	The default unsigned 16-bit prefix limits packets to 65535 bytes
+	and is understood by all servers. Wider framings are negotiated
+	when we connect and also allow each buffered batch to be sent as a
+	single batch frame when batch is True.
+	
+	When buffered is True, send() only queues each packet and a Flusher
+	thread writes them to the socket. At most maxqueue packets are held
+	in memory and overflow is one of the BoundedQueue policies. A write
+	failure in the flusher thread discards any packets it was writing,
+	counted by the lost attribute, and closes the socket. The flusher
+	then stops, packets still queued are also lost, and send() raises
+	ClientException. Packets queued within coalesce_delay seconds of
+	each other are written together, until coalesce_bytes have
+	accumulated. The writes counter tracks the number of socket writes
+	used.
+	
+	When shm_size is positive and we connect via a UNIX socket, packets
+	are written to a shared memory ring of shm_size bytes, created in
+	shm_dir, instead of the socket, and the buffered and framing options
+	are ignored. A full ring blocks with the BLOCK overflow policy and
+	otherwise drops the packet being sent, counted by the dropped
+	attribute, since only the server can discard older packets.
+	
+	When compression names a tops.core.network.framing.Compressor, our
+	header announces it and every later packet, or buffered batch of
+	packets, is sent as a compressed frame. Compression needs a wide
+	framing and is not used with a shared memory ring. The compressor
+	attribute keeps track of the compression ratio and CPU time used.
+	
+	When flow_control is True, our header asks the server for flow
+	control with an initial window of credit_frames packets and
+	credit_bytes bytes (or no limit on bytes if zero). Each packet sent
+	uses up credit, which the server grants back as it handles them.
+	The flow attribute is then a FlowControl that paces our packets and
+	counts when we were throttled. Flow control is not used with a
+	shared memory ring.
+	
+	When spool_dir is set, packets that cannot be written because the
+	server is unreachable, including when we are first created, are
+	appended to a Spool in that directory of up to spool_bytes, in
+	segments of spool_segment bytes. We try to reconnect at most every
+	spool_retry seconds as more packets are sent. A new connection
+	resends our header and then replays the spool in bulk before any
+	new packets. Our header must be sent before any other packets, and
+	a spool is not used with a shared memory ring.
+	
+	When multiplex names our service, we open a channel of the
+	connection that tops.core.network.mux shares between all clients in
+	this process, instead of our own socket. Flow control is not used
+	with a multiplexed connection.
 	"""
 
-	lengthPrefix = struct.Struct('!H') # 16-bit unsigned int using network byte order
+	# seconds to wait between attempts to write to a full ring
+	ringWait = 0.001
+	# seconds that close() waits for our flusher to write queued packets
+	closeTimeout = 5.0
 
-	def __init__(self,unix_path,tcp_host,tcp_port):
+	def __init__(self,unix_path,tcp_host,tcp_port,
+		buffered=False,maxqueue=1000,overflow=BoundedQueue.DROP_OLDEST,
+		coalesce_bytes=65536,coalesce_delay=0,framing='int16',batch=False,
+		shm_size=0,shm_dir=None,compression=None,
+		flow_control=False,credit_frames=1000,credit_bytes=1048576,
+		spool_dir=None,spool_bytes=67108864,spool_segment=4194304,spool_retry=1.0,
+		multiplex=None):
 		self.unix_addr = unix_path
+		self.multiplex = multiplex
+		if multiplex:
+			flow_control = False
 		self.tcp_addr = (tcp_host,tcp_port)
 		self.hdr = None
-		self.socket = self.connect()
+		self.framing = getFraming(framing)
+		if batch and self.framing.code is None:
+			raise ClientException('batches need a wide framing')
+		if compression and self.framing.code is None:
+			raise ClientException('compression needs a wide framing')
+		if overflow not in BoundedQueue.policies:
+			raise ClientException('unknown overflow policy "%s"' % overflow)
+		self.batch = batch
+		self.overflow = overflow
+		self.lost = 0
+		self.writes = 0
+		self.dropped = 0
+		self.ring = None
+		self.socket = None
+		# the header that we announce and the one sent on our current connection
+		self.announced = None
+		self.session = None
+		if spool_dir:
+			self.spool = Spool(spool_dir,spool_bytes,spool_segment)
+			self.spoolRetry = spool_retry
+			self.retryTime = time.time() + spool_retry
+			try:
+				self.socket = self.connect()
+			except socket.error:
+				pass
+		else:
+			self.spool = None
+			self.socket = self.connect()
+		if shm_size and self.socket is not None and self.socket.family == socket.AF_UNIX:
+			self.ring = RingBuffer.create(shm_dir or tempfile.gettempdir(),shm_size)
+			self.spool = None
+			buffered = False
+			compression = None
+			flow_control = False
+		if flow_control:
+			self.flow = FlowControl(credit_frames,credit_bytes,overflow)
+		else:
+			self.flow = None
+		if compression:
+			self.compressor = Compressor(compression)
+		else:
+			self.compressor = None
+		if buffered:
+			self.queue = BoundedQueue(maxqueue,overflow,len)
+			self.flusher = Flusher(self.queue,self.flush,coalesce_delay,coalesce_bytes,self.discard)
+		else:
+			self.queue = None
+			self.flusher = None
+		if self.socket is not None:
+			self.handshake()
 	
+	def handshake(self):
+		"""
+		Selects our framing with the server, if necessary.
+		
+		Announces our ring instead if we have one.
+		"""
+		if self.ring is not None:
+			self.write([framing.announceRing(self.ring.path)])
+			return
+		preamble = framing.preamble(self.framing)
+		if preamble:
+			self.write([preamble])
+
 	def connect(self):
 		"""
 		Attempts to return a connected socket.
 		
 		A UNIX address is tried first if one was provided in the
-		constructor, otherwise a TCP address is tried.
+		constructor, otherwise a TCP address is tried. Returns a channel
+		of our process's multiplexed connection instead if we have one.
 		"""
+		if self.multiplex:
+			import mux
+			return mux.shared().open(self.multiplex)
 		socket_type = socket.SOCK_STREAM
 		if self.unix_addr is not None:
 			try:
@@ -64,38 +635,637 @@ class Client(object):
 		
 	def send(self,data):
 		"""
-		Sends the specified data with an unsigned 16-bit length prefix.
+		Sends the specified data with a length prefix.
+		
+		In buffered mode, the data is queued for our flusher thread
+		and this method returns immediately.
 		"""
-		if self.socket is None:
+		if self.socket is None and self.spool is None:
 			raise ClientException("must connect socket before sending")
-		# add a length prefix
-		packet = self.lengthPrefix.pack(len(data)) + data
-		# try to send the packet
+		if self.ring is not None:
+			self.putRing(data)
+			return
+		if len(data) > self.framing.maxLength:
+			raise ClientException("packet of %d bytes is too long for %s framing" %
+				(len(data),self.framing.name))
+		if self.queue is not None:
+			self.queue.put(data)
+		elif self.spool is not None:
+			self.deliver([data])
+		elif self.flow is not None:
+			self.writePaced([data])
+		else:
+			self.write(framing.encodeFrames(self.framing,[data],compressor=self.compressor))
+
+	def putRing(self,data):
+		"""
+		Writes data to our ring, applying our overflow policy if it is full.
+		
+		Wakes up the server with a single byte if it has stopped polling.
+		"""
+		ring = self.ring
 		try:
-			if hasattr(self.socket,"sendall"):
-				self.socket.sendall(packet)
-			else:
-				offset = 0
-				remaining = len(packet)
-				while remaining > 0:
-					sent = self.socket.send(packet[offset:])
-					offset += sent
-					remaining -= sent
+			while not ring.put(data):
+				if self.overflow != BoundedQueue.BLOCK:
+					self.dropped += 1
+					return
+				# wake the server and check it is still listening while we wait
+				self.write(['\x00'])
+				time.sleep(self.ringWait)
+		except RingException,e:
+			raise ClientException(str(e))
+		if ring.isSleeping():
+			ring.setSleeping(False)
+			self.write(['\x00'])
+
+	def write(self,pieces):
+		"""
+		Writes a list of strings to our socket, blocking until they have been sent.
+		"""
+		try:
+			sendPieces(self.socket,pieces)
+			self.writes += 1
 		except socket.error:
-			self.close()
+			self.disconnect()
 			raise
-			
-	def close(self):
+
+	def writePaced(self,packets):
+		"""
+		Writes packets as quickly as our flow control credit allows.
+		"""
+		try:
+			self.flow.pace(self.socket,packets,lambda chunk:
+				self.write(framing.encodeFrames(self.framing,chunk,self.batch,self.compressor)))
+		except socket.error:
+			self.disconnect()
+			raise
+
+	def flush(self,batch):
+		"""
+		Writes a batch of queued data with a single socket write.
+		
+		Called from our flusher thread. Returns False if the write
+		failed and the flusher should stop, unless we have a spool.
+		"""
+		if self.spool is not None:
+			self.deliver(batch)
+			return True
+		if self.socket is None:
+			self.lost += len(batch)
+			return False
+		try:
+			if self.flow is not None:
+				self.writePaced(batch)
+			else:
+				self.write(framing.encodeFrames(self.framing,batch,self.batch,self.compressor))
+			return True
+		except socket.error:
+			self.lost += len(batch)
+			return False
+
+	def discard(self,batch):
+		"""
+		Counts the queued data left behind when our flusher stops.
+		"""
+		self.lost += len(batch)
+
+	def writePackets(self,packets):
+		"""
+		Writes a list of packets to our socket.
+		"""
+		if self.flow is not None:
+			self.writePaced(packets)
+		else:
+			self.write(framing.encodeFrames(self.framing,packets,self.batch,self.compressor))
+
+	def deliver(self,packets):
+		"""
+		Writes packets to the server, or appends them to our spool.
+		
+		Tries to reconnect first, if necessary, and replays any
+		spooled packets before these.
+		"""
+		if self.socket is None:
+			self.reconnect()
+		try:
+			if self.socket is not None and len(self.spool):
+				self.replay()
+			if self.socket is not None:
+				self.writePackets(packets)
+				return
+		except socket.error:
+			pass
+		self.spool.append(packets)
+
+	def reconnect(self):
+		"""
+		Tries to reconnect, if we have not tried too recently.
+		
+		The new connection starts with the header of the oldest spooled
+		packets, or else with our own header.
+		"""
+		now = time.time()
+		if now < self.retryTime:
+			return
+		self.retryTime = now + self.spoolRetry
+		try:
+			self.open(self.spool.firstHeader() or self.announced)
+		except socket.error:
+			pass
+
+	def open(self,header):
+		"""
+		Opens a new connection that starts with the specified serialized header.
+		"""
+		self.disconnect()
+		self.socket = self.connect()
+		self.handshake()
+		if self.compressor is not None:
+			self.compressor.reset()
+		if self.flow is not None:
+			self.flow.start()
+		self.write(framing.encodeFrames(self.framing,[header]))
+		self.session = header
+
+	def replay(self):
+		"""
+		Replays our spool, opening a new connection for each header.
+		
+		Finishes with a connection that announces our own header.
+		"""
+		def send(header,packets):
+			if header != self.session:
+				self.open(header)
+			self.writePackets(packets)
+		self.spool.replay(send)
+		if self.session != self.announced:
+			self.open(self.announced)
+
+	def disconnect(self):
+		if self.ring:
+			self.ring.close()
+			self.ring = None
 		if self.socket:
 			self.socket.close()
-			self.socket = None			
+			self.socket = None
+
+	def close(self):
+		"""
+		Closes our socket.
+		
+		In buffered mode, waits up to closeTimeout seconds for any queued
+		packets to be written first. A flusher still waiting for the server
+		after that, e.g. for flow control credit, is stopped by shutting
+		down our socket, and the packets it was writing are lost.
+		"""
+		if self.queue is not None:
+			self.queue.close()
+			self.flusher.join(self.closeTimeout)
+			if self.flusher.isAlive() and hasattr(self.socket,'shutdown'):
+				try:
+					self.socket.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					pass
+				self.flusher.join(self.closeTimeout)
+		self.disconnect()
+		if self.spool is not None:
+			self.spool.close()
 		
 	def sendHeader(self,hdr):
 		"""
 		Sends our header to the server.
+		
+		A header that announces compression or flow control is written
+		immediately since it is never compressed and does not use any
+		credit. With a spool, the header is also written immediately, if
+		we are connected, and is remembered for each new connection.
 		"""
 		self.hdr = hdr
-		self.send(hdr.SerializeToString())
+		if self.compressor is None and self.flow is None and self.spool is None:
+			self.send(hdr.SerializeToString())
+			return
+		if self.compressor is not None:
+			hdr.compression = self.compressor.name
+		if self.flow is not None:
+			self.flow.announce(hdr)
+		self.announced = hdr.SerializeToString()
+		if self.spool is not None:
+			self.spool.setHeader(self.announced)
+			if self.socket is None:
+				return
+			try:
+				self.write(framing.encodeFrames(self.framing,[self.announced]))
+			except socket.error:
+				return
+		else:
+			self.write(framing.encodeFrames(self.framing,[self.announced]))
+		self.session = self.announced
 	
 	def sendMessage(self,msg):
 		self.send(msg.SerializeToString())
+
+
+def getOptions(section):
+	"""
+	Returns the client keyword options configured in the named section.
+	
+	Only options that are set in the configuration are returned so that
+	a client created with these options otherwise uses our defaults.
+	The tops.core.utility.config module must already be initialized.
+	"""
+	import tops.core.utility.config as config
+	options = { }
+	if config.get(section,'framing'):
+		options['framing'] = config.get(section,'framing')
+		options['batch'] = bool(config.getboolean(section,'batch'))
+	if config.getboolean(section,'buffered'):
+		options['buffered'] = True
+		options['maxqueue'] = config.getint(section,'queue_size') or 1000
+		options['overflow'] = config.get(section,'overflow') or BoundedQueue.DROP_OLDEST
+		options['coalesce_bytes'] = config.getint(section,'coalesce_bytes') or 65536
+		options['coalesce_delay'] = config.getfloat(section,'coalesce_delay') or 0
+	if config.getboolean(section,'flow_control'):
+		options['flow_control'] = True
+		options['credit_frames'] = config.getint(section,'credit_frames') or 1000
+		options['credit_bytes'] = config.getint(section,'credit_bytes') or 0
+	compression = config.get(section,'compression')
+	if compression and compression != 'none':
+		options['compression'] = compression
+	if config.getint(section,'shm_size'):
+		options['shm_size'] = config.getint(section,'shm_size')
+		options['shm_dir'] = config.get(section,'shm_dir')
+	if config.getboolean(section,'spool'):
+		options['spool_dir'] = config.get(section,'spool_dir')
+		options['spool_bytes'] = config.getint(section,'spool_bytes') or 67108864
+		options['spool_segment'] = config.getint(section,'spool_segment') or 4194304
+		options['spool_retry'] = config.getfloat(section,'spool_retry') or 1.0
+	if config.getboolean(section,'multiplex'):
+		options['multiplex'] = section
+	return options
+
+
+import unittest
+
+class ClientTests(unittest.TestCase):
+
+	class PairClient(object):
+		"""
+		Mixin that connects to one end of a local socket pair.
+		"""
+		def connect(self):
+			(s,self.peer) = socket.socketpair()
+			return s
+
+	def read(self,s,nbytes):
+		data = ''
+		while len(data) < nbytes:
+			chunk = s.recv(nbytes - len(data))
+			if not chunk:
+				break
+			data += chunk
+		return data
+
+	def test00(self):
+		"""Bounded queue drops the oldest items on overflow"""
+		q = BoundedQueue(3,BoundedQueue.DROP_OLDEST)
+		for item in range(5):
+			self.assertEqual(q.put(item),True)
+		self.assertEqual(q.getAll(0),[2,3,4])
+		self.assertEqual((q.queued,q.dropped),(5,2))
+
+	def test01(self):
+		"""Bounded queue drops the newest items on overflow"""
+		q = BoundedQueue(3,BoundedQueue.DROP_NEWEST)
+		results = [q.put(item) for item in range(5)]
+		self.assertEqual(results,[True,True,True,False,False])
+		self.assertEqual(q.getAll(0),[0,1,2])
+		self.assertEqual((q.queued,q.dropped),(3,2))
+
+	def test02(self):
+		"""Bounded queue blocks on overflow until the consumer makes room"""
+		q = BoundedQueue(2,BoundedQueue.BLOCK)
+		q.put(0)
+		q.put(1)
+		consumed = [ ]
+		def consume():
+			time.sleep(0.1)
+			consumed.extend(q.getAll())
+		t = threading.Thread(target=consume)
+		t.start()
+		q.put(2)
+		t.join()
+		self.assertEqual(consumed,[0,1])
+		self.assertEqual(q.getAll(0),[2])
+		self.assertEqual(q.dropped,0)
+
+	def test03(self):
+		"""Closed queue rejects new items and releases waiting consumers"""
+		q = BoundedQueue()
+		q.put('a')
+		q.close()
+		self.assertRaises(ClientException,lambda: q.put('b'))
+		self.assertEqual(q.getAll(),['a'])
+		self.assertEqual(q.getAll(),[])
+
+	def test04(self):
+		"""Invalid queue configurations are rejected"""
+		self.assertRaises(ClientException,lambda: BoundedQueue(10,'drop-everything'))
+		self.assertRaises(ClientException,lambda: BoundedQueue(0))
+
+	def test05(self):
+		"""Buffered client delivers all packets in order when closed"""
+		class BufferedClient(self.PairClient,Client):
+			pass
+		c = BufferedClient(None,None,None,buffered=True,maxqueue=100,
+			overflow=BoundedQueue.BLOCK)
+		for index in range(50):
+			c.send('packet%02d' % index)
+		c.close()
+		expected = ''.join([struct.pack('!H',8) + 'packet%02d' % index for index in range(50)])
+		self.assertEqual(self.read(c.peer,len(expected)),expected)
+		self.assertEqual((c.queue.queued,c.queue.dropped,c.lost),(50,0,0))
+
+	def test06(self):
+		"""Buffered client counts packets lost when the socket fails"""
+		class BufferedClient(self.PairClient,Client):
+			pass
+		c = BufferedClient(None,None,None,buffered=True)
+		c.peer.close()
+		c.send('x'*1000)
+		c.flusher.join(5)
+		self.assertEqual(c.socket,None)
+		self.assertEqual(c.lost,1)
+		self.assertRaises(ClientException,lambda: c.send('more'))
+
+	def test07(self):
+		"""Bounded queue waits to coalesce items until enough bytes arrive"""
+		q = BoundedQueue(100,BoundedQueue.BLOCK,len)
+		q.put('abc')
+		def produce():
+			time.sleep(0.05)
+			q.put('defgh')
+		t = threading.Thread(target=produce)
+		t.start()
+		start = time.time()
+		self.assertEqual(q.getAll(None,5.0,8),['abc','defgh'])
+		self.assertTrue(time.time() - start < 1.0)
+		t.join()
+		self.assertEqual(q.nbytes,0)
+		q.put('x')
+		self.assertEqual(q.getAll(None,0.05,100),['x'])
+
+	def test08(self):
+		"""Buffered client coalesces a burst of packets into one write"""
+		class BufferedClient(self.PairClient,Client):
+			pass
+		c = BufferedClient(None,None,None,buffered=True,coalesce_delay=0.5,coalesce_bytes=100)
+		for index in range(10):
+			c.send('0123456789')
+		expected = (struct.pack('!H',10) + '0123456789')*10
+		self.assertEqual(self.read(c.peer,len(expected)),expected)
+		c.close()
+		self.assertEqual(c.writes,1)
+
+	def test10(self):
+		"""Wide framing negotiates and sends a buffered batch frame"""
+		class BufferedClient(self.PairClient,Client):
+			pass
+		c = BufferedClient(None,None,None,buffered=True,coalesce_delay=0.5,
+			coalesce_bytes=70010,framing='int32',batch=True)
+		c.send('h'*70000)
+		for index in range(10):
+			c.send('%d' % index)
+		c.close()
+		wide = framing.get('int32')
+		expected = (framing.preamble(wide) +
+			''.join(framing.encodeFrames(wide,['h'*70000] + ['%d' % index for index in range(10)],True)))
+		self.assertEqual(self.read(c.peer,len(expected)+1),expected)
+
+	def test11(self):
+		"""Long packets need a wide framing"""
+		class SyncClient(self.PairClient,Client):
+			pass
+		c = SyncClient(None,None,None)
+		self.assertRaises(ClientException,lambda: c.send('x'*65536))
+		self.assertRaises(ClientException,lambda: SyncClient(None,None,None,batch=True))
+
+	def test09(self):
+		"""Pieces of any size are written in order"""
+		(a,b) = socket.socketpair()
+		pieces = ['x'*n for n in range(200)]
+		sendPieces(a,pieces)
+		expected = ''.join(pieces)
+		self.assertEqual(self.read(b,len(expected)),expected)
+
+	def test12(self):
+		"""Client on a UNIX socket announces and writes to a shared memory ring"""
+		import shutil
+		class RingClient(self.PairClient,Client):
+			pass
+		directory = tempfile.mkdtemp()
+		try:
+			c = RingClient(None,None,None,buffered=True,overflow=BoundedQueue.DROP_NEWEST,
+				shm_size=64,shm_dir=directory)
+			self.assertEqual(c.queue,None)
+			announce = framing.announceRing(c.ring.path)
+			self.assertEqual(self.read(c.peer,len(announce)),announce)
+			server = RingBuffer(c.ring.path)
+			for index in range(10):
+				c.send('packet%02d' % index)
+			self.assertEqual(c.dropped,5)
+			self.assertEqual(server.getAll(),['packet%02d' % index for index in range(5)])
+			self.assertRaises(ClientException,lambda: c.send('x'*61))
+			# a sleeping server is woken up once
+			server.setSleeping(True)
+			c.send('a')
+			c.send('b')
+			self.assertEqual(server.isSleeping(),False)
+			c.peer.setblocking(0)
+			self.assertEqual(c.peer.recv(10),'\x00')
+			self.assertEqual(server.getAll(),['a','b'])
+			c.close()
+			self.assertEqual(c.writes,2)
+		finally:
+			shutil.rmtree(directory)
+
+	def test13(self):
+		"""Compressing client announces compression in its uncompressed header"""
+		class Header(object):
+			compression = None
+			def SerializeToString(self):
+				return 'header:%s' % self.compression
+		class CompressingClient(self.PairClient,Client):
+			pass
+		self.assertRaises(ClientException,lambda: CompressingClient(None,None,None,compression='zlib'))
+		c = CompressingClient(None,None,None,buffered=True,coalesce_delay=0.5,
+			coalesce_bytes=1000,framing='varint',compression='zlib')
+		c.sendHeader(Header())
+		for index in range(100):
+			c.send('repetitive message')
+		c.close()
+		wide = framing.get('varint')
+		data = self.read(c.peer,10000)
+		expected = framing.preamble(wide) + ''.join(framing.encodeFrames(wide,['header:zlib']))
+		self.assertEqual(data[:len(expected)],expected)
+		(length,flags,offset) = wide.decode(data,len(expected))
+		self.assertEqual(flags,framing.FLAG_BATCH|framing.FLAG_COMPRESSED)
+		payload = framing.Decompressor().decompress(data[offset:offset+length])
+		self.assertEqual(framing.decodeBatch(payload),['repetitive message']*100)
+		self.assertTrue(c.compressor.ratio() > 10)
+
+	def test14(self):
+		"""Flow controlled client paces or sheds packets according to its credit"""
+		class Header(object):
+			def SerializeToString(self):
+				return 'header:%d:%d' % (self.credit_frames,self.credit_bytes)
+		class FlowClient(self.PairClient,Client):
+			pass
+		c = FlowClient(None,None,None,overflow=BoundedQueue.DROP_NEWEST,
+			flow_control=True,credit_frames=3,credit_bytes=0)
+		c.sendHeader(Header())
+		for index in range(5):
+			c.send('%d' % index)
+		self.assertEqual((c.flow.throttled,c.flow.shed),(2,2))
+		expected = ''.join(framing.encodeFrames(framing.legacy,['header:3:0','0','1','2']))
+		self.assertEqual(self.read(c.peer,len(expected)),expected)
+		# a blocking client waits for the server to grant more credit
+		c.flow.overflow = BoundedQueue.BLOCK
+		def grant():
+			time.sleep(0.1)
+			c.peer.sendall(framing.encodeControl(framing.CONTROL_CREDIT,framing.credit.pack(2,0)))
+		t = threading.Thread(target=grant)
+		t.start()
+		c.send('5')
+		t.join()
+		self.assertEqual((c.flow.throttled,c.flow.grants,c.flow.frames),(3,1,1))
+		self.assertTrue(c.flow.throttleTime > 0.05)
+		self.assertEqual(self.read(c.peer,3),''.join(framing.encodeFrames(framing.legacy,['5'])))
+		# byte credit can be overdrawn by one packet
+		flow = FlowControl(3,10)
+		flow.nbytes = 1
+		self.assertEqual(flow.allowance(['abc','d']),1)
+		c.close()
+
+	def test15(self):
+		"""Spooling client stores packets until its server is reachable"""
+		import shutil
+		class Header(object):
+			def SerializeToString(self):
+				return 'header'
+		class SpoolingClient(self.PairClient,Client):
+			down = True
+			def connect(self):
+				if self.down:
+					raise socket.error('server is down')
+				return ClientTests.PairClient.connect(self)
+		directory = tempfile.mkdtemp()
+		try:
+			c = SpoolingClient(None,None,None,spool_dir=directory,spool_retry=0)
+			self.assertEqual(c.socket,None)
+			c.sendHeader(Header())
+			for packet in ('a','b','c'):
+				c.send(packet)
+			self.assertEqual(len(c.spool),3)
+			# the header is resent and the spool replayed when the server returns
+			c.down = False
+			c.send('d')
+			expected = ''.join(framing.encodeFrames(framing.legacy,['header','a','b','c','d']))
+			self.assertEqual(self.read(c.peer,len(expected)),expected)
+			self.assertEqual((len(c.spool),c.spool.replayed,c.writes),(0,3,3))
+			# packets are spooled again if the server goes away
+			c.peer.close()
+			c.down = True
+			c.send('e')
+			self.assertEqual((c.socket,len(c.spool)),(None,1))
+			c.close()
+		finally:
+			shutil.rmtree(directory)
+
+	def test16(self):
+		"""Bounded queue tracks its depth and waits for items to be handled"""
+		q = BoundedQueue(3,BoundedQueue.DROP_OLDEST)
+		for item in range(5):
+			q.put(item)
+		self.assertEqual((q.maxDepth,q.unfinished),(3,3))
+		self.assertEqual(q.join(0.05),False)
+		handled = [ ]
+		def write(items):
+			time.sleep(0.05)
+			handled.extend(items)
+			return True
+		flusher = Flusher(q,write)
+		self.assertEqual(q.join(5),True)
+		self.assertEqual(handled,[2,3,4])
+		q.close()
+		flusher.join()
+
+	def test17(self):
+		"""Control reader dispatches frames and grants credit to a waiting sender"""
+		(a,b) = socket.socketpair()
+		flow = FlowControl(1)
+		received = [ ]
+		handlers = dict(flow.handlers)
+		handlers['L'] = received.append
+		reader = ControlReader(a,handlers,flow)
+		sent = [ ]
+		def write(chunk):
+			sent.extend(chunk)
+			a.sendall(''.join(chunk))
+		def grant():
+			time.sleep(0.1)
+			b.sendall(framing.encodeControl('L','levels') +
+				framing.encodeControl(framing.CONTROL_CREDIT,framing.credit.pack(1,0)))
+		t = threading.Thread(target=grant)
+		t.start()
+		flow.pace(a,['x','y'],write)
+		t.join()
+		self.assertEqual((sent,received,flow.grants,flow.throttled),(['x','y'],['levels'],1,1))
+		self.assertEqual(self.read(b,2),'xy')
+		# a sender waiting for credit fails once the connection is closed
+		b.close()
+		reader.join(5)
+		self.assertEqual(reader.alive,False)
+		self.assertRaises(socket.error,lambda: flow.pace(a,['z'],write))
+		a.close()
+
+	def test18(self):
+		"""A failed write stops the flusher, closes the queue and loses what was left"""
+		class BufferedClient(self.PairClient,Client):
+			pass
+		c = BufferedClient(None,None,None,buffered=True,maxqueue=10,overflow=BoundedQueue.BLOCK)
+		c.peer.close()
+		c.socket.close()
+		for index in range(10):
+			try:
+				c.send('packet')
+			except ClientException:
+				break
+		c.flusher.join(5)
+		self.assertEqual((c.flusher.isAlive(),c.queue.closed),(False,True))
+		self.assertRaises(ClientException,lambda: c.send('late'))
+		self.assertEqual(c.lost,c.queue.queued)
+		c.close()
+
+	def test19(self):
+		"""Closing a client that is waiting for credit does not hang"""
+		class Header(object):
+			def SerializeToString(self):
+				return 'header'
+		class FlowClient(self.PairClient,Client):
+			closeTimeout = 0.1
+		c = FlowClient(None,None,None,framing='varint',buffered=True,
+			flow_control=True,credit_frames=1,overflow=BoundedQueue.BLOCK)
+		c.sendHeader(Header())
+		c.send('first')
+		data = ''
+		while not data.endswith('first'):
+			data += c.peer.recv(100)
+		c.send('second')
+		start = time.time()
+		c.close()
+		self.assertTrue(time.time() - start < 1.0)
+		self.assertEqual((c.flusher.isAlive(),c.lost),(False,1))
+		c.peer.close()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,497 @@
+"""
+Length-prefixed framing for the simple client-server protocol
+
+Clients send a stream of binary frames, each prefixed with its length.
+The original protocol uses an unsigned 16-bit prefix, which limits
+frames to 65535 bytes. A client can instead negotiate a wider prefix by
+starting its stream with a handshake preamble: an empty 16-bit frame
+(two zero bytes) followed by a single byte that identifies the framing
+to use for the rest of the stream, including the header. Legacy clients
+never send an empty first frame since every header carries a name, so a
+server can always tell the two apart.
+
+Wide framings reserve two flag bits in each prefix. The BATCH flag marks
+a frame whose payload is a container for several messages: a varint
+message count followed by each message with its own varint length.
+
+The COMPRESSED flag marks a frame whose payload is the next part of a
+compressed stream that spans the whole connection, flushed at the end
+of each frame, so that later frames benefit from the repetition in
+earlier ones. The decompressed payload is a batch container if the
+BATCH flag is also set, or else a single message. A client announces
+compression in its header, which is never compressed.
+
+A server can also send control frames back to its client on the same
+connection. Each has a 16-bit length prefix followed by a one-byte
+opcode and its payload. A CREDIT control grants the client permission
+to send more messages and bytes, as two unsigned 32-bit integers, to a
+client that asked for flow control in its header. A LEVELS control
+tells a client that asked for them the lowest level of log record that
+the server wants from each of its sources. An EXCEPTION control
+acknowledges the digest of an exception traceback, which the client can
+then send instead of the traceback on the same connection.
+
+A client on the same host as its server can instead announce a shared
+memory ring with the SHARED_MEMORY code, followed by the varint length
+of the ring's path and the path itself. All frames, including the
+header, are then written to the ring and any further bytes on the
+socket only wake up the server. See tops.core.network.shmring.
+
+A process can instead carry the streams of several clients over one
+connection by starting it with the MULTIPLEXED code. Each later channel
+frame has the varint id of a client's channel and the varint length of
+its payload. The first frame of each channel names the service that it
+is for, the following frames carry pieces of an ordinary stream for
+that service, and an empty frame closes the channel. A server sends its
+control frames back in channel frames of the same form. See
+tops.core.network.mux.
+"""
+
+## @package tops.core.network.framing
+# Length-prefixed framing for the simple client-server protocol
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import struct
+import time
+import zlib
+
+class FramingException(Exception):
+	pass
+
+# flag bits that wide framings carry in each length prefix
+FLAG_BATCH = 0x1
+FLAG_COMPRESSED = 0x2
+FLAG_MASK = 0x3
+
+# the handshake codes that announce a shared memory ring and channels
+SHARED_MEMORY = 0x3
+MULTIPLEXED = 0x4
+
+# the opcodes of control frames sent from a server to its client
+CONTROL_CREDIT = 'C'
+credit = struct.Struct('!II')
+CONTROL_LEVELS = 'L'
+CONTROL_EXCEPTION = 'E'
+
+def encodeVarint(value):
+	"""
+	Returns the unsigned varint encoding of a non-negative integer.
+
+	Uses the same little-endian base-128 encoding as protocol buffers.
+	"""
+	pieces = [ ]
+	while value > 0x7f:
+		pieces.append(chr(0x80 | (value & 0x7f)))
+		value >>= 7
+	pieces.append(chr(value))
+	return ''.join(pieces)
+
+def decodeVarint(data,offset=0):
+	"""
+	Decodes an unsigned varint starting at offset in data.
+
+	The data can be a string or a bytearray. Returns a tuple
+	(value,next_offset) or None if data ends before the varint is
+	complete.
+	"""
+	value = 0
+	shift = 0
+	end = len(data)
+	isString = isinstance(data,str)
+	while offset < end:
+		byte = ord(data[offset]) if isString else data[offset]
+		offset += 1
+		value |= (byte & 0x7f) << shift
+		if not byte & 0x80:
+			return (value,offset)
+		shift += 7
+		if shift > 63:
+			raise FramingException('varint is too long')
+	return None
+
+
+class Int16Framing(object):
+	"""
+	The original framing with an unsigned 16-bit prefix and no flags.
+	"""
+	name = 'int16'
+	code = None
+	maxLength = 0xffff
+	packer = struct.Struct('!H')
+	# fixed-size prefixes are unpacked to maxLength bits of length and the remaining bits of flags
+	prefixLength = 2
+	flagShift = 16
+
+	def encode(self,length,flags=0):
+		if length > self.maxLength:
+			raise FramingException('frame of %d bytes is too long for %s framing' % (length,self.name))
+		if flags:
+			raise FramingException('%s framing does not support flags' % self.name)
+		return self.packer.pack(length)
+
+	def decode(self,data,offset=0):
+		"""
+		Decodes the prefix starting at offset in data.
+
+		The data can be a string or a bytearray and is not copied.
+		Returns a tuple (length,flags,payload_offset) or None if data
+		ends before the prefix is complete.
+		"""
+		if len(data) < offset + 2:
+			return None
+		(length,) = self.packer.unpack_from(data,offset)
+		return (length,0,offset+2)
+
+class Int32Framing(Int16Framing):
+	"""
+	An unsigned 32-bit prefix whose two most significant bits are flags.
+	"""
+	name = 'int32'
+	code = 1
+	maxLength = (1 << 30) - 1
+	packer = struct.Struct('!I')
+	prefixLength = 4
+	flagShift = 30
+
+	def encode(self,length,flags=0):
+		if length > self.maxLength:
+			raise FramingException('frame of %d bytes is too long for %s framing' % (length,self.name))
+		return self.packer.pack(length | (flags << 30))
+
+	def decode(self,data,offset=0):
+		if len(data) < offset + 4:
+			return None
+		(word,) = self.packer.unpack_from(data,offset)
+		return (word & self.maxLength,word >> 30,offset+4)
+
+class VarintFraming(Int16Framing):
+	"""
+	A varint prefix whose two least significant bits are flags.
+
+	Small frames only need a one or two byte prefix.
+	"""
+	name = 'varint'
+	code = 2
+	maxLength = (1 << 62) - 1
+	prefixLength = None
+
+	def encode(self,length,flags=0):
+		return encodeVarint((length << 2) | flags)
+
+	def decode(self,data,offset=0):
+		decoded = decodeVarint(data,offset)
+		if decoded is None:
+			return None
+		(word,offset) = decoded
+		return (word >> 2,word & FLAG_MASK,offset)
+
+
+legacy = Int16Framing()
+framings = dict([(f.name,f) for f in (legacy,Int32Framing(),VarintFraming())])
+codes = dict([(f.code,f) for f in framings.itervalues() if f.code is not None])
+
+def get(name):
+	"""
+	Returns the framing with the specified name.
+	"""
+	try:
+		return framings[name]
+	except KeyError:
+		raise FramingException('unknown framing "%s"' % name)
+
+def preamble(framing):
+	"""
+	Returns the handshake preamble that a client sends to select a framing.
+
+	The preamble is empty for the legacy framing.
+	"""
+	if framing.code is None:
+		return ''
+	return legacy.encode(0) + chr(framing.code)
+
+def announceRing(path):
+	"""
+	Returns the handshake preamble that a client sends to announce a ring.
+	"""
+	return legacy.encode(0) + chr(SHARED_MEMORY) + encodeVarint(len(path)) + path
+
+def announceMultiplexed():
+	"""
+	Returns the handshake preamble that starts a multiplexed connection.
+	"""
+	return legacy.encode(0) + chr(MULTIPLEXED)
+
+def encodeChannel(channel,length):
+	"""
+	Returns the prefix of a channel frame with a payload of length bytes.
+	"""
+	return encodeVarint(channel) + encodeVarint(length)
+
+def decodeChannel(data,offset=0):
+	"""
+	Decodes the prefix of a channel frame starting at offset in data.
+
+	Returns a tuple (channel,length,payload_offset) or None if data
+	ends before the prefix is complete.
+	"""
+	decoded = decodeVarint(data,offset)
+	if decoded is None:
+		return None
+	(channel,offset) = decoded
+	decoded = decodeVarint(data,offset)
+	if decoded is None:
+		return None
+	return (channel,) + decoded
+
+class Compressor(object):
+	"""
+	Compresses the frames sent on one connection.
+
+	Keeps track of the bytes passed to compress(), the bytes it
+	returned, and the processor time it used, over the lifetime of the
+	compressor. A new stream is started by reset() on each connection.
+	"""
+	names = ('zlib',)
+
+	def __init__(self,name='zlib',level=6):
+		if name not in self.names:
+			raise FramingException('unknown compression "%s"' % name)
+		self.name = name
+		self.level = level
+		self.rawBytes = 0
+		self.compressedBytes = 0
+		self.cpuTime = 0
+		self.reset()
+
+	def reset(self):
+		self.stream = zlib.compressobj(self.level)
+
+	def compress(self,data):
+		start = time.clock()
+		compressed = self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+		self.cpuTime += time.clock() - start
+		self.rawBytes += len(data)
+		self.compressedBytes += len(compressed)
+		return compressed
+
+	def ratio(self):
+		"""
+		Returns the ratio of uncompressed to compressed bytes so far.
+		"""
+		if not self.compressedBytes:
+			return 1.0
+		return float(self.rawBytes)/self.compressedBytes
+
+	def report(self):
+		return ('%s compression of %d bytes to %d (ratio %.1f) used %.3fs of CPU' %
+			(self.name,self.rawBytes,self.compressedBytes,self.ratio(),self.cpuTime))
+
+class Decompressor(Compressor):
+	"""
+	Decompresses the frames received on one connection.
+
+	A frame that decompresses to more than limit bytes raises a
+	FramingException as soon as the limit is passed, so a small frame
+	cannot expand without bound.
+	"""
+	def reset(self):
+		self.stream = zlib.decompressobj()
+
+	def decompress(self,data,limit=64*1024*1024):
+		start = time.clock()
+		try:
+			raw = self.stream.decompress(data,limit + 1)
+		except zlib.error,e:
+			raise FramingException('unable to decompress frame: %s' % e)
+		if len(raw) > limit or self.stream.unconsumed_tail:
+			raise FramingException('frame decompresses to more than %d bytes' % limit)
+		self.cpuTime += time.clock() - start
+		self.rawBytes += len(raw)
+		self.compressedBytes += len(data)
+		return raw
+
+def encodeControl(opcode,payload=''):
+	"""
+	Returns a control frame for a server to send to its client.
+	"""
+	return legacy.encode(1 + len(payload)) + opcode + payload
+
+def decodeControls(data):
+	"""
+	Decodes the complete control frames at the start of a string.
+
+	Returns a tuple (controls,remaining) where controls is a list of
+	(opcode,payload) tuples and remaining is any incomplete data.
+	"""
+	controls = [ ]
+	offset = 0
+	while True:
+		prefix = legacy.decode(data,offset)
+		if prefix is None:
+			break
+		(length,flags,start) = prefix
+		if start + length > len(data):
+			break
+		if length == 0:
+			raise FramingException('empty control frame')
+		controls.append((data[start],data[start+1:start+length]))
+		offset = start + length
+	return (controls,data[offset:])
+
+def encodeFrames(framing,messages,batch=False,compressor=None):
+	"""
+	Returns a list of pieces that frame each message for transmission.
+
+	If batch is True, all messages are framed in a single batch
+	container. The pieces reference the original message strings so
+	that they can be written without further copying. If a compressor
+	is provided, all messages are compressed into a single frame,
+	using a batch container if there is more than one.
+	"""
+	if compressor is not None:
+		if len(messages) > 1:
+			# compress the batch container without its prefix
+			pieces = encodeFrames(framing,messages,True)
+			payload = compressor.compress(''.join(pieces[1:]))
+			flags = FLAG_BATCH | FLAG_COMPRESSED
+		else:
+			payload = compressor.compress(messages[0])
+			flags = FLAG_COMPRESSED
+		return [framing.encode(len(payload),flags),payload]
+	pieces = [ ]
+	if batch and len(messages) > 1:
+		count = encodeVarint(len(messages))
+		pieces.append(None)
+		pieces.append(count)
+		length = len(count)
+		for data in messages:
+			prefix = encodeVarint(len(data))
+			pieces.append(prefix)
+			pieces.append(data)
+			length += len(prefix) + len(data)
+		pieces[0] = framing.encode(length,FLAG_BATCH)
+	else:
+		encode = framing.encode
+		for data in messages:
+			pieces.append(encode(len(data)))
+			pieces.append(data)
+	return pieces
+
+def splitBatch(data,start,end):
+	"""
+	Locates the messages in a batch container without copying them.
+
+	The container occupies data[start:end], where data can be a string
+	or a bytearray. Returns a list of (offset,length) tuples for each
+	message.
+	"""
+	decoded = decodeVarint(data,start)
+	if decoded is None or decoded[1] > end:
+		raise FramingException('truncated batch count')
+	(count,offset) = decoded
+	spans = [ ]
+	for index in xrange(count):
+		decoded = decodeVarint(data,offset)
+		if decoded is None or decoded[1] > end:
+			raise FramingException('truncated batch message length')
+		(length,offset) = decoded
+		if offset + length > end:
+			raise FramingException('truncated batch message')
+		spans.append((offset,length))
+		offset += length
+	if offset != end:
+		raise FramingException('unexpected data after batch')
+	return spans
+
+def decodeBatch(payload):
+	"""
+	Returns the list of messages packed in a batch container.
+	"""
+	return [payload[offset:offset+length]
+		for (offset,length) in splitBatch(payload,0,len(payload))]
+
+
+import unittest
+
+class FramingTests(unittest.TestCase):
+	def test00(self):
+		"""Varint encoding round trips"""
+		for value in (0,1,127,128,300,65535,1<<32,(1<<62)-1):
+			encoded = encodeVarint(value)
+			self.assertEqual(decodeVarint(encoded),(value,len(encoded)))
+			self.assertEqual(decodeVarint(encoded[:-1]),None)
+		self.assertEqual(encodeVarint(300),'\xac\x02')
+	def test01(self):
+		"""Prefixes round trip with their flags"""
+		for framing in framings.itervalues():
+			flags = (0,) if framing is legacy else (0,FLAG_BATCH)
+			for length in (0,1,200,65535):
+				for flag in flags:
+					prefix = framing.encode(length,flag)
+					self.assertEqual(framing.decode('xx' + prefix,2),(length,flag,2+len(prefix)))
+					self.assertEqual(framing.decode(prefix[:-1]),None)
+	def test02(self):
+		"""Legacy framing rejects long frames and flags"""
+		self.assertRaises(FramingException,lambda: legacy.encode(65536))
+		self.assertRaises(FramingException,lambda: legacy.encode(10,FLAG_BATCH))
+		self.assertEqual(get('int32').decode(get('int32').encode(1<<20)),(1<<20,0,4))
+	def test03(self):
+		"""Batch containers round trip"""
+		messages = ['','a','b'*1000,'c'*70000]
+		pieces = encodeFrames(get('varint'),messages,batch=True)
+		data = ''.join(pieces)
+		(length,flags,offset) = get('varint').decode(data)
+		self.assertEqual(flags,FLAG_BATCH)
+		self.assertEqual(offset+length,len(data))
+		self.assertEqual(decodeBatch(data[offset:]),messages)
+		self.assertRaises(FramingException,lambda: decodeBatch(data[offset:-1]))
+		buf = bytearray('xyz' + data)
+		spans = splitBatch(buf,3+offset,len(buf))
+		self.assertEqual([str(buf[start:start+size]) for (start,size) in spans],messages)
+		self.assertEqual(get('varint').decode(buf,3),(length,flags,3+offset))
+	def test04(self):
+		"""Handshake preambles"""
+		self.assertEqual(preamble(legacy),'')
+		self.assertEqual(preamble(get('int32')),'\x00\x00\x01')
+		self.assertEqual(codes[2].name,'varint')
+		self.assertRaises(FramingException,lambda: get('int64'))
+		self.assertEqual(announceRing('/tmp/r'),'\x00\x00\x03\x06/tmp/r')
+		self.assertEqual(SHARED_MEMORY in codes,False)
+	def test06(self):
+		"""Control frames round trip"""
+		data = encodeControl(CONTROL_CREDIT,credit.pack(10,1000)) + encodeControl('X')
+		self.assertEqual(decodeControls(data),([('C',credit.pack(10,1000)),('X','')],''))
+		self.assertEqual(decodeControls(data[:-1]),([('C',credit.pack(10,1000))],data[11:-1]))
+
+	def test05(self):
+		"""Compressed frames share one stream per connection"""
+		wide = get('int32')
+		compressor = Compressor()
+		decompressor = Decompressor()
+		messages = ['source.name.%d' % index for index in range(50)]
+		for chunk in (messages[:1],messages[1:25],messages[25:]):
+			data = ''.join(encodeFrames(wide,chunk,compressor=compressor))
+			(length,flags,offset) = wide.decode(data)
+			self.assertEqual(offset+length,len(data))
+			self.assertEqual(flags & FLAG_COMPRESSED,FLAG_COMPRESSED)
+			payload = decompressor.decompress(data[offset:])
+			if flags & FLAG_BATCH:
+				self.assertEqual(decodeBatch(payload),chunk)
+			else:
+				self.assertEqual([payload],chunk)
+		self.assertEqual(decompressor.rawBytes,compressor.rawBytes)
+		self.assertEqual(decompressor.compressedBytes,compressor.compressedBytes)
+		self.assertTrue(compressor.ratio() > 3)
+		self.assertRaises(FramingException,lambda: Compressor('lzma'))
+		self.assertRaises(FramingException,lambda: Decompressor().decompress('junk'))
+		# frames that expand past the limit are refused
+		bomb = Compressor().compress('x'*100000)
+		self.assertEqual(len(Decompressor().decompress(bomb,100000)),100000)
+		self.assertRaises(FramingException,lambda: Decompressor().decompress(bomb,1000))
+
+if __name__ == '__main__':
+	unittest.main()
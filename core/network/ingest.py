@@ -0,0 +1,356 @@
+"""
+Multi-process ingest for simple telescope operations network servers
+
+Spreads the work of decoding producer frames over several worker
+processes. The coordinating process starts each worker as a copy of
+itself, with the --worker option, and listens for their connections on
+a UNIX socket. A private data key read with the --readkey option is
+passed on to each worker through a pipe to its stdin. Every worker
+listens on the server's TCP port with SO_REUSEPORT, so that the kernel
+balances new producer connections between them, and decodes each frame
+with the server's own protocol. Instead of updating any shared state,
+a worker forwards a compact summary of each header and message to the
+coordinator, marshalled in one batch per reactor iteration. The
+coordinator owns all of the state that consumers see, serves HTTP, and
+continues to accept producers on its own UNIX socket.
+
+The summaries are produced and applied by the summarizeHeader(),
+applyHeader(), summarizeMessage() and applyMessage() methods of
+tops.core.network.server.Server. Subclasses override these so that as
+much work as possible happens in the workers.
+"""
+
+## @package tops.core.network.ingest
+# Multi-process ingest for simple telescope operations network servers
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import sys
+import os
+import socket
+import struct
+import marshal
+import subprocess
+
+import twisted.internet.protocol
+import twisted.internet.tcp
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+from twisted.protocols.basic import Int32StringReceiver
+
+# the kinds of item that a worker forwards for each producer connection
+HEADER = 0
+MESSAGE = 1
+CLOSED = 2
+
+class IngestException(Exception):
+	pass
+
+def reusePortOption():
+	"""
+	Returns the SO_REUSEPORT socket option for this platform.
+	"""
+	try:
+		return socket.SO_REUSEPORT
+	except AttributeError:
+		# older pythons do not define this constant, which is 15 on linux
+		if sys.platform.startswith('linux'):
+			return 15
+		raise IngestException('SO_REUSEPORT is not available on %s' % sys.platform)
+
+class ReusePort(twisted.internet.tcp.Port):
+	"""
+	A listening TCP port that other processes can also listen on.
+	"""
+	def createInternetSocket(self):
+		s = twisted.internet.tcp.Port.createInternetSocket(self)
+		s.setsockopt(socket.SOL_SOCKET,reusePortOption(),1)
+		return s
+
+
+class ForwardingConnection(twisted.internet.protocol.Protocol):
+	def connectionMade(self):
+		self.transport.registerProducer(self.factory,True)
+		# send anything that was received while we were connecting
+		self.factory.flush()
+
+@implementer(IPushProducer)
+class Forwarder(twisted.internet.protocol.ClientFactory):
+	"""
+	Forwards summaries from a worker to its coordinator.
+
+	Items are collected until the end of the current reactor iteration
+	and then written as a single marshalled batch. The worker stops if
+	its connection to the coordinator is lost. We are paused by our
+	connection while the coordinator is not keeping up with our batches,
+	and a worker's producers are then overloaded.
+	"""
+	protocol = ForwardingConnection
+
+	def __init__(self):
+		self.pending = [ ]
+		self.connection = None
+		self.scheduled = False
+		self.paused = False
+		self.keys = 0
+
+	def pauseProducing(self):
+		self.paused = True
+
+	def resumeProducing(self):
+		self.paused = False
+
+	def stopProducing(self):
+		pass
+
+	def overloaded(self):
+		return self.paused
+
+	def newKey(self):
+		"""
+		Returns a key that identifies one producer connection to the coordinator.
+		"""
+		self.keys += 1
+		return self.keys
+
+	def buildProtocol(self,addr):
+		self.connection = twisted.internet.protocol.ClientFactory.buildProtocol(self,addr)
+		return self.connection
+
+	def startedConnecting(self,connector):
+		print 'Connecting to ingest coordinator'
+
+	def clientConnectionFailed(self,connector,reason):
+		print 'Unable to reach ingest coordinator:',reason.getErrorMessage()
+		self.stop()
+
+	def clientConnectionLost(self,connector,reason):
+		print 'Lost ingest coordinator:',reason.getErrorMessage()
+		self.stop()
+
+	def stop(self):
+		from twisted.internet import reactor
+		# let any shutdown that is already pending go first
+		reactor.callLater(0,self.stopReactor)
+
+	def stopReactor(self):
+		from twisted.internet import reactor
+		from twisted.internet.error import ReactorNotRunning
+		try:
+			reactor.stop()
+		except ReactorNotRunning:
+			pass
+
+	def forward(self,key,kind,summary):
+		self.pending.append((key,kind,summary))
+		if not self.scheduled:
+			from twisted.internet import reactor
+			self.scheduled = True
+			reactor.callLater(0,self.flush)
+
+	def flush(self):
+		self.scheduled = False
+		if self.connection is None or self.connection.transport is None or not self.pending:
+			return
+		payload = marshal.dumps(self.pending)
+		self.pending = [ ]
+		self.connection.transport.write(struct.pack('!I',len(payload)) + payload)
+
+def forwarding(cls):
+	"""
+	Returns a variant of a Server subclass that forwards summaries.
+
+	The factory of each connection must have a forwarder attribute.
+	"""
+	class ForwardingServer(cls):
+		def connectionMade(self):
+			cls.connectionMade(self)
+			self.key = self.factory.forwarder.newKey()
+		def connectionLost(self,reason):
+			cls.connectionLost(self,reason)
+			self.factory.forwarder.forward(self.key,CLOSED,None)
+		def handleHeader(self,hdr):
+			self.factory.forwarder.forward(self.key,HEADER,self.summarizeHeader(hdr))
+		def handleMessage(self,msg):
+			self.factory.forwarder.forward(self.key,MESSAGE,self.summarizeMessage(msg))
+	return ForwardingServer
+
+
+class Collector(Int32StringReceiver):
+	"""
+	Applies the summaries forwarded by one worker in the coordinator.
+
+	Each producer connection handled by the worker is represented by an
+	unconnected instance of the server protocol built by our service
+	factory.
+	"""
+	MAX_LENGTH = 256*1024*1024
+
+	def connectionMade(self):
+		self.sessions = { }
+		print 'Ingest worker connected'
+
+	def connectionLost(self,reason):
+		print 'Ingest worker disconnected with %d open sessions' % len(self.sessions)
+		self.sessions.clear()
+
+	def stringReceived(self,data):
+		sessions = self.sessions
+		for (key,kind,summary) in marshal.loads(data):
+			if kind == MESSAGE:
+				session = sessions.get(key)
+				if session is not None:
+					session.applyMessage(summary)
+			elif kind == HEADER:
+				session = self.factory.service.buildProtocol(None)
+				session.applyHeader(summary)
+				sessions[key] = session
+			elif kind == CLOSED:
+				sessions.pop(key,None)
+
+def coordinatorPath(section):
+	import tops.core.utility.config as config
+	return config.getfilename(section,'unix_addr') + '.ingest'
+
+def startCoordinator(section,factory,count):
+	"""
+	Starts count workers that share our TCP port and collects their summaries.
+
+	The factory builds the service's normal server protocol and holds
+	the state that its summaries are applied to. Workers are stopped
+	when our reactor shuts down.
+	"""
+	from twisted.internet import reactor
+	import tops.core.utility.options as options
+	path = coordinatorPath(section)
+	if os.path.exists(path):
+		os.unlink(path)
+	collectors = twisted.internet.protocol.Factory()
+	collectors.protocol = Collector
+	collectors.service = factory
+	reactor.listenUNIX(path,collectors)
+	# start each worker as a copy of ourself
+	args = [sys.executable,os.path.abspath(sys.argv[0])] + sys.argv[1:]
+	key = options.get('key') if options.get('readkey') else None
+	workers = [ ]
+	for index in range(count):
+		if key is None:
+			process = subprocess.Popen(args + ['--worker',str(index)],shell=False)
+		else:
+			# a worker reads our key from stdin just as we did
+			process = subprocess.Popen(args + ['--worker',str(index)],shell=False,stdin=subprocess.PIPE)
+			process.stdin.write(key + '\n')
+			process.stdin.close()
+		print 'Started ingest worker %d as PID %d' % (index,process.pid)
+		workers.append(process)
+	def stopWorkers():
+		for process in workers:
+			if process.poll() is None:
+				process.terminate()
+	reactor.addSystemEventTrigger('before','shutdown',stopWorkers)
+	return workers
+
+def startWorker(section,factory,index):
+	"""
+	Starts listening for producers on our shared TCP port.
+
+	The factory's protocol is replaced with a variant that forwards
+	summaries to our coordinator.
+	"""
+	from twisted.internet import reactor
+	import tops.core.utility.config as config
+	factory.protocol = forwarding(factory.protocol)
+	factory.forwarder = Forwarder()
+	factory.overloaded = factory.forwarder.overloaded
+	reactor.connectUNIX(coordinatorPath(section),factory.forwarder)
+	port = ReusePort(config.getint(section,'tcp_port'),factory,reactor=reactor)
+	port.startListening()
+	print 'Ingest worker %d listening on port %d' % (index,config.getint(section,'tcp_port'))
+	return port
+
+
+import unittest
+
+class IngestTests(unittest.TestCase):
+
+	class Header(object):
+		def ParseFromString(self,raw):
+			self.name = raw
+		def SerializeToString(self):
+			return self.name
+
+	def server(self):
+		from tops.core.network.server import Server
+		class RecordingServer(Server):
+			Header = Message = IngestTests.Header
+			def handleHeader(self,hdr):
+				self.factory.received.append(('header',hdr.name))
+			def handleMessage(self,msg):
+				self.factory.received.append((self.hdr.name,msg.name))
+		return RecordingServer
+
+	def test00(self):
+		"""Listening sockets allow the port to be reused"""
+		port = ReusePort(0,twisted.internet.protocol.Factory())
+		s = port.createInternetSocket()
+		self.assertNotEqual(s.getsockopt(socket.SOL_SOCKET,reusePortOption()),0)
+		s.close()
+
+	def test01(self):
+		"""Worker summaries are applied in the coordinator"""
+		from twisted.test.proto_helpers import StringTransport
+		from twisted.python.failure import Failure
+		from twisted.internet.error import ConnectionDone
+		from tops.core.network import framing
+		# a worker that decodes two producers
+		factory = twisted.internet.protocol.Factory()
+		factory.protocol = forwarding(self.server())
+		factory.forwarder = Forwarder()
+		factory.forwarder.scheduled = True
+		producers = [ ]
+		for name in ('a','b'):
+			producer = factory.buildProtocol(None)
+			producer.makeConnection(StringTransport())
+			producer.dataReceived(''.join(framing.encodeFrames(framing.legacy,[name,'1','2'])))
+			producers.append(producer)
+		producers[0].connectionLost(Failure(ConnectionDone()))
+		self.assertEqual(len(factory.forwarder.pending),7)
+		connection = ForwardingConnection()
+		connection.factory = factory.forwarder
+		factory.forwarder.connection = connection
+		connection.makeConnection(StringTransport())
+		self.assertEqual(factory.forwarder.pending,[])
+		# the coordinator applies the forwarded batch to its own sessions
+		service = twisted.internet.protocol.Factory()
+		service.protocol = self.server()
+		service.received = [ ]
+		collectors = twisted.internet.protocol.Factory()
+		collectors.protocol = Collector
+		collectors.service = service
+		collector = collectors.buildProtocol(None)
+		collector.makeConnection(StringTransport())
+		collector.dataReceived(connection.transport.value())
+		self.assertEqual(service.received,[('header','a'),('a','1'),('a','2'),
+			('header','b'),('b','1'),('b','2')])
+		self.assertEqual(collector.sessions.keys(),[producers[1].key])
+
+	def test02(self):
+		"""A worker is overloaded while its coordinator link is backed up"""
+		from twisted.test.proto_helpers import StringTransport
+		factory = twisted.internet.protocol.Factory()
+		factory.forwarder = Forwarder()
+		factory.overloaded = factory.forwarder.overloaded
+		connection = ForwardingConnection()
+		connection.factory = factory.forwarder
+		connection.makeConnection(StringTransport())
+		self.assertEqual(factory.overloaded(),False)
+		connection.transport.producer.pauseProducing()
+		self.assertEqual(factory.overloaded(),True)
+		connection.transport.producer.resumeProducing()
+		self.assertEqual(factory.overloaded(),False)
+
+if __name__ == '__main__':
+	unittest.main()
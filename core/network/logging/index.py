@@ -0,0 +1,192 @@
+"""
+Full-text index of log records
+
+The logging server can index the words in the body and exception of
+every record in its feed buffer, so that records mentioning an exposure
+id or an exception class can be found without reading every record. The
+index maps each word to the sequence numbers of the records containing
+it, in the order they were added, and forgets them as records leave the
+feed buffer.
+
+A query is a list of words that must all appear in a record, and any
+number of these lists can be combined with OR. Words are compared
+without regard to case, and a query word containing punctuation, like
+a dotted class name, requires each of its parts.
+"""
+
+## @package tops.core.network.logging.index
+# Full-text index of log records
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import re
+
+from array import array
+from bisect import bisect_left
+
+# the characters that make up an indexed word
+wordPattern = re.compile(r'\w+',re.UNICODE)
+
+# longer words are indexed by their beginning
+maxWordLength = 64
+
+def words(text):
+	"""
+	Returns the set of distinct lower-case words in text.
+	"""
+	return set(word[:maxWordLength] for word in wordPattern.findall(text.lower()))
+
+def contains(postings,seq):
+	index = bisect_left(postings,seq)
+	return index < len(postings) and postings[index] == seq
+
+class TextIndex(object):
+	"""
+	Maps words to the sequence numbers of the records that contain them.
+
+	Sequence numbers below first belong to records that have expired. A
+	posting list is only trimmed of them once every sweepInterval calls
+	to expire(), so that the cost of forgetting records is shared between
+	many of them.
+	"""
+	sweepInterval = 10000
+
+	def __init__(self):
+		self.postings = { }
+		self.first = 0
+		self.expired = 0
+
+	def add(self,record):
+		"""
+		Indexes the body and exception of a record that has a sequence number.
+		"""
+		(text,exception) = record.fields()
+		if exception:
+			text += ' ' + exception
+		seq = record.seq
+		postings = self.postings
+		for word in words(text):
+			try:
+				postings[word].append(seq)
+			except KeyError:
+				postings[word] = array('L',(seq,))
+
+	def expire(self,first):
+		"""
+		Forgets the records numbered below first.
+		"""
+		self.first = first
+		self.expired += 1
+		if self.expired >= self.sweepInterval:
+			self.sweep()
+
+	def sweep(self):
+		self.expired = 0
+		first = self.first
+		for (word,postings) in self.postings.items():
+			count = bisect_left(postings,first)
+			if count == len(postings):
+				del self.postings[word]
+			elif count:
+				del postings[:count]
+
+	def parse(self,query):
+		"""
+		Returns a list of the lists of words combined by a query.
+		"""
+		groups = [ ]
+		for group in re.split(r'\s+OR\s+',query.strip()):
+			found = words(group)
+			if found:
+				groups.append(found)
+		return groups
+
+	def matching(self,group):
+		"""
+		Generates the sequence numbers of records containing every word, newest first.
+		"""
+		try:
+			lists = sorted([self.postings[word] for word in group],key=len)
+		except KeyError:
+			return
+		(shortest,others) = (lists[0],lists[1:])
+		first = self.first
+		for index in xrange(len(shortest) - 1,-1,-1):
+			seq = shortest[index]
+			if seq < first:
+				return
+			for postings in others:
+				if not contains(postings,seq):
+					break
+			else:
+				yield seq
+
+	def search(self,query):
+		"""
+		Generates the sequence numbers of records matching a query, newest first.
+		"""
+		generators = [self.matching(group) for group in self.parse(query)]
+		heads = { }
+		for generator in generators:
+			for seq in generator:
+				heads[generator] = seq
+				break
+		last = None
+		while heads:
+			(generator,seq) = max(heads.iteritems(),key=lambda item: item[1])
+			if seq != last:
+				yield seq
+				last = seq
+			for seq in generator:
+				heads[generator] = seq
+				break
+			else:
+				del heads[generator]
+
+
+import unittest
+
+class TextIndexTests(unittest.TestCase):
+	class Record(object):
+		def __init__(self,seq,body,exception=None):
+			self.seq = seq
+			self.body = body
+			self.exception = exception
+		def fields(self):
+			return (self.body,self.exception)
+	def index(self):
+		index = TextIndex()
+		for (seq,body,exception) in (
+			(0,'Exposure 1234 started',None),
+			(1,'AzStat update: axis=Az pos=12.5',None),
+			(2,'exposure 1234 aborted','Traceback: ValueError("bad shutter")'),
+			(3,'Exposure 1235 started',None),
+			(4,'AzStat fault',None)):
+			index.add(self.Record(seq,body,exception))
+		return index
+	def test00(self):
+		"""Records are found by words combined with AND and OR"""
+		index = self.index()
+		self.assertEqual(list(index.search('exposure')),[3,2,0])
+		self.assertEqual(list(index.search('EXPOSURE 1234')),[2,0])
+		self.assertEqual(list(index.search('azstat OR valueerror')),[4,2,1])
+		self.assertEqual(list(index.search('1234 started OR 1235 OR fault')),[4,3,0])
+		self.assertEqual(list(index.search('shutter OR shutter')),[2])
+		self.assertEqual(list(index.search('missing OR azstat missing')),[])
+		self.assertEqual(list(index.search('')),[])
+	def test01(self):
+		"""Expired records are forgotten"""
+		index = self.index()
+		index.sweepInterval = 2
+		index.expire(2)
+		self.assertEqual(list(index.search('exposure OR azstat')),[4,3,2])
+		self.assertTrue('update' in index.postings)
+		index.expire(3)
+		self.assertEqual('update' in index.postings,False)
+		self.assertEqual(list(index.postings['exposure']),[3])
+
+if __name__ == '__main__':
+	unittest.main()
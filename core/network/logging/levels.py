@@ -0,0 +1,143 @@
+"""
+Log levels that the logging server asks its producers to send
+
+A logging server that pushes levels tells each producer, whenever they
+change, the lowest level of record that it wants from each source, so
+that a producer can drop unwanted records before formatting or sending
+them. The levels are encoded as a list of rules, one per line:
+
+  D <level>             the level wanted from sources without a rule
+  B <level> <pattern>   the level wanted from sources matching pattern
+  W <level> <pattern>   a lower level wanted from sources matching pattern
+
+The first B rule whose ResourceNamePattern matches a source replaces the
+default D level, and any matching W rules, e.g. from the filters of
+clients watching the server's feed, can lower it.
+"""
+
+## @package tops.core.network.logging.levels
+# Log levels that the logging server asks its producers to send
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+from tops.core.network.naming import ResourceNamePattern,NamingException
+
+def encodeLevels(default,rules=(),wanted=()):
+	"""
+	Returns the payload of a levels control frame.
+
+	Rules and wanted are sequences of (pattern,level) tuples.
+	"""
+	lines = ['D %d' % default]
+	lines.extend(['B %d %s' % (level,pattern) for (pattern,level) in rules])
+	lines.extend(['W %d %s' % (level,pattern) for (pattern,level) in wanted])
+	return '\n'.join(lines)
+
+def couldMatch(pattern,prefix):
+	"""
+	Returns True if a pattern could match prefix or a name that starts with it.
+	"""
+	names = prefix.split('.')
+	for alternative in pattern.split(ResourceNamePattern.separator):
+		elements = alternative.split('.')
+		for (element,name) in zip(elements,names):
+			if element == ResourceNamePattern.wildcard:
+				return True
+			if element != name:
+				break
+		else:
+			if len(elements) >= len(names):
+				return True
+	return False
+
+class LevelThresholds(object):
+	"""
+	Decodes the levels that a server wants from the sources of one producer.
+
+	The name of each of our loggers is appended to prefix to give its
+	source, except for the root logger, whose source is prefix. Invalid
+	rules are ignored.
+	"""
+	def __init__(self,payload,prefix):
+		self.prefix = prefix
+		self.default = 0
+		self.rules = [ ]
+		self.wanted = [ ]
+		for line in payload.split('\n'):
+			fields = line.split(' ',2)
+			try:
+				level = int(fields[1])
+				if fields[0] == 'D':
+					self.default = level
+				elif fields[0] == 'B':
+					self.rules.append((ResourceNamePattern(fields[2]),level))
+				elif fields[0] == 'W':
+					self.wanted.append((ResourceNamePattern(fields[2]),level))
+			except (IndexError,ValueError,NamingException):
+				pass
+		self.thresholds = { }
+
+	def threshold(self,name):
+		"""
+		Returns the lowest level wanted from the logger with this name.
+		"""
+		try:
+			return self.thresholds[name]
+		except KeyError:
+			pass
+		source = self.prefix if name == 'root' else self.prefix + '.' + name
+		level = self.default
+		for (pattern,rule) in self.rules:
+			if pattern.matches(source):
+				level = rule
+				break
+		for (pattern,wanted) in self.wanted:
+			if wanted < level and pattern.matches(source):
+				level = wanted
+		self.thresholds[name] = level
+		return level
+
+	def lowest(self):
+		"""
+		Returns the lowest level that could be wanted from any of our sources.
+
+		This is a lower bound, since a source matching a rule might also
+		match an earlier one with a higher level.
+		"""
+		levels = [self.default]
+		for (pattern,level) in self.rules + self.wanted:
+			if couldMatch(pattern,self.prefix):
+				levels.append(level)
+		return min(levels)
+
+
+import unittest
+
+class LevelThresholdsTests(unittest.TestCase):
+	def test00(self):
+		"""Rules and watchers set the level wanted from each source"""
+		payload = encodeLevels(20,[('tcc.*',30),('*',40)],[('tcc.axis',10),('hub.*',10)])
+		levels = LevelThresholds(payload,'tcc')
+		self.assertEqual(levels.threshold('root'),40)
+		self.assertEqual(levels.threshold('listener'),30)
+		self.assertEqual(levels.threshold('axis'),10)
+		self.assertEqual(levels.lowest(),10)
+		levels = LevelThresholds(payload,'hub')
+		self.assertEqual(levels.threshold('root'),40)
+		self.assertEqual(levels.threshold('cmds'),10)
+		self.assertEqual(LevelThresholds(encodeLevels(30,[('hub.*',10)]),'mcp').lowest(),30)
+		self.assertEqual(LevelThresholds(encodeLevels(20),'mcp').threshold('x'),20)
+	def test01(self):
+		"""Patterns are checked against the sources a producer could have"""
+		self.assertEqual(couldMatch('tcc.axis','tcc'),True)
+		self.assertEqual(couldMatch('*.axis','tcc'),True)
+		self.assertEqual(couldMatch('hub,tcc','tcc'),True)
+		self.assertEqual(couldMatch('hub.*','tcc'),False)
+		self.assertEqual(couldMatch('tcc','tcc.listener'),False)
+		self.assertEqual(couldMatch('tcc.*','tcc.listener'),True)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -25,6 +25,31 @@ valid ResourceName. See record.py in this package for details.
 initialize() also sets the message level filter to DEBUG so that all
 messages are sent to the server by default. Use, for example,
 logging.setLevel(logging.ERROR) to change this.
+
+If the logger's buffered option is set, each logging call only queues
+its record, and a background thread formats, serializes and writes
+them to the server, coalescing bursts of messages into a single write.
+See tops.core.network.client for details of the options that control
+this. If the logger's shm_size
+option is set and the server is reached via its UNIX socket, messages
+are written to a shared memory ring instead. If the logger's spool
+option is set, messages are stored on disk while the server is
+unreachable and replayed when it returns.
+
+If the logger's suppress_window option is set, a message that repeats
+with the same logger, level and format string is only sent once per
+window, followed by a summary of how many times it was repeated.
+
+If the logger's push_levels option is set, the server tells us the
+lowest level that it wants from each of our sources, and changes it as
+clients start and stop watching them, so that unwanted messages are
+dropped before they are formatted or sent. The level of the root logger
+then follows the lowest level wanted from any of our sources, replacing
+the DEBUG level set by initialize().
+
+If the logger's exception_ids option is set, an exception traceback
+that the server has acknowledged is sent as a digest instead of in full
+for the rest of the connection.
 """
 
 ## @package tops.core.network.logging.producer
@@ -38,42 +63,312 @@ logging.setLevel(logging.ERROR) to change this.
 from logging import *
 from logging.handlers import SocketHandler
 
-from struct import Struct
 from traceback import format_exception
 
 import socket
+import tempfile
+import os.path
+import time
+import threading
+
+from collections import OrderedDict
 
 from logging_pb2 import Message,Header
 from tops.core.network.naming import ResourceName
+from tops.core.network.client import BoundedQueue,Flusher,FlowControl,ControlReader,ClientException,sendPieces
+from tops.core.network.shmring import RingBuffer
+from tops.core.network.spool import Spool
+import tops.core.network.mux as mux
+import tops.core.network.framing as framing
+from tops.core.network.framing import get as getFraming,Compressor
+from levels import LevelThresholds
+from traces import digest
 
-class ClientHandler(SocketHandler):
+class Suppressor(object):
+	"""
+	Suppresses log records that repeat within a window of time.
+	
+	Records are keyed on their logger name, level and format string, so
+	that a message repeats even when its arguments change. The first
+	record with each key is let through and starts a window of window
+	seconds. Later records with the same key are counted until the window
+	expires, when a summary record reports how many there were. At most
+	maxKeys keys are tracked, and the oldest window is closed early to
+	make room for a new one. The suppressed attribute counts records
+	that were held back. Only what a summary needs is kept from the
+	last record held back, and not its exception or traceback.
+	"""
+	def __init__(self,window,maxKeys=1000):
+		self.window = window
+		self.maxKeys = maxKeys
+		# windows in the order that they started: key ->
+		# [start,last,count,pathname,lineno,funcName,args] of the last record
+		self.windows = OrderedDict()
+		self.suppressed = 0
+
+	def admit(self,record):
+		"""
+		Returns True if a record should be sent, or counts it otherwise.
+		"""
+		key = (record.name,record.levelno,record.msg)
+		try:
+			state = self.windows.get(key)
+		except TypeError:
+			# an unhashable format object is never suppressed
+			return True
+		if state is not None:
+			state[1:] = [record.created,state[2] + 1,
+				record.pathname,record.lineno,record.funcName,record.args]
+			self.suppressed += 1
+			return False
+		self.windows[key] = [record.created,record.created,0,
+			record.pathname,record.lineno,record.funcName,record.args]
+		return True
 
-	_LengthPacker = Struct('!H') # 16-bit unsigned int using network byte order
+	def nextExpiry(self):
+		"""
+		Returns when our oldest window expires, or None if we have none.
+		"""
+		for state in self.windows.itervalues():
+			return state[0] + self.window
+		return None
 
-	def __init__(self,source,path,host,port):
+	def expire(self,now):
+		"""
+		Returns summary records for the windows that have expired by now.
+		
+		Also closes the oldest windows if we are tracking too many keys.
+		"""
+		summaries = [ ]
+		windows = self.windows
+		while windows:
+			(key,state) = next(windows.iteritems())
+			if now < state[0] + self.window and len(windows) < self.maxKeys:
+				break
+			del windows[key]
+			if state[2]:
+				summaries.append(self.summarize(key,state))
+		return summaries
+
+	def expireAll(self):
+		summaries = [self.summarize(key,state) for (key,state) in self.windows.iteritems() if state[2]]
+		self.windows.clear()
+		return summaries
+
+	def summarize(self,key,state):
+		"""
+		Returns a record that summarizes the repeats of one message.
+		"""
+		(name,levelno,msg) = key
+		(start,last,count,pathname,lineno,funcName,args) = state
+		record = LogRecord(name,levelno,pathname,lineno,msg,args,None,funcName)
+		try:
+			body = record.getMessage()
+		except (TypeError,ValueError):
+			body = str(msg)
+		summary = LogRecord(name,levelno,pathname,lineno,
+			'Repeated %d times between %s and %s: %s',
+			(count,self.timestamp(start),self.timestamp(last),body),None,funcName)
+		summary.created = last
+		return summary
+
+	def timestamp(self,when):
+		return time.strftime('%H:%M:%S',time.localtime(when)) + ('.%03d' % (1000*(when % 1)))
+
+class ClientHandler(SocketHandler):
+	"""
+	Sends log records to the logging server.
+	
+	When buffered is True, emit() only appends each record to a bounded
+	queue, using the same options as a buffered
+	tops.core.network.client.Client, and a Flusher thread interpolates,
+	serializes and writes them in batches. The arguments of a record
+	should therefore not be modified after it has been logged. Records
+	that cannot be delivered because the server is unreachable are
+	counted by the lost attribute, and stats() summarizes our queue.
+	flush(), which is called by logging.shutdown(), waits for every
+	queued record to be written. close() waits at most closeTimeout
+	seconds for them and then abandons the rest, counting them as lost,
+	so that a server that has stopped reading or granting credit cannot
+	hang our process as it exits.
+	The framing and batch options also have the same meaning as for a
+	Client, and a wide framing is needed to send records with large
+	exception tracebacks.
+	
+	When shm_size is positive, each UNIX socket connection announces a
+	new shared memory ring of shm_size bytes in shm_dir and records are
+	written directly to the ring. Records that do not fit in a full ring
+	are counted as lost.
+	
+	The compression and flow control options also have the same meaning
+	as for a Client. Each new connection starts a new compressed stream
+	and a new window of credit.
+	
+	When spool_dir is set, records that cannot be written are appended
+	to a Spool in that directory, as for a Client, instead of being
+	lost. Each new connection replays the spool after our header. Since
+	our header only names our source, spooled records are replayed on
+	the current connection even if an earlier process spooled them.
+	Connections are retried as for any SocketHandler, and spool_retry
+	is ignored.
+	
+	When multiplex names our service, records are written to a channel
+	of the connection that tops.core.network.mux shares between all
+	clients in this process, as for a Client.
+	
+	When suppress_window is positive, records that repeat within that
+	many seconds are replaced by summaries from a Suppressor that tracks
+	up to suppress_keys messages. A summary is sent once its window
+	expires, by a timer that runs while records are being held back, or
+	when we are flushed, even if nothing else is logged.
+	
+	When templates is True, a record whose arguments are all numbers,
+	booleans or strings is sent as the id of its format string and the
+	typed arguments, leaving the server to render its body when needed.
+	Each format string is sent once per connection to register its id,
+	for up to maxTemplates format strings. Templates are not used with a
+	spool, whose records can be replayed on a different connection.
+	
+	When dynamic_levels is True, our header asks the server for the
+	levels that it wants from our sources, and a ControlReader applies
+	the levels that it sends on each connection. Records below the level
+	wanted from their source are dropped before they are suppressed,
+	formatted or queued, and the filtered attribute counts them. If our
+	adjustLogger attribute is a logger, its level is set to the lowest
+	level wanted from any of our sources. Dynamic levels are not used
+	with a shared memory ring or a multiplexed connection, which have no
+	way to read what the server sends back.
+	
+	When exception_ids is True, each exception traceback is sent with
+	the digest of its text, and once the server acknowledges a digest,
+	the same traceback is sent as just its digest for the rest of the
+	connection. As with templates and dynamic levels, this is not used
+	with a spool, a shared memory ring or a multiplexed connection.
+	"""
+	def __init__(self,source,path,host,port,
+		buffered=False,maxqueue=1000,overflow=BoundedQueue.DROP_OLDEST,
+		coalesce_bytes=65536,coalesce_delay=0,framing='int16',batch=False,
+		shm_size=0,shm_dir=None,compression=None,
+		flow_control=False,credit_frames=1000,credit_bytes=1048576,
+		spool_dir=None,spool_bytes=67108864,spool_segment=4194304,spool_retry=None,
+		multiplex=None,templates=False,suppress_window=0,suppress_keys=1000,
+		dynamic_levels=False,exception_ids=False):
 		self.path = path
+		if suppress_window > 0:
+			self.suppressor = Suppressor(suppress_window,suppress_keys)
+		else:
+			self.suppressor = None
+		self.timer = None
+		# format strings registered on our current connection
+		self.templates = { } if templates and not spool_dir else None
+		self.multiplex = multiplex
+		if multiplex:
+			flow_control = False
+			dynamic_levels = False
+			exception_ids = False
+		if shm_size or spool_dir:
+			exception_ids = False
+		if shm_size:
+			dynamic_levels = False
+		# the digests of exceptions acknowledged on our current connection
+		self.acked = set() if exception_ids else None
+		self.source = str(source)
+		self.dynamicLevels = dynamic_levels
+		self.thresholds = None
+		self.adjustLogger = None
+		self.reader = None
+		self.filtered = 0
+		self.shm_size = shm_size
+		self.shm_dir = shm_dir
+		self.ring = None
 		SocketHandler.__init__(self,host,port)
+		self.framing = getFraming(framing)
+		if batch and self.framing.code is None:
+			raise ClientException('batches need a wide framing')
+		if compression and self.framing.code is None:
+			raise ClientException('compression needs a wide framing')
+		self.batch = batch
 		header = Header()
 		header.name = str(source)
-		self.hdr = self._pack16(header.SerializeToString())
+		# shared memory rings are never compressed or flow controlled
+		self.header = header.SerializeToString()
+		if compression:
+			self.compressor = Compressor(compression)
+			header.compression = self.compressor.name
+		else:
+			self.compressor = None
+		if flow_control:
+			self.flow = FlowControl(credit_frames,credit_bytes,overflow)
+			self.flow.announce(header)
+		else:
+			self.flow = None
+		if dynamic_levels:
+			header.levels = True
+		if exception_ids:
+			header.exception_ids = True
+		announced = header.SerializeToString()
+		self.hdr = self._frame(announced)
+		if spool_dir:
+			self.spool = Spool(spool_dir,spool_bytes,spool_segment)
+			self.spool.setHeader(announced)
+		else:
+			self.spool = None
+		self.lost = 0
+		self.writes = 0
+		# set when close() gives up waiting for our flusher
+		self.abandoned = False
+		if buffered:
+			self.queue = BoundedQueue(maxqueue,overflow,self.recordSize)
+			self.flusher = Flusher(self.queue,self.flushRecords,coalesce_delay,coalesce_bytes,self.discard)
+		else:
+			self.queue = None
+			self.flusher = None
+
+	# seconds that flush() waits for our queue to be written
+	flushTimeout = 5.0
+
+	# seconds that close() waits for our flusher to write queued records
+	closeTimeout = 5.0
+
+	# the most format strings that we register on one connection
+	maxTemplates = 1000
+
+	def recordSize(self,record):
+		"""
+		Returns a cheap estimate of the serialized size of a queued record.
+		"""
+		if isinstance(record.msg,basestring):
+			return 32 + len(record.msg)
+		return 32
 
-	def _pack16(self,data):
+	def _frame(self,data):
 		"""
-		Returns data with a 16-bit unsigned integer length prepended, in network byte order.
+		Returns data with our framing's length prefix prepended.
 		"""
-		return self._LengthPacker.pack(len(data)) + data
+		return self.framing.encode(len(data)) + data
 
 	def makePickle(self,record):
 		"""
-		Serializes the record in binary format with a 16-bit length
-		prefix, and returns it ready for transmission across the socket.
+		Serializes the record in binary format with a length prefix, and
+		returns it ready for transmission across the socket.
+		"""
+		if self.compressor is not None:
+			return ''.join(framing.encodeFrames(self.framing,[self.serialize(record)],
+				compressor=self.compressor))
+		return self._frame(self.serialize(record))
+
+	def serialize(self,record):
+		"""
+		Serializes the record in binary format.
+		
 		Uses a Google protocol buffer instead of the default pickle
 		implementation.
 		"""
 		msg = Message()
 		msg.levelno = record.levelno
-		interpolated = record.msg % record.args
-		msg.body = interpolated.encode('utf-8','replace')
+		if self.templates is None or not self.setTemplate(msg,record):
+			interpolated = record.msg % record.args
+			msg.body = interpolated.encode('utf-8','replace')
 		if not record.name == 'root':
 			msg.source = record.name
 		if 'SaveContext' in record.__dict__ and record.SaveContext:
@@ -81,16 +376,78 @@ class ClientHandler(SocketHandler):
 			msg.context.lineno = record.lineno
 			msg.context.funcname = record.funcName
 		if record.exc_info is not None:
-			msg.exception = ''.join(format_exception(*record.exc_info))
-		return self._pack16(msg.SerializeToString())
+			exception = ''.join(format_exception(*record.exc_info))
+			if self.acked is None:
+				msg.exception = exception
+			else:
+				msg.exception_id = digest(exception)
+				if msg.exception_id not in self.acked:
+					msg.exception = exception
+		return msg.SerializeToString()
+
+	def setTemplate(self,msg,record):
+		"""
+		Sends the body of a record as a template with typed arguments, if possible.
+		
+		Returns False if the record's body must be sent instead.
+		"""
+		args = record.args
+		if not isinstance(args,tuple) or not isinstance(record.msg,basestring):
+			return False
+		template_id = self.templates.get(record.msg)
+		if template_id is None and len(self.templates) >= self.maxTemplates:
+			return False
+		# group the arguments by type with as few protobuf calls as possible
+		types = [ ]
+		integers = [ ]
+		reals = [ ]
+		texts = [ ]
+		for value in args:
+			kind = type(value)
+			if kind is str or kind is unicode:
+				texts.append(value)
+				types.append('t')
+			elif kind is int or kind is long:
+				integers.append(value)
+				types.append('i')
+			elif kind is float:
+				reals.append(value)
+				types.append('r')
+			elif kind is bool:
+				integers.append(value)
+				types.append('f')
+			else:
+				return False
+		try:
+			if texts:
+				msg.texts.extend(texts)
+			if integers:
+				msg.integers.extend(integers)
+		except ValueError:
+			# strings that are not valid UTF-8 or integers that are too big
+			msg.ClearField('texts')
+			msg.ClearField('integers')
+			return False
+		if reals:
+			msg.reals.extend(reals)
+		msg.types = ''.join(types)
+		if template_id is None:
+			template_id = len(self.templates) + 1
+			self.templates[record.msg] = template_id
+			msg.template = record.msg.decode('utf-8','replace') if isinstance(record.msg,str) else record.msg
+		msg.template_id = template_id
+		return True
 
 	def makeSocket(self):
 		"""
 		Returns a connected socket.
 		
 		Tries a unix socket first if a path is provided, otherwise (or
-		if the unix socket fails) uses a TCP socket.
+		if the unix socket fails) uses a TCP socket. Returns a channel of
+		our process's multiplexed connection instead if we have one.
 		"""
+		if self.multiplex:
+			return mux.shared().open(self.multiplex)
 		if self.path is not None:
 			try:
 				s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -103,12 +460,354 @@ class ClientHandler(SocketHandler):
 		return s
 
 	def createSocket(self):
+		if self.reader is not None:
+			self.reader.stop()
+			self.reader = None
 		SocketHandler.createSocket(self)
-		if self.sock:
-			self.send(self.hdr)
+		if not self.sock:
+			return
+		if self.templates is not None:
+			self.templates.clear()
+		if self.acked is not None:
+			self.acked.clear()
+		if self.shm_size and self.sock.family == socket.AF_UNIX:
+			self.ring = RingBuffer.create(self.shm_dir or tempfile.gettempdir(),self.shm_size)
+			self.ring.put(self.header)
+			self.send(framing.announceRing(self.ring.path))
+		else:
+			if self.compressor is not None:
+				self.compressor.reset()
+			if self.flow is not None:
+				self.flow.start()
+			SocketHandler.send(self,framing.preamble(self.framing) + self.hdr)
+			if self.sock is not None and (self.dynamicLevels or self.acked is not None):
+				self.startReader()
+			if self.sock is not None and self.spool is not None and len(self.spool):
+				self.replay()
+
+	def startReader(self):
+		"""
+		Starts reading the control frames sent on a new connection.
+		"""
+		if self.flow is not None:
+			handlers = self.flow.handlers
+		else:
+			handlers = { }
+		if self.dynamicLevels:
+			handlers[framing.CONTROL_LEVELS] = self.setLevels
+		if self.acked is not None:
+			handlers[framing.CONTROL_EXCEPTION] = self.acked.add
+		self.reader = ControlReader(self.sock,handlers,self.flow)
+
+	def setLevels(self,payload):
+		"""
+		Applies the levels that the server wants from our sources.
+		"""
+		thresholds = LevelThresholds(payload,self.source)
+		if self.adjustLogger is not None:
+			self.adjustLogger.setLevel(thresholds.lowest())
+		self.thresholds = thresholds
+
+	def replay(self):
+		"""
+		Replays our spool on a new connection.
+		"""
+		try:
+			self.spool.replay(lambda header,packets: self.writePackets(packets))
+		except socket.error:
+			pass
+
+	def send(self,packet):
+		SocketHandler.send(self,packet)
+		self.writes += 1
+		if self.sock is None and self.ring is not None:
+			self.ring.close()
+			self.ring = None
+
+	def putRing(self,record):
+		"""
+		Writes a record to our shared memory ring.
+		
+		Wakes up the server if it has stopped polling, and checks that it
+		is still listening if the ring is full.
+		"""
+		try:
+			if not self.ring.put(self.serialize(record)):
+				self.lost += 1
+				self.send('\x00')
+			elif self.ring.isSleeping():
+				self.ring.setSleeping(False)
+				self.send('\x00')
+		except (KeyboardInterrupt,SystemExit):
+			raise
+		except:
+			self.handleError(record)
+
+	def emit(self,record):
+		"""
+		Sends a record, or queues it in buffered mode.
+		
+		Sends any summaries of suppressed records first.
+		"""
+		thresholds = self.thresholds
+		if thresholds is not None and record.levelno < thresholds.threshold(record.name):
+			self.filtered += 1
+			if self.sock is None and self.queue is None:
+				# reconnect to learn whether the server wants more
+				self.createSocket()
+			return
+		if self.suppressor is not None:
+			for summary in self.suppressor.expire(record.created):
+				self.forward(summary)
+			if not self.suppressor.admit(record):
+				self.scheduleExpiry()
+				return
+		self.forward(record)
+
+	def scheduleExpiry(self):
+		"""
+		Starts a timer for when our oldest suppression window expires.
+		
+		Called with our lock held.
+		"""
+		if self.timer is not None:
+			return
+		when = self.suppressor.nextExpiry()
+		if when is None:
+			return
+		self.timer = threading.Timer(max(when - time.time(),0),self.expireSuppressed)
+		self.timer.setDaemon(True)
+		self.timer.start()
+
+	def expireSuppressed(self):
+		"""
+		Sends the summaries of suppression windows that have expired.
+		
+		Called by our timer and by flush().
+		"""
+		self.acquire()
+		try:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			for summary in self.suppressor.expire(time.time()):
+				self.forward(summary)
+			self.scheduleExpiry()
+		finally:
+			self.release()
+
+	def forward(self,record):
+		"""
+		Sends a record that was not suppressed.
+		"""
+		if self.shm_size:
+			if self.sock is None:
+				self.createSocket()
+			if self.ring is not None:
+				self.putRing(record)
+				return
+		if self.queue is None:
+			if (self.compressor is not None or self.flow is not None or self.spool is not None or
+				self.templates is not None or self.acked is not None) and self.sock is None:
+				# connect before compressing so that the record starts a new stream
+				self.createSocket()
+				if self.sock is None and self.spool is None:
+					self.lost += 1
+					return
+			if self.spool is not None:
+				try:
+					self.deliver([self.serialize(record)])
+				except (KeyboardInterrupt,SystemExit):
+					raise
+				except:
+					self.handleError(record)
+				return
+			if self.flow is not None:
+				try:
+					self.sendPaced([self.serialize(record)])
+				except (KeyboardInterrupt,SystemExit):
+					raise
+				except socket.error:
+					self.lost += 1
+				except:
+					self.handleError(record)
+				return
+			SocketHandler.emit(self,record)
+			return
+		try:
+			self.queue.put(record)
+		except (KeyboardInterrupt,SystemExit):
+			raise
+		except:
+			self.handleError(record)
+
+	def flushRecords(self,records):
+		"""
+		Serializes a batch of queued records and writes them.
+		
+		Called from our flusher thread. Connects first, if necessary, so
+		that the records can use the templates and exceptions of the new
+		connection.
+		"""
+		if self.sock is None and not self.abandoned and (self.templates is not None or self.acked is not None):
+			self.createSocket()
+		packets = [ ]
+		for record in records:
+			try:
+				data = self.serialize(record)
+				if len(data) > self.framing.maxLength:
+					raise ClientException('record of %d bytes is too long for %s framing' %
+						(len(data),self.framing.name))
+				packets.append(data)
+			except (KeyboardInterrupt,SystemExit):
+				raise
+			except:
+				self.handleError(record)
+		if not packets:
+			return True
+		return self.flushPackets(packets)
+
+	def flushPackets(self,batch):
+		"""
+		Writes a batch of queued records with a single write.
+		
+		Called from our flusher thread. Returns True since we retry the
+		connection for subsequent batches if it fails, unless close() has
+		abandoned our queue.
+		"""
+		if self.sock is None and not self.abandoned:
+			self.createSocket()
+		if self.spool is not None:
+			self.deliver(batch)
+			return True
+		if self.sock is None:
+			self.lost += len(batch)
+			return not self.abandoned
+		try:
+			self.writePackets(batch)
+		except socket.error:
+			self.lost += len(batch)
+			return not self.abandoned
+		return True
+
+	def discard(self,records):
+		"""
+		Counts the records left in our queue when our flusher stops.
+		"""
+		self.lost += len(records)
+
+	def writePackets(self,packets):
+		"""
+		Writes a list of serialized records to our socket.
+		
+		Closes our socket if the connection fails.
+		"""
+		if self.flow is not None:
+			self.sendPaced(packets)
+			return
+		try:
+			sendPieces(self.sock,framing.encodeFrames(self.framing,packets,self.batch,self.compressor))
+			self.writes += 1
+		except socket.error:
+			self.sock.close()
+			self.sock = None
+			raise
+
+	def deliver(self,packets):
+		"""
+		Writes serialized records to our socket, or else to our spool.
+		"""
+		if self.sock is not None:
+			try:
+				self.writePackets(packets)
+				return
+			except socket.error:
+				pass
+		self.spool.append(packets)
+
+	def sendPaced(self,packets):
+		"""
+		Writes packets as quickly as our flow control credit allows.
+		
+		Closes our socket if the connection fails.
+		"""
+		def write(chunk):
+			sendPieces(self.sock,framing.encodeFrames(self.framing,chunk,self.batch,self.compressor))
+			self.writes += 1
+		try:
+			self.flow.pace(self.sock,packets,write)
+		except socket.error:
+			self.sock.close()
+			self.sock = None
+			raise
+
+	def flush(self):
+		"""
+		Sends the summaries of expired suppression windows and then waits
+		for any queued records to be written.
+		"""
+		if self.suppressor is not None:
+			self.expireSuppressed()
+		if self.queue is not None:
+			self.queue.join(self.flushTimeout)
+
+	def stats(self):
+		"""
+		Returns a dictionary of counters that describe our delivery of records.
+		"""
+		stats = { 'lost': self.lost, 'writes': self.writes, 'filtered': self.filtered }
+		if self.queue is not None:
+			stats.update({
+				'depth': len(self.queue),
+				'maxDepth': self.queue.maxDepth,
+				'queued': self.queue.queued,
+				'dropped': self.queue.dropped
+			})
+		return stats
+
+	def close(self):
+		"""
+		Closes our connection after writing any queued records.
+		
+		Summarizes any records that are still being suppressed first.
+		"""
+		if self.suppressor is not None:
+			self.acquire()
+			try:
+				if self.timer is not None:
+					self.timer.cancel()
+					self.timer = None
+				for summary in self.suppressor.expireAll():
+					self.forward(summary)
+			finally:
+				self.release()
+		if self.queue is not None:
+			self.queue.close()
+			self.flusher.join(self.closeTimeout)
+			if self.flusher.isAlive():
+				# wake a flusher that is still waiting for the server
+				self.abandoned = True
+				if self.reader is not None:
+					self.reader.stop()
+				sock = self.sock
+				if sock is not None and hasattr(sock,'shutdown'):
+					try:
+						sock.shutdown(socket.SHUT_RDWR)
+					except socket.error:
+						pass
+				self.flusher.join(self.closeTimeout)
+		if self.reader is not None:
+			self.reader.stop()
+		SocketHandler.close(self)
+		if self.ring is not None:
+			self.ring.close()
+			self.ring = None
+		if self.spool is not None:
+			self.spool.close()
 
 
 import tops.core.utility.config as config
+import tops.core.network.client as client
 
 def initialize(name):
 	"""
@@ -132,10 +831,156 @@ def initialize(name):
 	globals()["getLogger"] = clientGetLogger
 
 	source = ResourceName(name)	
+	options = client.getOptions('logger')
+	if 'spool_dir' in options:
+		options['spool_dir'] = os.path.join(options['spool_dir'],str(source))
+	options['templates'] = bool(config.getboolean('logger','templates'))
+	options['suppress_window'] = config.getfloat('logger','suppress_window') or 0
+	options['suppress_keys'] = config.getint('logger','suppress_keys') or 1000
+	options['dynamic_levels'] = bool(config.getboolean('logger','push_levels'))
+	options['exception_ids'] = bool(config.getboolean('logger','exception_ids'))
 	clientHandler = ClientHandler(source,
 		config.get('logger','unix_addr'),
 		config.get('logger','tcp_host'),
-		config.get('logger','tcp_port')
+		config.getint('logger','tcp_port'),
+		**options
 	)
 	root.handlers.append(clientHandler)
 	root.setLevel(DEBUG)
+	if clientHandler.dynamicLevels:
+		clientHandler.adjustLogger = root
+
+
+import unittest
+
+class SuppressorTests(unittest.TestCase):
+	def record(self,when,msg='unable to parse line %r',args=('x',),level=WARNING):
+		record = LogRecord('tcc',level,'f',1,msg,args,None)
+		record.created = when
+		return record
+	def test00(self):
+		"""Repeated messages are summarized once their window expires"""
+		s = Suppressor(10)
+		self.assertEqual(s.admit(self.record(100.0)),True)
+		self.assertEqual([s.admit(self.record(100.0 + t,args=(t,))) for t in (1,2,3)],[False]*3)
+		self.assertEqual(s.admit(self.record(101.0,level=ERROR)),True)
+		self.assertEqual(s.expire(109.0),[])
+		summaries = s.expire(110.5)
+		self.assertEqual(len(summaries),1)
+		self.assertEqual(summaries[0].levelno,WARNING)
+		self.assertTrue(summaries[0].getMessage().startswith('Repeated 3 times between '))
+		self.assertTrue(summaries[0].getMessage().endswith(': unable to parse line 3'))
+		# the unrepeated error closes silently and the warning starts a new window
+		self.assertEqual(s.expire(111.0),[])
+		self.assertEqual(s.admit(self.record(111.0)),True)
+		self.assertEqual(s.suppressed,3)
+	def test01(self):
+		"""Only a bounded number of messages are tracked"""
+		s = Suppressor(10,maxKeys=3)
+		summaries = [ ]
+		for index in range(10):
+			s.admit(self.record(100.0,msg='message %d' % index))
+			s.admit(self.record(100.0,msg='message %d' % index))
+			summaries.extend(s.expire(100.0))
+		self.assertEqual(len(s.windows),2)
+		self.assertEqual(len(summaries),8)
+		self.assertEqual(len(s.expireAll()),2)
+		self.assertEqual(len(s.windows),0)
+	def test02(self):
+		"""A burst of repeats is summarized even if nothing else is logged"""
+		import sys
+		(a,b) = socket.socketpair()
+		class PairHandler(ClientHandler):
+			def makeSocket(self):
+				return a
+		handler = PairHandler('tcc',None,None,None,framing='varint',suppress_window=0.2)
+		try:
+			raise ValueError('bad')
+		except ValueError:
+			for index in range(5):
+				handler.handle(LogRecord('axis',ERROR,'f',1,'fault %d',(index,),sys.exc_info()))
+		self.assertEqual((handler.writes,handler.suppressor.suppressed),(1,4))
+		self.assertEqual(handler.suppressor.windows.values()[0][-1],(4,))
+		deadline = time.time() + 5
+		while handler.writes < 2 and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertEqual((handler.writes,len(handler.suppressor.windows)),(2,0))
+		self.assertEqual(handler.timer,None)
+		handler.close()
+		data = b.recv(65536)
+		self.assertTrue('Repeated 4 times between ' in data and ': fault 4' in data)
+		b.close()
+
+class DynamicLevelsTests(unittest.TestCase):
+	def test00(self):
+		"""Records below the levels pushed by the server are dropped"""
+		from levels import encodeLevels
+		(a,b) = socket.socketpair()
+		class PairHandler(ClientHandler):
+			def makeSocket(self):
+				return a
+		handler = PairHandler('tcc',None,None,None,dynamic_levels=True)
+		handler.adjustLogger = Logger('adjusted')
+		handler.handle(LogRecord('axis',DEBUG,'f',1,'sent before levels arrive',(),None))
+		b.sendall(framing.encodeControl(framing.CONTROL_LEVELS,encodeLevels(WARNING,[],[('tcc.axis',DEBUG)])))
+		deadline = time.time() + 5
+		while handler.thresholds is None and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertEqual(handler.adjustLogger.level,DEBUG)
+		handler.handle(LogRecord('listener',INFO,'f',1,'dropped',(),None))
+		handler.handle(LogRecord('axis',DEBUG,'f',1,'sent',(),None))
+		handler.handle(LogRecord('root',ERROR,'f',1,'sent',(),None))
+		self.assertEqual((handler.writes,handler.filtered),(3,1))
+		handler.close()
+		handler.reader.join(5)
+		self.assertEqual(handler.reader.alive,False)
+		b.close()
+	def test01(self):
+		"""Exceptions acknowledged by the server are sent as their digest"""
+		import sys
+		from traces import digest
+		(a,b) = socket.socketpair()
+		class PairHandler(ClientHandler):
+			def makeSocket(self):
+				return a
+		handler = PairHandler('tcc',None,None,None,exception_ids=True)
+		try:
+			raise ValueError('bad')
+		except ValueError:
+			record = LogRecord('axis',ERROR,'f',1,'failed',(),sys.exc_info())
+		handler.handle(record)
+		msg = Message()
+		msg.ParseFromString(handler.serialize(record))
+		self.assertEqual(msg.exception_id,digest(msg.exception))
+		b.sendall(framing.encodeControl(framing.CONTROL_EXCEPTION,str(msg.exception_id)))
+		deadline = time.time() + 5
+		while not handler.acked and time.time() < deadline:
+			time.sleep(0.01)
+		msg = Message()
+		msg.ParseFromString(handler.serialize(record))
+		self.assertEqual((msg.HasField('exception'),msg.exception_id),(False,digest(''.join(format_exception(*record.exc_info)))))
+		handler.close()
+		b.close()
+
+class ClientHandlerTests(unittest.TestCase):
+	def test00(self):
+		"""Closing a handler that is waiting for credit abandons its queue"""
+		(a,b) = socket.socketpair()
+		class PairHandler(ClientHandler):
+			closeTimeout = 0.1
+			def makeSocket(self):
+				return a
+		handler = PairHandler('tcc',None,None,None,buffered=True,framing='varint',
+			flow_control=True,credit_frames=1,overflow=BoundedQueue.BLOCK)
+		handler.handle(LogRecord('axis',INFO,'f',1,'sent',(),None))
+		self.assertEqual(handler.queue.join(5),True)
+		for index in range(3):
+			handler.handle(LogRecord('axis',INFO,'f',1,'waiting %d',(index,),None))
+		start = time.time()
+		handler.close()
+		self.assertTrue(time.time() - start < 1.0)
+		self.assertEqual((handler.flusher.isAlive(),handler.lost,handler.writes),(False,3,1))
+		b.close()
+
+if __name__ == '__main__':
+	unittest.main()
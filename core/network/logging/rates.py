@@ -0,0 +1,184 @@
+"""
+Rolling message rates of the logging server
+
+Counts the records handled by the logging server by source and level
+over the last second, minute and hour, so that a source that is flooding
+the server can be found without searching the records themselves. Each
+count is kept in a fixed number of time buckets that are reused in turn,
+so counting a record takes constant time and memory does not grow with
+the rate.
+"""
+
+## @package tops.core.network.logging.rates
+# Rolling message rates of the logging server
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import logging
+
+from record import quote
+
+class RollingCounter(object):
+	"""
+	Counts events over a rolling window of slots buckets of width ms each.
+
+	Times are integer milliseconds. Events older than the window are
+	ignored.
+	"""
+	__slots__ = ('width','counts','base')
+
+	def __init__(self,width,slots):
+		self.width = width
+		self.counts = [0]*slots
+		# the number of the newest bucket
+		self.base = 0
+
+	def advance(self,bucket):
+		"""
+		Makes bucket the newest, emptying the buckets that it replaces.
+		"""
+		slots = len(self.counts)
+		if bucket - self.base >= slots:
+			self.counts[:] = [0]*slots
+		else:
+			for number in xrange(self.base + 1,bucket + 1):
+				self.counts[number % slots] = 0
+		self.base = bucket
+
+	def add(self,when,count=1):
+		bucket = when // self.width
+		if bucket > self.base:
+			self.advance(bucket)
+		elif bucket <= self.base - len(self.counts):
+			return
+		self.counts[bucket % len(self.counts)] += count
+
+	def total(self,when):
+		"""
+		Returns the number of events in the window ending at when.
+		"""
+		bucket = when // self.width
+		if bucket > self.base:
+			self.advance(bucket)
+		return sum(self.counts)
+
+class MessageRates(object):
+	"""
+	Keeps rolling counts of records by source prefix and level.
+
+	Sources are counted by their first depth elements, so that with the
+	default depth 'tcc.axis.az' and 'tcc.axis.alt' are counted together
+	as 'tcc.axis'. At most maxKeys combinations of prefix and level are
+	counted separately, and any others are counted under the prefix
+	'(other)'.
+	"""
+	# (bucket width in ms,number of buckets) of each window
+	windows = ((100,10),(1000,60),(60000,60))
+	windowNames = ('1s','1m','1h')
+
+	maxKeys = 1000
+
+	def __init__(self,depth=2):
+		self.depth = depth
+		self.prefixes = { }
+		self.counters = { }
+		self.levels = { }
+
+	def prefix(self,source):
+		try:
+			return self.prefixes[source]
+		except KeyError:
+			prefix = '.'.join(source.split('.')[:self.depth])
+			self.prefixes[source] = prefix
+			return prefix
+
+	def count(self,record):
+		"""
+		Counts a record at its timestamp.
+		"""
+		key = (self.prefix(record.source),record.levelno)
+		try:
+			counters = self.counters[key]
+		except KeyError:
+			if len(self.counters) >= self.maxKeys:
+				key = ('(other)',record.levelno)
+			counters = self.counters.get(key)
+			if counters is None:
+				counters = [RollingCounter(width,slots) for (width,slots) in self.windows]
+				self.counters[key] = counters
+		when = record.tstamp
+		for counter in counters:
+			counter.add(when)
+
+	def json(self,now):
+		"""
+		Returns our counts at now in ms as JSON, busiest over the last minute first.
+		"""
+		rows = [ ]
+		for ((prefix,levelno),counters) in self.counters.iteritems():
+			totals = [counter.total(now) for counter in counters]
+			if totals[-1]:
+				rows.append((totals[1],totals,prefix,levelno))
+		rows.sort(reverse=True)
+		items = ',\n\t'.join(['{"source":%s,"level":%s,"counts":[%d,%d,%d]}' %
+			((quote(prefix),self.levelName(levelno)) + tuple(totals))
+			for (busy,totals,prefix,levelno) in rows])
+		return ('{"tstamp":%d,"windows":["%s"],"items":[%s]}' %
+			(now,'","'.join(self.windowNames),items))
+
+	def levelName(self,levelno):
+		try:
+			return self.levels[levelno]
+		except KeyError:
+			name = quote(logging.getLevelName(levelno).replace(' ','_'))
+			self.levels[levelno] = name
+			return name
+
+
+import unittest
+
+class MessageRatesTests(unittest.TestCase):
+	class Record(object):
+		def __init__(self,tstamp,source,levelno):
+			self.tstamp = tstamp
+			self.source = source
+			self.levelno = levelno
+	def test00(self):
+		"""Counts roll over their windows"""
+		counter = RollingCounter(1000,60)
+		for when in xrange(0,120000,500):
+			counter.add(when)
+		self.assertEqual(counter.total(119999),120)
+		self.assertEqual(counter.total(150000),58)
+		counter.add(90999)
+		self.assertEqual(counter.total(150000),58)
+		counter.add(100000)
+		counter.add(149000)
+		self.assertEqual(counter.total(150000),60)
+		self.assertEqual(counter.total(1000000),0)
+	def test01(self):
+		"""Records are counted by source prefix and level"""
+		rates = MessageRates()
+		for when in xrange(0,60000,10):
+			rates.count(self.Record(when,'tcc.axis.az',20))
+			if when % 1000 == 0:
+				rates.count(self.Record(when,'tcc.axis.alt',40))
+				rates.count(self.Record(when,'hub',20))
+		from json import loads
+		update = loads(rates.json(59999))
+		self.assertEqual(update['windows'],['1s','1m','1h'])
+		self.assertEqual([(item['source'],item['level'],item['counts']) for item in update['items']],
+			[('tcc.axis','INFO',[100,6000,6000]),('tcc.axis','ERROR',[1,60,60]),('hub','INFO',[1,60,60])])
+	def test02(self):
+		"""Only a bounded number of sources are counted separately"""
+		rates = MessageRates(depth=1)
+		rates.maxKeys = 2
+		for name in ('aaa','bbb','ccc','ddd'):
+			rates.count(self.Record(0,name + '.xxx',20))
+		self.assertEqual(sorted(prefix for (prefix,levelno) in rates.counters),['(other)','aaa','bbb'])
+
+if __name__ == '__main__':
+	unittest.main()
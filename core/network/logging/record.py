@@ -3,6 +3,13 @@ Manages the message formats used for distributed logging
 
 A record combines a session header and a message resulting from a
 client-server interaction.
+
+A message can carry its body as a template, registered earlier on the
+same connection, and typed arguments.
+
+A record is encoded as a JSON fragment once, when it is created, and
+keeps only what is needed to filter and serve it, so that a large
+buffer of records stays small.
 """
 
 ## @package tops.core.network.logging.record
@@ -15,59 +22,138 @@ client-server interaction.
 
 from time import time
 from datetime import datetime
+from json import encoder,loads
 import logging
 
 from tops.core.network.naming import ResourceNamePattern,NamingException
 
+def render(template,msg):
+	"""
+	Returns the body of a message sent as a template with typed arguments.
+	"""
+	integers = iter(msg.integers)
+	reals = iter(msg.reals)
+	texts = iter(msg.texts)
+	values = [ ]
+	try:
+		for kind in msg.types:
+			if kind == 't':
+				values.append(texts.next())
+			elif kind == 'i':
+				values.append(integers.next())
+			elif kind == 'r':
+				values.append(reals.next())
+			elif kind == 'f':
+				values.append(bool(integers.next()))
+	except StopIteration:
+		pass
+	values = tuple(values)
+	try:
+		return template % values
+	except (TypeError,ValueError):
+		return '%s %r' % (template,values)
+
+# quotes and escapes a string as JSON, see http://www.json.org/
+quote = encoder.encode_basestring_ascii
+
+def intern_name(name):
+	"""
+	Returns the interned str of a name, so that records share their sources.
+	"""
+	if isinstance(name,unicode):
+		name = name.encode('utf-8')
+	return intern(name)
+
 class LogRecord(object):
 	"""
 	The record generated from a single log message.
+	
+	The template of a message that was sent as one should be provided.
+	A record is timestamped when it is created, unless its message was
+	forwarded with the timestamp it was given by another server.
+	A record does not keep its message or header: the timestamp is kept
+	as integer milliseconds and the body and exception only in the JSON
+	fragment that serves the record, which is ASCII with everything else
+	escaped. The seq attribute is assigned by a FeedBuffer.
+	
+	A new record also keeps its body and exception in its decoded
+	attribute until the FeedBuffer has handled it and clears it.
 	"""
-	def __init__(self,msg,hdr):
-		self.timestamp = time()
-		self.when = datetime.fromtimestamp(self.timestamp)
+	__slots__ = ('tstamp','levelno','source','encoded','seq','decoded')
+
+	def __init__(self,msg,hdr,template=None):
+		self.tstamp = msg.tstamp if msg.HasField('tstamp') else int(1000*time())
+		self.levelno = msg.levelno
 		# we assume that these are valid names
-		self.source = hdr.name + '.' + msg.source if msg.source else hdr.name
-		self.msg = msg
-		self.hdr = hdr
-		self.cached_json = None
+		self.source = intern_name(hdr.name + '.' + msg.source if msg.source else hdr.name)
+		body = msg.body if template is None else render(template,msg)
+		fields = [
+			'{"tstamp":%d' % self.tstamp,
+			'"level":%s' % quote(logging.getLevelName(self.levelno).replace(' ','_')),
+			'"source":%s' % quote(self.source),
+			'"body":%s' % quote(body)
+		]
+		if msg.exception:
+			fields.append('"exception":%s' % quote(msg.exception))
+		self.encoded = ','.join(fields) + '}'
+		self.decoded = (body,msg.exception or None)
+
+	@property
+	def timestamp(self):
+		return 1e-3*self.tstamp
+
+	@property
+	def body(self):
+		return self.fields()[0]
+
+	def fields(self):
+		"""
+		Returns the body of this record and its exception, or None.
+
+		The fields are decoded from our JSON once decoded has been cleared.
+		"""
+		decoded = self.decoded
+		if decoded is None:
+			fields = loads(self.encoded)
+			decoded = (fields['body'],fields.get('exception'))
+		return decoded
+
+	def compact(self):
+		"""
+		Returns a marshallable tuple that expand() turns back into a record.
+		"""
+		return (self.tstamp,self.source,self.levelno,self.encoded)
+
+	@classmethod
+	def expand(cls,compact):
+		"""
+		Returns the record corresponding to a compact() tuple.
+		"""
+		record = cls.__new__(cls)
+		(record.tstamp,source,record.levelno,record.encoded) = compact
+		record.source = intern_name(source)
+		record.decoded = None
+		return record
 
 	def json(self):
-		if self.cached_json:
-			return self.cached_json
-		msg = self.msg
-		if msg.HasField('context'):
-			context = msg.context
-			json_context = ('{"file":"%s","line":%d,"func":"%s"}' %
-				(context.filename,context.lineno,context.funcname))
-		else:
-			json_context = 'null'
-		json_exception = '"%s"' % msg.exception if msg.exception else 'null'
-		# See http://www.json.org/ for string escaping rules
-		escaped_body = (msg.body
-			.replace('\\', r'\\')
-			.replace('"', r'\"')
-			.replace('\b', r'\b')
-			.replace('\f', r'\f')
-			.replace('\n', r'\n')
-			.replace('\r', r'\r')
-			.replace('\t', r'\t'))
-		self.cached_json = (
-			'{"tstamp":%d,"level":"%s","source":"%s","body":"%s"}' %
-			(int(1000*self.timestamp),logging.getLevelName(msg.levelno).replace(' ','_'),
-			self.source,escaped_body)
-		)
-		return self.cached_json
+		return self.encoded
 
 	def __str__(self):
-		return '[%02d] %s (%s) %s' % (self.msg.levelno,self.when,self.source,self.msg.body)
+		return '[%02d] %s (%s) %s' % (self.levelno,datetime.fromtimestamp(self.timestamp),self.source,self.body)
 
 class LogFilter(object):
 	"""
 	Filters a log record.
+	
+	The cursor is the sequence number of the next record that this
+	filter's client has not yet seen. A filter subscribed to a feed also
+	has a list of pending records that it selects, and calls notify, if
+	it is set, whenever a record is added to them.
 	"""
 	def __init__(self,sourceFilter='*',minLevel='WARNING'):
-		self.last = 0
+		self.cursor = 0
+		self.pending = None
+		self.notify = None
 		try:
 			self.sourcePattern = ResourceNamePattern(sourceFilter)
 		except NamingException:
@@ -80,11 +166,63 @@ class LogFilter(object):
 			self.minLevel = logging.NOTSET
 
 	def selects(self,record):
-		selected = (
-			(record.timestamp > self.last) and
-			(record.msg.levelno >= self.minLevel) and
+		return (
+			(record.levelno >= self.minLevel) and
 			(self.sourcePattern.matches(record.source))
 		)
-		if record.timestamp > self.last:
-			self.last = record.timestamp
-		return selected
\ No newline at end of file
+
+
+import unittest
+
+class LogRecordTests(unittest.TestCase):
+	def message(self,*args):
+		from logging_pb2 import Message,Header
+		msg = Message()
+		msg.levelno = logging.INFO
+		for value in args:
+			if isinstance(value,bool):
+				msg.integers.append(value)
+				msg.types += 'f'
+			elif isinstance(value,(int,long)):
+				msg.integers.append(value)
+				msg.types += 'i'
+			elif isinstance(value,float):
+				msg.reals.append(value)
+				msg.types += 'r'
+			else:
+				msg.texts.append(value)
+				msg.types += 't'
+		hdr = Header()
+		hdr.name = 'test'
+		return (msg,hdr)
+	def test00(self):
+		"""Templates are rendered into the JSON of a record"""
+		(msg,hdr) = self.message(-3,2.5,'x',True)
+		record = LogRecord(msg,hdr,'%d %.1f %s %s')
+		self.assertEqual(record.body,'-3 2.5 x True')
+		self.assertTrue('"body":"-3 2.5 x True"' in record.json())
+		copy = LogRecord.expand(record.compact())
+		self.assertEqual((copy.body,copy.json()),(record.body,record.json()))
+		self.assertEqual((copy.fields(),record.fields()),(('-3 2.5 x True',None),('-3 2.5 x True',None)))
+		record.decoded = None
+		self.assertEqual(record.fields(),('-3 2.5 x True',None))
+	def test01(self):
+		"""Templates that do not match their arguments are still rendered"""
+		(msg,hdr) = self.message('x')
+		self.assertEqual(LogRecord(msg,hdr,'%d and %d').body,"%d and %d (u'x',)")
+	def test02(self):
+		"""Records are encoded as valid JSON"""
+		(msg,hdr) = self.message()
+		msg.body = u'tab\tquote" back\\slash \x01 \u00b5s'
+		msg.exception = 'Traceback\n  "line"'
+		msg.source = 'axis'
+		record = LogRecord(msg,hdr)
+		decoded = loads(record.json())
+		self.assertEqual(decoded['body'],msg.body)
+		self.assertEqual(decoded['exception'],msg.exception)
+		self.assertEqual((decoded['source'],decoded['level'],decoded['tstamp']),('test.axis','INFO',record.tstamp))
+		self.assertTrue(record.source is LogRecord(msg,hdr).source)
+		self.assertRaises(AttributeError,lambda: setattr(record,'msg',msg))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -15,23 +15,79 @@ producer clients and serves consumer clients via a web server.
 
 from twisted.internet.protocol import Factory
 from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from twisted.web.server import NOT_DONE_YET
 from twisted.python import log
 
 from collections import deque
+from itertools import islice
+from time import time
 from record import *
+from rates import MessageRates
+from levels import encodeLevels
 from datetime import datetime,timedelta
 
-from logging import DEBUG
+from logging import DEBUG,INFO,getLevelName
 
 import logging_pb2
 
 class FeedBuffer(object):
 	"""
 	Maintains an in-memory buffer of recent log messages.
+	
+	The buffer holds at most maxdepth records and, if maxbytes is
+	positive, records using at most about maxbytes of memory, counting
+	the JSON of each record and a fixed overhead. The oldest records are
+	evicted to stay within both bounds, and are appended to our spill
+	store, if we have one, where they can still be paged through.
+	
+	Each record is numbered in the order it was added, so a client can
+	hold a cursor and only be sent the records added after it. Sequence
+	numbers are dense, so seeking to a cursor is a subtraction rather
+	than a search and only the new records are visited.
+	
+	Subscribed filters are indexed by their minimum level and then by
+	their source pattern, so filters that are the same are only matched
+	once. The filters selecting each combination of source and level
+	are cached, so a record is matched against the index only when it
+	is the first with its source and level. It is then appended to the
+	pending list of each filter that selects it. Evicted records are
+	trimmed from the head of a pending list when the filter is next
+	appended to or drained, so a parked subscriber does not keep them in
+	memory for long and eviction does not visit every subscriber.
+	
+	Every record is also counted by our rolling message rates, appended
+	to our store and sink, if we have them, added to our full-text index
+	while it is buffered, if we have one, and added to the group of its
+	traceback in our TraceStore, if we have one, and forwarded by our
+	UpstreamClient, if we have one. Our LevelPolicy, if we have one, is
+	told whenever our subscribers change.
 	"""
-	def __init__(self,maxdepth=100):
+	maxRoutes = 1000
+
+	# the memory used by a buffered record in addition to its JSON
+	recordOverhead = 160
+
+	def __init__(self,maxdepth=100,maxbytes=0):
 		self.maxdepth = maxdepth
+		self.maxbytes = maxbytes
 		self.buffer = deque()
+		# the memory used by our buffered records
+		self.nbytes = 0
+		# the sequence number of the next record to be added
+		self.nextSeq = 0
+		# subscribed filters indexed by minLevel then source pattern
+		self.subscribers = { }
+		# the subscribed filters that select each (source,levelno) seen so far
+		self.routes = { }
+		self.rates = MessageRates()
+		self.store = None
+		self.sink = None
+		self.index = None
+		self.levels = None
+		self.traces = None
+		self.spill = None
+		self.upstream = None
 		self.hdr = logging_pb2.Header()
 		self.hdr.name = 'logging.server'
 		self.msgCount = 0
@@ -39,39 +95,402 @@ class FeedBuffer(object):
 		LoopingCall(self.statusMessage).start(60.0)
 
 	def add(self,record):
+		record.seq = self.nextSeq
+		self.nextSeq += 1
 		self.buffer.append(record)
-		if len(self.buffer) > self.maxdepth:
-			self.buffer.popleft()
+		self.nbytes += len(record.encoded) + self.recordOverhead
+		if len(self.buffer) > self.maxdepth or (self.maxbytes and self.nbytes > self.maxbytes):
+			self.evict()
 		self.msgCount += 1
+		self.rates.count(record)
+		if self.store is not None:
+			self.store.append(record)
+		if self.sink is not None:
+			self.sink.put(record)
+		if self.index is not None:
+			self.index.add(record)
+		if self.traces is not None and '"exception":' in record.encoded:
+			self.traces.add(record)
+		if self.upstream is not None:
+			self.upstream.forward(record)
+		# buffered records only keep their JSON
+		record.decoded = None
+		oldest = self.nextSeq - len(self.buffer)
+		for filt in self.route(record):
+			pending = filt.pending
+			while pending and pending[0].seq < oldest:
+				pending.popleft()
+			pending.append(record)
+			if filt.notify is not None:
+				filt.notify()
+
+	def evict(self):
+		"""
+		Removes our oldest records until we are within our bounds.
+		
+		The newest record is always kept.
+		"""
+		buffer = self.buffer
+		while len(buffer) > 1 and (len(buffer) > self.maxdepth or
+			(self.maxbytes and self.nbytes > self.maxbytes)):
+			record = buffer.popleft()
+			self.nbytes -= len(record.encoded) + self.recordOverhead
+			if self.spill is not None:
+				self.spill.append(record)
+		if self.index is not None:
+			self.index.expire(buffer[0].seq)
+
+	def route(self,record):
+		"""
+		Returns the subscribed filters that select a record.
+		"""
+		key = (record.source,record.levelno)
+		try:
+			return self.routes[key]
+		except KeyError:
+			pass
+		selected = [ ]
+		for (minLevel,patterns) in self.subscribers.iteritems():
+			if record.levelno < minLevel:
+				continue
+			for filters in patterns.itervalues():
+				if filters[0].sourcePattern.matches(record.source):
+					selected.extend(filters)
+		if len(self.routes) >= self.maxRoutes:
+			self.routes.clear()
+		self.routes[key] = selected
+		return selected
+
+	def subscribe(self,filt):
+		"""
+		Subscribes a filter to the records that it selects.
+		
+		Its pending list starts with the buffered records after its cursor.
+		"""
+		filt.pending = deque([r for r in self.since(filt.cursor) if filt.selects(r)],self.maxdepth)
+		patterns = self.subscribers.setdefault(filt.minLevel,{ })
+		patterns.setdefault(filt.sourcePattern,[ ]).append(filt)
+		self.routes.clear()
+		if self.levels is not None:
+			self.levels.changed()
+
+	def unsubscribe(self,filt):
+		"""
+		Stops collecting the records that a filter selects.
+		"""
+		try:
+			patterns = self.subscribers[filt.minLevel]
+			filters = patterns[filt.sourcePattern]
+			filters.remove(filt)
+		except (KeyError,ValueError):
+			return
+		if not filters:
+			del patterns[filt.sourcePattern]
+			if not patterns:
+				del self.subscribers[filt.minLevel]
+		filt.pending = None
+		self.routes.clear()
+		if self.levels is not None:
+			self.levels.changed()
+		if filt.notify is not None:
+			filt.notify()
+
+	def since(self,cursor):
+		"""
+		Returns the buffered records numbered cursor or later, oldest first.
+		
+		A cursor that has fallen off the tail of the buffer returns
+		every buffered record.
+		"""
+		count = min(self.nextSeq - cursor,len(self.buffer))
+		if count <= 0:
+			return [ ]
+		records = list(islice(reversed(self.buffer),count))
+		records.reverse()
+		return records
+
+	def search(self,query,filt,limit=100):
+		"""
+		Returns the most recent buffered records matching a full-text query.
+		
+		At most limit records selected by a filter are returned, oldest
+		first, followed by whether more were selected.
+		"""
+		first = self.nextSeq - len(self.buffer)
+		records = [ ]
+		more = False
+		# matches arrive newest first, so walk back through the buffer once
+		newer = reversed(self.buffer)
+		position = self.nextSeq
+		for seq in self.index.search(query):
+			if seq < first:
+				break
+			skip = position - seq - 1
+			record = next(islice(newer,skip,skip + 1))
+			position = seq
+			if filt.selects(record):
+				if len(records) == limit:
+					more = True
+					break
+				records.append(record)
+		records.reverse()
+		return (records,more)
 
-	def dump(self,filt):
-		items = ',\n\t'.join([r.json() for r in self.buffer if filt.selects(r)])
-		return '({"items":[' + items + ']})'
+	def dump(self,filt,cursor=None):
+		"""
+		Returns an update() wrapped for a JSON GET response.
+		"""
+		return '(' + self.update(filt,cursor) + ')'
+
+	def update(self,filt,cursor=None):
+		"""
+		Returns a JSON update of the records after a filter's cursor and advances it.
+		
+		The records pending for a subscribed filter that are still buffered
+		are drained. Otherwise, or if the client's cursor shows that it
+		missed our last update, the buffer is searched from the cursor
+		instead.
+		"""
+		if cursor is None or cursor > filt.cursor:
+			cursor = filt.cursor
+		if filt.pending is not None and cursor == filt.cursor:
+			oldest = self.nextSeq - len(self.buffer)
+			records = [r for r in filt.pending if r.seq >= oldest]
+		else:
+			records = [r for r in self.since(cursor) if filt.selects(r)]
+		if filt.pending is not None:
+			filt.pending.clear()
+		filt.cursor = self.nextSeq
+		items = ',\n\t'.join([r.json() for r in records])
+		return '{"items":[' + items + '],"cursor":%d}' % filt.cursor
 
 	def statusMessage(self):
 		msg = logging_pb2.Message()
 		msg.levelno = DEBUG
 		elapsed = datetime.now() - self.starttime
 		elapsed = timedelta(elapsed.days,elapsed.seconds)
-		msg.body = 'Server has been running %s and handled %u messages.' % (elapsed,self.msgCount) 
+		msg.body = 'Server has been running %s and handled %u messages.' % (elapsed,self.msgCount)
+		if self.sink is not None:
+			msg.body += ' Using ' + self.sink.stats() + '.'
+		if self.upstream is not None:
+			msg.body += ' Has ' + self.upstream.stats() + '.'
 		self.add(LogRecord(msg,self.hdr))
 
+class LevelPolicy(object):
+	"""
+	Decides the lowest level of record that producers should send from each source.
+	
+	A source is sent the level of the first rule whose pattern matches
+	it, or else our default level, unless a filter subscribed to our feed
+	wants a lower level from it. Producers that ask for levels in their
+	header are attached to us and sent our levels when they connect and
+	whenever they change. Changes made together are pushed together.
+	"""
+	clock = reactor
+
+	def __init__(self,feed,default=INFO):
+		self.feed = feed
+		feed.levels = self
+		self.default = default
+		# (pattern,levelno) tuples in the order they are checked
+		self.rules = [ ]
+		self.producers = set()
+		self.pending = None
+		self.pushes = 0
+		self.payload = self.encode()
+
+	def wanted(self):
+		"""
+		Returns the (pattern,levelno) tuples wanted by our feed's subscribers.
+		"""
+		wanted = [ ]
+		for (minLevel,patterns) in self.feed.subscribers.iteritems():
+			for pattern in patterns:
+				wanted.append((pattern,minLevel))
+		wanted.sort()
+		return wanted
+
+	def encode(self):
+		return encodeLevels(self.default,self.rules,self.wanted())
+
+	def setRule(self,pattern,levelno=None):
+		"""
+		Sets the level of a rule, adding it after our others if necessary.
+		
+		Removes the rule if levelno is None. Raises NamingException for an
+		invalid pattern.
+		"""
+		pattern = ResourceNamePattern(pattern)
+		for (index,(existing,level)) in enumerate(self.rules):
+			if existing == pattern:
+				if levelno is None:
+					del self.rules[index]
+				else:
+					self.rules[index] = (pattern,levelno)
+				break
+		else:
+			if levelno is not None:
+				self.rules.append((pattern,levelno))
+		self.changed()
+
+	def changed(self):
+		"""
+		Schedules our levels to be pushed to our producers if they have changed.
+		"""
+		if self.pending is None:
+			self.pending = self.clock.callLater(0,self.push)
+
+	def push(self):
+		self.pending = None
+		payload = self.encode()
+		if payload == self.payload:
+			return
+		self.payload = payload
+		self.pushes += 1
+		for producer in self.producers:
+			producer.sendLevels(payload)
+
+	def attach(self,producer):
+		self.producers.add(producer)
+		producer.sendLevels(self.payload)
+
+	def detach(self,producer):
+		self.producers.discard(producer)
+
+	def json(self):
+		def items(pairs):
+			return ','.join(['{"source":%s,"level":%s}' % (quote(pattern),quote(getLevelName(level)))
+				for (pattern,level) in pairs])
+		return ('{"default":%s,"rules":[%s],"wanted":[%s],"producers":%d}' %
+			(quote(getLevelName(self.default)),items(self.rules),items(self.wanted()),len(self.producers)))
+
 
 from tops.core.network.webserver import WebQuery,prepareWebServer
 
+class FeedWaiter(object):
+	"""
+	Holds a GET request for a subscribed filter until it has records to send.
+	
+	A long poll is answered with the first update that has records, or an
+	empty update after timeout seconds. A stream sends each update as a
+	server-sent event, and a comment every timeout seconds to keep the
+	connection alive, until the client disconnects. Records that arrive
+	together are sent together. A request is released without any records
+	if another request starts waiting on the same filter.
+	"""
+	clock = reactor
+
+	def __init__(self,request,feed,filt,timeout,stream=False):
+		self.request = request
+		self.feed = feed
+		self.filt = filt
+		self.stream = stream
+		self.scheduled = None
+		if filt.notify is not None:
+			# only one request can wait on a filter at a time
+			filt.notify(release=True)
+		filt.notify = self.wake
+		if stream:
+			self.timer = LoopingCall(self.keepalive)
+			self.timer.clock = self.clock
+			self.timer.start(timeout,now=False)
+		else:
+			self.timer = self.clock.callLater(timeout,self.deliver)
+		request.notifyFinish().addBoth(self.finished)
+
+	def wake(self,release=False):
+		if release:
+			self.release()
+		elif self.scheduled is None:
+			self.scheduled = self.clock.callLater(0,self.deliver)
+
+	def deliver(self,cursor=None):
+		"""
+		Sends the records after a cursor, or our filter's cursor by default.
+		"""
+		self.scheduled = None
+		if self.request is None:
+			return
+		update = self.feed.update(self.filt,cursor)
+		if self.stream:
+			self.request.write('id: %d\ndata: %s\n\n' % (self.filt.cursor,update.replace('\n','')))
+		else:
+			self.request.write('(' + update + ')')
+			self.request.finish()
+
+	def release(self):
+		if self.request is None:
+			return
+		if not self.stream:
+			self.request.write('({"items":[],"cursor":%d})' % self.filt.cursor)
+		self.request.finish()
+
+	def keepalive(self):
+		self.request.write(':\n\n')
+
+	def finished(self,result):
+		"""
+		Stops waiting once our request is finished or its client disconnects.
+		"""
+		self.request = None
+		if self.filt.notify == self.wake:
+			self.filt.notify = None
+		if self.scheduled is not None:
+			self.scheduled.cancel()
+			self.scheduled = None
+		if self.stream:
+			self.timer.stop()
+		elif self.timer.active():
+			self.timer.cancel()
+
 class FeedUpdate(WebQuery):
 	"""
 	Serves filtered updates from the site's FeedBuffer via JSON
 	responses to HTTP GET queries. Listens to POST queries to configure
 	the per-session filter.
+	
+	Each update includes the cursor to resume from. A GET query can pass
+	it back as a 'cursor' parameter, otherwise the session's filter
+	remembers where it left off. Filters are subscribed to the feed until
+	they are replaced or their session expires.
+	
+	Instead of polling, a client can pass a 'wait' parameter to be
+	answered as soon as there are records to send, or after that many
+	seconds, or an 'events' parameter to receive updates as a stream of
+	server-sent events.
 	"""
 	ServiceName = 'LOGGER'
 
+	# the longest that a GET can wait, and the keep-alive interval of a stream
+	maxWait = 30.0
+
 	def GET(self,request,session,state):
 		if not hasattr(state,'filter'):
 			print 'cannot serve GET requests before a filter has been specified'
 			return '({"items":[]})'
-		return session.site.feed.dump(state.filter)
+		feed = session.site.feed
+		filt = state.filter
+		try:
+			cursor = int(self.get_arg('cursor') or request.getHeader('last-event-id'))
+		except (TypeError,ValueError):
+			cursor = None
+		try:
+			wait = min(float(self.get_arg('wait',0)),self.maxWait)
+		except ValueError:
+			wait = 0
+		if self.get_arg('events') and filt.pending is not None:
+			request.setHeader('content-type','text/event-stream')
+			request.setHeader('cache-control','no-cache')
+			request.write('retry: 1000\n')
+			waiter = FeedWaiter(request,feed,filt,self.maxWait,stream=True)
+			if filt.pending or (cursor is not None and cursor < filt.cursor):
+				waiter.deliver(cursor)
+			return NOT_DONE_YET
+		if (wait <= 0 or filt.pending is None or filt.pending or
+			(cursor is not None and cursor < filt.cursor)):
+			return feed.dump(filt,cursor)
+		FeedWaiter(request,feed,filt,wait)
+		return NOT_DONE_YET
 		
 	def POST(self,request,session,state):
 		sourceFilter = self.get_arg('sourceFilter')
@@ -79,23 +498,222 @@ class FeedUpdate(WebQuery):
 		if not sourceFilter or not minLevel:
 			return 'ERROR'
 		else:
+			feed = session.site.feed
+			if hasattr(state,'filter'):
+				feed.unsubscribe(state.filter)
+			else:
+				session.notifyOnExpire(lambda: feed.unsubscribe(state.filter))
 			state.filter = LogFilter(sourceFilter,minLevel)
+			feed.subscribe(state.filter)
 			return 'OK'
 
+class IndexQuery(WebQuery):
+	"""
+	Searches the site's FeedBuffer via JSON responses to HTTP GET queries.
+	
+	The q parameter lists words that must all appear in the body or
+	exception of a record, with alternative lists separated by OR. The
+	sourceFilter and minLevel parameters select records as for a feed,
+	and at most limit of the most recent matches are returned, oldest
+	first, with "more" set if there were others.
+	"""
+	ServiceName = 'LOGGER'
+
+	def GET(self,request,session,state):
+		filt = LogFilter(self.get_arg('sourceFilter','*'),self.get_arg('minLevel','DEBUG'))
+		try:
+			limit = int(self.get_arg('limit',100))
+		except ValueError:
+			return 'ERROR'
+		(records,more) = session.site.feed.search(self.get_arg('q',''),filt,limit)
+		items = ',\n\t'.join([r.json() for r in records])
+		return '({"items":[' + items + '],"more":%s})' % ('true' if more else 'false')
+
+class RateQuery(WebQuery):
+	"""
+	Serves the rolling message rates of the site's FeedBuffer via JSON
+	responses to HTTP GET queries.
+	
+	Each item gives the number of records from a source prefix at one
+	level over the last second, minute and hour.
+	"""
+	ServiceName = 'LOGGER'
+
+	def GET(self,request,session,state):
+		return '(' + session.site.feed.rates.json(int(1000*time())) + ')'
+
+class StoreQuery(WebQuery):
+	"""
+	Searches the site's LogStore via JSON responses to HTTP GET queries.
+	
+	A query selects records using the same sourceFilter and minLevel
+	parameters as a feed, and optionally from t0 to t1 in milliseconds
+	since the epoch. At most limit records are returned, oldest first,
+	with "more" set if others were also selected. These are the newest
+	records selected if the newest parameter is set, so that a client
+	can page back through recent records. The response's cursor, if not
+	null, is passed back with the same query to fetch the next page.
+	"""
+	ServiceName = 'LOGGER'
+
+	def GET(self,request,session,state):
+		store = session.site.store
+		filt = LogFilter(self.get_arg('sourceFilter','*'),self.get_arg('minLevel','DEBUG'))
+		try:
+			t0 = self.get_arg('t0')
+			t0 = int(t0) if t0 else None
+			t1 = self.get_arg('t1')
+			t1 = int(t1) if t1 else None
+			limit = int(self.get_arg('limit',1000))
+			(items,more,cursor) = store.query(filt,t0,t1,limit,bool(self.get_arg('newest')),
+				self.get_arg('cursor'))
+		except ValueError:
+			return 'ERROR'
+		return '({"items":[' + ',\n\t'.join(items) + '],"more":%s,"cursor":%s})' % (
+			'true' if more else 'false',quote(cursor) if cursor else 'null')
+
+class TraceQuery(WebQuery):
+	"""
+	Lists the exception groups of the site's FeedBuffer via JSON
+	responses to HTTP GET queries.
+	
+	Up to limit groups are returned, most common first, each with the
+	text of its first traceback, its count, the timestamps in ms of its
+	first and last records, and the sources that logged them.
+	"""
+	ServiceName = 'LOGGER'
+
+	def GET(self,request,session,state):
+		try:
+			limit = int(self.get_arg('limit',100))
+		except ValueError:
+			return 'ERROR'
+		return '(' + session.site.feed.traces.json(limit) + ')'
+
+class LevelQuery(WebQuery):
+	"""
+	Serves and changes the site's LevelPolicy via HTTP GET and POST queries.
+	
+	A GET query returns the policy's default level, its rules, the
+	levels wanted by feed subscribers and the number of producers that
+	follow them, as JSON. A POST query sets the level of the rule for a
+	sourceFilter pattern to minLevel, or removes the rule if minLevel is
+	empty, and the change is pushed to producers without restarting them.
+	"""
+	ServiceName = 'LOGGER'
+
+	def GET(self,request,session,state):
+		return '(' + session.site.levels.json() + ')'
+
+	def POST(self,request,session,state):
+		sourceFilter = self.get_arg('sourceFilter')
+		minLevel = self.get_arg('minLevel')
+		if not sourceFilter:
+			return 'ERROR'
+		if minLevel:
+			levelno = getLevelName(minLevel)
+			if not isinstance(levelno,int):
+				return 'ERROR'
+		else:
+			levelno = None
+		try:
+			session.site.levels.setRule(sourceFilter,levelno)
+		except NamingException:
+			return 'ERROR'
+		return 'OK'
+
 
 from tops.core.network.server import Server
+import tops.core.network.framing as framing
 
 class LogServer(Server):
 	"""
 	Receives log messages from local and remote clients and feeds them into a central buffer.
+	
+	Keeps track of the templates registered by our client. Prints each
+	record to our own log unless our factory's echo attribute is False,
+	e.g. because the records are written by a FileSink instead. A client
+	that asks for levels is attached to our factory's LevelPolicy, if it
+	has one.
+	
+	The exception of a message that has an exception_id is remembered
+	for the rest of the connection, for up to maxExceptions exceptions,
+	and acknowledged to a client that omits acknowledged exceptions, so
+	that its later messages can send just the id.
 	"""
 	Header = logging_pb2.Header
 	Message = logging_pb2.Message
-	
+
+	def __init__(self):
+		Server.__init__(self)
+		self.templates = { }
+		self.levels = None
+		# exceptions by id that have been sent on this connection
+		self.exceptions = { }
+
+	# the most exceptions that we remember for one connection
+	maxExceptions = 1000
+
+	def handleHeader(self,hdr):
+		policy = getattr(self.factory,'levels',None)
+		if hdr.levels and policy is not None and self.transport is not None:
+			self.levels = policy
+			policy.attach(self)
+
+	def sendLevels(self,payload):
+		self.transport.write(framing.encodeControl(framing.CONTROL_LEVELS,payload))
+
+	def connectionLost(self,reason):
+		if self.levels is not None:
+			self.levels.detach(self)
+			self.levels = None
+		Server.connectionLost(self,reason)
+
+	def templateFor(self,msg):
+		"""
+		Returns the template of a message, registering it if necessary, or None.
+		"""
+		if not msg.HasField('template_id'):
+			return None
+		if msg.HasField('template'):
+			self.templates[msg.template_id] = msg.template
+			return msg.template
+		try:
+			return self.templates[msg.template_id]
+		except KeyError:
+			return '(unregistered template %d)' % msg.template_id
+
+	def expandException(self,msg):
+		"""
+		Remembers the exception of a message or fills it in from its id.
+		"""
+		if not msg.exception_id:
+			return
+		if msg.HasField('exception'):
+			if msg.exception_id not in self.exceptions and len(self.exceptions) < self.maxExceptions:
+				self.exceptions[msg.exception_id] = msg.exception
+				if self.hdr.exception_ids:
+					self.transport.write(framing.encodeControl(framing.CONTROL_EXCEPTION,str(msg.exception_id)))
+		else:
+			msg.exception = self.exceptions.get(msg.exception_id,
+				'(unacknowledged exception %s)' % msg.exception_id)
+
 	def handleMessage(self,msg):
-		record = LogRecord(msg,self.hdr)
+		self.expandException(msg)
+		record = LogRecord(msg,self.hdr,self.templateFor(msg))
 		self.factory.feed.add(record)
-		print record
+		if getattr(self.factory,'echo',True):
+			print record
+
+	def summarizeMessage(self,msg):
+		self.expandException(msg)
+		record = LogRecord(msg,self.hdr,self.templateFor(msg))
+		if getattr(self.factory,'echo',True):
+			print record
+		return record.compact()
+
+	def applyMessage(self,summary):
+		self.factory.feed.add(LogRecord.expand(summary))
 
 
 def initialize():
@@ -109,33 +727,113 @@ def initialize():
 	
 	# load our run-time configuration
 	import tops.core.utility.config as config
+	import tops.core.utility.options as options
+	import tops.core.network.ingest as ingest
+	from tops.core.network.logging.store import LogStore
+	from tops.core.network.logging.index import TextIndex
+	from tops.core.network.logging.sink import FileSink
+	from tops.core.network.logging.traces import TraceStore
+	import tops.core.network.logging.upstream as upstream
 	verbose = config.initialize()
+	worker = options.get('worker')
 
 	# use file-based logging for ourself (print statements are automatically redirected)
 	logpath = config.getfilename('logger','logfile')
 	if not logpath or logpath == 'stdout':
 		log.startLogging(sys.stdout)
 	else:
+		if worker is not None:
+			logpath += '-worker%d' % worker
 		(logpath,logfile) = os.path.split(logpath)
 		log.startLogging(LogFile(logfile,logpath))
 
 	print 'Executing',__file__,'as PID',os.getpid()
 	try:
+		factory = Factory()
+		factory.protocol = LogServer
+		factory.section = 'logger'
+		factory.shm_dir = config.get('logger','shm_dir')
+		# records are written by our sink instead of being printed, if we have one
+		factory.echo = not config.getboolean('logger','sink')
+		
+		# an ingest worker only decodes messages for our coordinator
+		if worker is not None:
+			ingest.startWorker('logger',factory,worker)
+			reactor.run()
+			return
+
 		# create a record buffer to connect our feed watchers to our clients
-		feed = FeedBuffer()
+		feed = FeedBuffer(config.getint('logger','feed_depth') or 100,
+			config.getint('logger','feed_bytes') or 0)
+		feed.rates = MessageRates(config.getint('logger','rates_depth') or 2)
+
+		# optionally keep every record on disk too
+		handlers = {"feed":FeedUpdate(),"rates":RateQuery()}
+		properties = {"feed":feed}
+		if config.getboolean('logger','store'):
+			store = LogStore(config.getfilename('logger','store_dir'),
+				config.getint('logger','store_bytes'),config.getint('logger','store_segment'))
+			print 'Storing records in',store.directory
+			feed.store = store
+			LoopingCall(store.flush).start(1.0,now=False)
+			reactor.addSystemEventTrigger('before','shutdown',store.close)
+			handlers['query'] = StoreQuery()
+			properties['store'] = store
+		elif config.getboolean('logger','spill'):
+			# the store would already have the records that leave our feed
+			spill = LogStore(config.getfilename('logger','spill_dir'),
+				config.getint('logger','spill_bytes'),config.getint('logger','spill_segment'))
+			print 'Spilling records from memory to',spill.directory
+			feed.spill = spill
+			LoopingCall(spill.flush).start(1.0,now=False)
+			reactor.addSystemEventTrigger('before','shutdown',spill.close)
+			handlers['query'] = StoreQuery()
+			properties['store'] = spill
+		if not factory.echo:
+			sink = FileSink(config.getfilename('logger','sink_path'),
+				config.getint('logger','sink_bytes'),config.getint('logger','sink_age'),
+				config.getboolean('logger','sink_gzip'),config.getint('logger','sink_queue'))
+			print 'Writing records to',sink.path
+			feed.sink = sink
+			# withhold credit from flow controlled producers while the sink is behind
+			factory.overloaded = sink.overloaded
+			reactor.addSystemEventTrigger('before','shutdown',sink.close)
+		if config.getboolean('logger','index'):
+			feed.index = TextIndex()
+			handlers['search'] = IndexQuery()
+		if config.getboolean('logger','exceptions'):
+			feed.traces = TraceStore(config.getint('logger','exception_groups') or 10000)
+			handlers['exceptions'] = TraceQuery()
+
+		# optionally tell our producers which levels to send
+		if config.getboolean('logger','push_levels'):
+			default = getLevelName(config.get('logger','push_default') or 'INFO')
+			if not isinstance(default,int):
+				raise ValueError('invalid push_default level')
+			factory.levels = LevelPolicy(feed,default)
+			handlers['levels'] = LevelQuery()
+			properties['levels'] = factory.levels
+
+		# optionally forward our records to a central logging server
+		feed.upstream = upstream.connect()
+		if feed.upstream is not None:
+			print 'Forwarding records upstream as',feed.upstream.prefix
+			reactor.addSystemEventTrigger('before','shutdown',feed.upstream.close)
 
 		# initialize socket servers to listen for local and network log message producers
-		factory = Factory()
-		factory.protocol = LogServer
 		factory.feed = feed
-		reactor.listenTCP(config.getint('logger','tcp_port'),factory)
+		workers = config.getint('logger','workers')
+		if workers:
+			ingest.startCoordinator('logger',factory,workers)
+		else:
+			reactor.listenTCP(config.getint('logger','tcp_port'),factory)
 		reactor.listenUNIX(config.getfilename('logger','unix_addr'),factory)
 
 		# initialize an HTTP server to handle feed watcher requests via http
 		prepareWebServer(
 			portNumber = config.getint('logger','http_port'),
-			handlers = {"feed":FeedUpdate()},
-			properties = {"feed":feed},
+			handlers = handlers,
+			properties = properties,
 			filterLogs = True
 		)
 
@@ -149,5 +847,378 @@ def initialize():
 		#reactor.stop()
 		raise
 
+
+import unittest
+
+class FeedBufferTests(unittest.TestCase):
+	def feed(self,count,maxdepth=100):
+		feed = FeedBuffer(maxdepth)
+		for index in range(count):
+			msg = logging_pb2.Message()
+			msg.levelno = 30
+			msg.body = 'message %d' % index
+			record = LogRecord(msg,feed.hdr)
+			# records that share a timestamp must not be lost
+			record.tstamp = 123000
+			feed.add(record)
+		return feed
+	def test00(self):
+		"""A cursor only returns the records added after it"""
+		feed = self.feed(5)
+		filt = LogFilter('*','WARNING')
+		self.assertEqual(feed.dump(filt).count('"body":'),5)
+		self.assertEqual(filt.cursor,feed.nextSeq)
+		self.assertEqual(feed.dump(filt),'({"items":[],"cursor":%d})' % feed.nextSeq)
+		feed.add(feed.buffer[-1])
+		self.assertEqual(feed.dump(filt).count('"body":"message 4"'),1)
+	def test01(self):
+		"""A cursor that has fallen off the tail returns the whole buffer"""
+		feed = self.feed(20,maxdepth=8)
+		self.assertEqual([r.body for r in feed.since(3)],['message %d' % i for i in range(12,20)])
+		self.assertEqual([r.seq for r in feed.since(feed.nextSeq - 2)],[feed.nextSeq - 2,feed.nextSeq - 1])
+		self.assertEqual(feed.since(feed.nextSeq),[])
+	def test02(self):
+		"""Subscribed filters collect the records they select"""
+		feed = self.feed(3)
+		filters = [LogFilter('*','DEBUG'),LogFilter('tcc.*','WARNING'),LogFilter('tcc.*','WARNING')]
+		for filt in filters:
+			feed.subscribe(filt)
+		self.assertEqual(len(feed.subscribers[30]),1)
+		for (source,levelno) in (('tcc',30),('tcc.axis',10),('tcc.axis',40),('tcc.axis',40)):
+			msg = logging_pb2.Message()
+			msg.levelno = levelno
+			msg.body = 'update'
+			msg.source = source.split('.',1)[-1] if '.' in source else ''
+			hdr = logging_pb2.Header()
+			hdr.name = source.split('.')[0]
+			feed.add(LogRecord(msg,hdr))
+		self.assertEqual(len(feed.routes),3)
+		self.assertEqual(feed.dump(filters[0]).count('"body":'),8)
+		self.assertEqual(feed.dump(filters[1]).count('"body":'),2)
+		self.assertEqual(feed.dump(filters[1]).count('"body":'),0)
+		# a client that missed an update can rewind its cursor
+		self.assertEqual(feed.dump(filters[2],feed.nextSeq - 2).count('"body":'),2)
+		feed.unsubscribe(filters[1])
+		feed.unsubscribe(filters[2])
+		self.assertEqual(filters[2].pending,None)
+		self.assertEqual(feed.subscribers.keys(),[10])
+	def request(self,**args):
+		from twisted.web.test.requesthelper import DummyRequest
+		request = DummyRequest([''])
+		request.args = dict((name,[str(value)]) for (name,value) in args.iteritems())
+		return request
+	def add(self,feed,count=1):
+		for index in range(count):
+			msg = logging_pb2.Message()
+			msg.levelno = 30
+			msg.body = 'pushed'
+			feed.add(LogRecord(msg,feed.hdr))
+	def test05(self):
+		"""Buffered records are found with a full-text index"""
+		from tops.core.network.logging.index import TextIndex
+		feed = FeedBuffer(50)
+		feed.index = TextIndex()
+		feed.index.sweepInterval = 10
+		for index in range(200):
+			msg = logging_pb2.Message()
+			msg.levelno = (20,30)[index % 2]
+			msg.body = 'exposure %d %s' % (index,'AzStat' if index % 3 == 0 else 'done')
+			feed.add(LogRecord(msg,feed.hdr))
+		(records,more) = feed.search('azstat',LogFilter('*','WARNING'),limit=3)
+		self.assertEqual([r.body for r in records],['exposure %d AzStat' % i for i in (183,189,195)])
+		self.assertEqual(more,True)
+		(records,more) = feed.search('exposure 149 OR exposure 151 OR 10',LogFilter('*','INFO'))
+		self.assertEqual(([r.body for r in records],more),(['exposure 151 done'],False))
+		self.assertTrue(len(feed.index.postings) < 80)
+	def test03(self):
+		"""A long poll is answered when records arrive or it times out"""
+		from twisted.internet.task import Clock
+		FeedWaiter.clock = clock = Clock()
+		try:
+			feed = self.feed(2)
+			filt = LogFilter('*','WARNING')
+			feed.subscribe(filt)
+			self.assertEqual(feed.dump(filt).count('"body":'),2)
+			from tops.core.network.webserver import SessionState
+			request = self.request(wait=10)
+			handler = FeedUpdate()
+			handler.args = request.args
+			session = SessionState()
+			session.site = SessionState()
+			session.site.feed = feed
+			state = SessionState()
+			state.filter = filt
+			self.assertEqual(handler.GET(request,session,state),NOT_DONE_YET)
+			self.add(feed,3)
+			self.assertEqual(request.finished,0)
+			clock.advance(0)
+			self.assertEqual(request.finished,1)
+			self.assertEqual(''.join(request.written).count('"body":"pushed"'),3)
+			self.assertEqual(filt.notify,None)
+			request = self.request()
+			FeedWaiter(request,feed,filt,10)
+			clock.advance(10)
+			self.assertEqual(''.join(request.written),'({"items":[],"cursor":%d})' % feed.nextSeq)
+			# a waiting request is released by the next one
+			first = self.request()
+			FeedWaiter(first,feed,filt,10)
+			second = self.request()
+			FeedWaiter(second,feed,filt,10)
+			self.add(feed)
+			clock.advance(0)
+			self.assertEqual(''.join(first.written).count('"body":'),0)
+			self.assertEqual(''.join(second.written).count('"body":'),1)
+			self.assertEqual(clock.getDelayedCalls(),[])
+		finally:
+			FeedWaiter.clock = reactor
+	def test04(self):
+		"""A stream sends records as events until its client disconnects"""
+		from twisted.internet.task import Clock
+		FeedWaiter.clock = clock = Clock()
+		try:
+			feed = self.feed(0)
+			filt = LogFilter('*','WARNING')
+			feed.subscribe(filt)
+			request = self.request()
+			FeedWaiter(request,feed,filt,30,stream=True)
+			self.add(feed,2)
+			clock.advance(0)
+			self.add(feed)
+			clock.advance(30)
+			events = ''.join(request.written).split('\n\n')
+			self.assertEqual(events[0],'id: %d\ndata: {"items":[%s],"cursor":%d}' %
+				(feed.nextSeq - 1,',\n\t'.join(r.json() for r in list(feed.buffer)[-3:-1]).replace('\n',''),feed.nextSeq - 1))
+			self.assertTrue(events[1].startswith('id: %d\ndata: ' % feed.nextSeq))
+			self.assertEqual(events[2:],[':',''])
+			request.processingFailed(Exception('disconnected'))
+			self.assertEqual((filt.notify,clock.getDelayedCalls()),(None,[]))
+		finally:
+			FeedWaiter.clock = reactor
+	def test06(self):
+		"""Producers are pushed the levels wanted by rules and feed subscribers"""
+		from twisted.internet.task import Clock
+		from twisted.test.proto_helpers import StringTransport
+		from twisted.python.failure import Failure
+		from twisted.internet.error import ConnectionDone
+		from tops.core.network.webserver import SessionState
+		from levels import LevelThresholds
+		from json import loads
+		LevelPolicy.clock = clock = Clock()
+		try:
+			feed = self.feed(0)
+			factory = Factory()
+			factory.levels = LevelPolicy(feed)
+			protocol = LogServer()
+			protocol.factory = factory
+			protocol.makeConnection(StringTransport())
+			hdr = logging_pb2.Header()
+			hdr.name = 'tcc'
+			hdr.levels = True
+			protocol.handleHeader(hdr)
+			def pushed():
+				(controls,remaining) = framing.decodeControls(protocol.transport.value())
+				protocol.transport.clear()
+				return [LevelThresholds(payload,'tcc') for (opcode,payload) in controls
+					if opcode == framing.CONTROL_LEVELS]
+			self.assertEqual([levels.threshold('axis') for levels in pushed()],[20])
+			factory.levels.setRule('tcc.*',30)
+			filt = LogFilter('tcc.axis','DEBUG')
+			feed.subscribe(filt)
+			self.assertEqual(pushed(),[])
+			clock.advance(0)
+			self.assertEqual([(levels.threshold('axis'),levels.threshold('listener'),levels.threshold('root'))
+				for levels in pushed()],[(10,30,20)])
+			# levels that have not changed are not pushed again
+			feed.unsubscribe(filt)
+			feed.subscribe(filt)
+			clock.advance(0)
+			self.assertEqual((pushed(),factory.levels.pushes),([],1))
+			# rules can be changed via the web server
+			handler = LevelQuery()
+			session = SessionState()
+			session.site = SessionState()
+			session.site.levels = factory.levels
+			handler.args = self.request(sourceFilter='tcc.*',minLevel='').args
+			self.assertEqual(handler.POST(None,session,None),'OK')
+			handler.args = self.request(sourceFilter='tcc.*',minLevel='LOUD').args
+			self.assertEqual(handler.POST(None,session,None),'ERROR')
+			clock.advance(0)
+			self.assertEqual([levels.threshold('listener') for levels in pushed()],[20])
+			self.assertEqual(loads(handler.GET(None,session,None)[1:-1]),{'default':'INFO','rules':[],
+				'wanted':[{'source':'tcc.axis','level':'DEBUG'}],'producers':1})
+			protocol.connectionLost(Failure(ConnectionDone()))
+			self.assertEqual(factory.levels.producers,set())
+		finally:
+			LevelPolicy.clock = reactor
+	def test07(self):
+		"""Acknowledged exceptions are expanded and grouped by fingerprint"""
+		from twisted.test.proto_helpers import StringTransport
+		from tops.core.network.logging.traces import TraceStore,digest
+		from tops.core.network.webserver import SessionState
+		from json import loads
+		feed = self.feed(0)
+		feed.traces = TraceStore()
+		factory = Factory()
+		factory.feed = feed
+		factory.echo = False
+		protocol = LogServer()
+		protocol.factory = factory
+		protocol.makeConnection(StringTransport())
+		protocol.hdr.name = 'tcc'
+		protocol.hdr.exception_ids = True
+		trace = 'Traceback (most recent call last):\n  File "x.py", line %d, in run\nValueError: bad\n'
+		for (line,full) in ((1,True),(1,False),(2,True),(2,True)):
+			msg = logging_pb2.Message()
+			msg.levelno = 40
+			msg.body = 'failed'
+			msg.exception_id = digest(trace % line)
+			if full:
+				msg.exception = trace % line
+			protocol.handleMessage(msg)
+		(controls,remaining) = framing.decodeControls(protocol.transport.value())
+		self.assertEqual(controls,[(framing.CONTROL_EXCEPTION,digest(trace % 1)),
+			(framing.CONTROL_EXCEPTION,digest(trace % 2))])
+		self.assertEqual([loads(r.json())['exception'] for r in feed.buffer if r.source == 'tcc'],
+			[trace % i for i in (1,1,2,2)])
+		handler = TraceQuery()
+		handler.args = self.request(limit=5).args
+		session = SessionState()
+		session.site = SessionState()
+		session.site.feed = feed
+		update = loads(handler.GET(None,session,None)[1:-1])
+		self.assertEqual([(item['type'],item['count'],item['sources']) for item in update['items']],
+			[('ValueError',4,['tcc'])])
+	def test08(self):
+		"""Records beyond our memory limit spill to disk where they can be paged through"""
+		import tempfile,shutil
+		from tops.core.network.logging.store import LogStore
+		from tops.core.network.webserver import SessionState
+		from json import loads
+		directory = tempfile.mkdtemp()
+		try:
+			feed = FeedBuffer(1000,maxbytes=20000)
+			feed.spill = LogStore(directory,max_bytes=1 << 20,segment_bytes=8192)
+			for index in range(200):
+				msg = logging_pb2.Message()
+				msg.levelno = 30
+				msg.body = 'record %d %s' % (index,'x'*(1000 if index % 50 == 0 else 10))
+				feed.add(LogRecord(msg,feed.hdr))
+			self.assertTrue(feed.nbytes <= 20000)
+			self.assertEqual(feed.nbytes,sum(len(r.encoded) + feed.recordOverhead for r in feed.buffer))
+			self.assertEqual(feed.spill.stored + len(feed.buffer),feed.nextSeq)
+			oldest = feed.buffer[0].body
+			handler = StoreQuery()
+			session = SessionState()
+			session.site = SessionState()
+			session.site.store = feed.spill
+			handler.args = self.request(limit=3,newest=1).args
+			update = loads(handler.GET(None,session,None)[1:-1])
+			self.assertEqual(update['more'],True)
+			self.assertEqual([int(item['body'].split()[1]) for item in update['items']],
+				[int(oldest.split()[1]) - i for i in (3,2,1)])
+			handler.args = self.request(limit=3,newest=1,cursor=update['cursor']).args
+			update = loads(handler.GET(None,session,None)[1:-1])
+			self.assertEqual([int(item['body'].split()[1]) for item in update['items']],
+				[int(oldest.split()[1]) - i for i in (6,5,4)])
+			# the newest record is kept however large it is
+			msg = logging_pb2.Message()
+			msg.levelno = 30
+			msg.body = 'y'*30000
+			feed.add(LogRecord(msg,feed.hdr))
+			self.assertEqual([r.body for r in feed.buffer],[msg.body])
+			feed.spill.close()
+		finally:
+			shutil.rmtree(directory)
+	def test10(self):
+		"""Producers stop receiving credit while the file sink falls behind"""
+		import os,tempfile,shutil,threading,time
+		from twisted.internet.protocol import Factory
+		from twisted.internet.task import Clock
+		from twisted.test.proto_helpers import StringTransport
+		from tops.core.network.logging.sink import FileSink
+		release = threading.Event()
+		class SlowSink(FileSink):
+			def write(self,records):
+				release.wait(5)
+				return FileSink.write(self,records)
+		directory = tempfile.mkdtemp()
+		try:
+			sink = SlowSink(os.path.join(directory,'records'),maxqueue=8,delay=0)
+			factory = Factory()
+			factory.feed = FeedBuffer()
+			factory.feed.sink = sink
+			factory.overloaded = sink.overloaded
+			factory.echo = False
+			server = LogServer()
+			server.factory = factory
+			server.clock = Clock()
+			server.makeConnection(StringTransport())
+			hdr = logging_pb2.Header()
+			hdr.name = 'tcc'
+			hdr.credit_frames = 4
+			msg = logging_pb2.Message()
+			msg.levelno = 30
+			msg.body = 'slow'
+			server.dataReceived(''.join(framing.encodeFrames(framing.legacy,[hdr.SerializeToString()])))
+			def send(count):
+				server.dataReceived(''.join(framing.encodeFrames(framing.legacy,[msg.SerializeToString()]*count)))
+			# the sink starts writing the first record and then stalls
+			send(1)
+			deadline = time.time() + 5
+			while len(sink.queue) and time.time() < deadline:
+				time.sleep(0.01)
+			send(3)
+			self.assertEqual((server.grants,server.creditPauses),(2,0))
+			send(4)
+			server.clock.advance(1)
+			self.assertEqual((server.grants,server.creditPauses),(2,1))
+			granted = server.transport.value()
+			send(2)
+			server.clock.advance(1)
+			self.assertEqual(server.transport.value(),granted)
+			# credit is granted again once the sink catches up
+			release.set()
+			self.assertEqual(sink.flush(5),True)
+			server.clock.advance(server.overloadInterval)
+			self.assertEqual(server.grants,3)
+			self.assertTrue(len(server.transport.value()) > len(granted))
+			sink.close()
+		finally:
+			shutil.rmtree(directory)
+	def test09(self):
+		"""A parked subscriber only holds records that are still buffered"""
+		import tempfile,shutil
+		from tops.core.network.logging.store import LogStore
+		from json import loads
+		directory = tempfile.mkdtemp()
+		try:
+			feed = FeedBuffer(1000,maxbytes=20000)
+			feed.spill = LogStore(directory,max_bytes=1 << 20,segment_bytes=8192)
+			parked = LogFilter('*','WARNING')
+			feed.subscribe(parked)
+			quiet = LogFilter('*','ERROR')
+			feed.subscribe(quiet)
+			msg = logging_pb2.Message()
+			msg.levelno = 40
+			msg.body = 'evicted'
+			feed.add(LogRecord(msg,feed.hdr))
+			for index in range(500):
+				msg = logging_pb2.Message()
+				msg.levelno = 30
+				msg.body = 'record %d %s' % (index,'x'*100)
+				feed.add(LogRecord(msg,feed.hdr))
+			self.assertTrue(len(parked.pending) < 500)
+			self.assertEqual(parked.pending[-1].decoded,None)
+			self.assertTrue(sum(len(r.encoded) + feed.recordOverhead for r in parked.pending) <= feed.maxbytes)
+			self.assertEqual([r.seq for r in parked.pending],[r.seq for r in feed.buffer])
+			update = loads(feed.update(parked))
+			self.assertEqual(update['items'][0]['body'],feed.buffer[0].body)
+			# an evicted record is dropped when its filter is drained
+			self.assertEqual(len(quiet.pending),1)
+			self.assertEqual(loads(feed.update(quiet))['items'],[ ])
+			feed.spill.close()
+		finally:
+			shutil.rmtree(directory)
+
 if __name__ == '__main__':
 	initialize()
@@ -0,0 +1,267 @@
+"""
+Asynchronous file sink for log records
+
+The logging server can write the records that it handles to a file from
+a background thread, instead of printing each one to its own log from
+the reactor thread, so that a slow disk cannot stall the handling of new
+records. Records are queued as they are handled and written in batches.
+The file is rotated when it reaches a maximum size or age, and rotated
+files can be compressed with gzip.
+"""
+
+## @package tops.core.network.logging.sink
+# Asynchronous file sink for log records
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os
+import os.path
+import time
+import gzip
+import shutil
+
+from tops.core.network.client import BoundedQueue,Flusher
+
+class FileSink(object):
+	"""
+	Writes log records to a file in batches from a background thread.
+
+	Records are formatted as they would be printed. Up to maxqueue
+	records wait to be written, and the oldest are dropped when the
+	queue is full. Each batch is written with one write, after waiting
+	up to delay seconds for minbytes of records to accumulate. The file
+	is rotated before it would exceed max_bytes or once it is max_age
+	seconds old, if either is positive, and the rotated file is renamed
+	with the time of rotation and optionally compressed.
+
+	Our consumers are overloaded while at least half of maxqueue records
+	are waiting, so that flow controlled producers can be slowed down
+	before records are dropped.
+
+	The written, rotated and errors attributes count records written,
+	files rotated and failed writes or rotations. A file that cannot be
+	renamed keeps being written to, a file that cannot be written to is
+	reopened for the next batch, and the lost attribute counts the
+	records that could not be written.
+	"""
+	def __init__(self,path,max_bytes=0,max_age=0,compress=False,maxqueue=100000,
+		delay=0.5,minbytes=65536):
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		self.path = path
+		self.maxBytes = max_bytes
+		self.maxAge = max_age
+		self.compress = compress
+		self.file = None
+		self.written = 0
+		self.rotated = 0
+		self.errors = 0
+		self.lost = 0
+		self.open()
+		self.queue = BoundedQueue(maxqueue,BoundedQueue.DROP_OLDEST)
+		self.flusher = Flusher(self.queue,self.write,delay,minbytes)
+
+	def open(self):
+		self.file = open(self.path,'ab')
+		self.size = self.file.tell()
+		self.opened = time.time()
+
+	def closeFile(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def failed(self,e):
+		self.errors += 1
+		if self.errors == 1:
+			print 'Unable to write log records to %s: %s' % (self.path,e)
+
+	def put(self,record):
+		"""
+		Queues a record to be written.
+		"""
+		self.queue.put(record)
+
+	def overloaded(self):
+		"""
+		Returns True if records are arriving faster than we can write them.
+		"""
+		return 2*len(self.queue) >= self.queue.maxsize
+
+	def write(self,records):
+		"""
+		Writes a batch of records, rotating our file first if necessary.
+
+		Reopens our file first if an earlier write failed, and closes it
+		after the last batch once our queue has been closed.
+		"""
+		lines = [ ]
+		for record in records:
+			lines.append(unicode(record).encode('utf-8'))
+		lines.append('')
+		data = '\n'.join(lines)
+		try:
+			if self.file is None:
+				self.open()
+			if ((self.maxBytes > 0 and self.size > 0 and self.size + len(data) > self.maxBytes) or
+				(self.maxAge > 0 and time.time() - self.opened >= self.maxAge)):
+				self.rotate()
+			self.file.write(data)
+			self.file.flush()
+			self.size += len(data)
+			self.written += len(records)
+		except (IOError,OSError,ValueError),e:
+			self.lost += len(records)
+			self.failed(e)
+			# start again with a new file object for the next batch
+			try:
+				self.closeFile()
+			except (IOError,OSError):
+				self.file = None
+		if self.queue.closed and not len(self.queue):
+			# nothing more can be queued, so this was our last batch
+			self.closeFile()
+		return True
+
+	def rotate(self):
+		"""
+		Renames our file with the current time and starts a new one.
+
+		Continues with the same file if it cannot be renamed.
+		"""
+		self.closeFile()
+		rotated = self.path + time.strftime('.%Y%m%d-%H%M%S')
+		serial = 0
+		while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+			serial += 1
+			rotated = self.path + time.strftime('.%Y%m%d-%H%M%S') + '-%d' % serial
+		try:
+			os.rename(self.path,rotated)
+		except OSError,e:
+			self.failed(e)
+			self.open()
+			return
+		self.open()
+		self.rotated += 1
+		if self.compress:
+			try:
+				source = open(rotated,'rb')
+				try:
+					target = gzip.open(rotated + '.gz','wb')
+					try:
+						shutil.copyfileobj(source,target)
+					finally:
+						target.close()
+				finally:
+					source.close()
+				os.unlink(rotated)
+			except (IOError,OSError),e:
+				# the rotated file is kept uncompressed
+				self.failed(e)
+
+	def depth(self):
+		"""
+		Returns the number of records waiting to be written.
+		"""
+		return len(self.queue)
+
+	def stats(self):
+		return ('sink queue %d (max %d), %d written, %d dropped, %d lost, %d write errors' %
+			(len(self.queue),self.queue.maxDepth,self.written,self.queue.dropped,self.lost,self.errors))
+
+	def flush(self,timeout=None):
+		"""
+		Waits until every record queued so far has been written.
+		"""
+		return self.queue.join(timeout)
+
+	def close(self,timeout=5.0):
+		"""
+		Writes any queued records and closes our file.
+
+		Returns False if our flusher is still writing after timeout
+		seconds, in which case it closes our file when it finishes.
+		"""
+		self.queue.close()
+		self.flusher.join(timeout)
+		if self.flusher.isAlive():
+			return False
+		self.closeFile()
+		return True
+
+
+import unittest
+import tempfile
+
+class FileSinkTests(unittest.TestCase):
+	class Record(object):
+		def __init__(self,text):
+			self.text = text
+		def __str__(self):
+			return self.text
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory,'log','records')
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	def test00(self):
+		"""Records are written in batches and flushed on close"""
+		sink = FileSink(self.path,delay=0.1,minbytes=1 << 20)
+		for index in range(1000):
+			sink.put(self.Record(u'record %d \u00b5s' % index))
+		self.assertTrue(sink.depth() > 0)
+		sink.close()
+		lines = open(self.path).read().splitlines()
+		self.assertEqual(len(lines),1000)
+		self.assertEqual(lines[-1],u'record 999 \u00b5s'.encode('utf-8'))
+		self.assertEqual((sink.written,sink.errors),(1000,0))
+	def test01(self):
+		"""Files are rotated by size and compressed"""
+		sink = FileSink(self.path,max_bytes=4096,compress=True,delay=0)
+		for index in range(2000):
+			sink.put(self.Record('record %04d' % index))
+			if index % 100 == 99:
+				self.assertEqual(sink.flush(5.0),True)
+		sink.close()
+		def order(name):
+			# records.<date>-<time>[-<serial>].gz
+			parts = name[:-3].split('-')
+			return (parts[1],int(parts[2]) if len(parts) > 2 else 0)
+		rotated = sorted((name for name in os.listdir(os.path.dirname(self.path)) if name.endswith('.gz')),key=order)
+		self.assertEqual(len(rotated),sink.rotated)
+		self.assertTrue(sink.rotated >= 5)
+		lines = [ ]
+		for name in rotated:
+			f = gzip.open(os.path.join(os.path.dirname(self.path),name))
+			data = f.read()
+			f.close()
+			self.assertTrue(len(data) <= 4096)
+			lines.extend(data.splitlines())
+		lines.extend(open(self.path).read().splitlines())
+		self.assertEqual(lines,['record %04d' % index for index in range(2000)])
+	def test02(self):
+		"""Failed rotations and writes lose records without stopping the sink"""
+		sink = FileSink(self.path,max_bytes=100,delay=0)
+		sink.put(self.Record('first'))
+		self.assertEqual(sink.flush(5.0),True)
+		# our file can neither be renamed nor reopened
+		shutil.rmtree(os.path.dirname(self.path))
+		sink.put(self.Record('x'*100))
+		self.assertEqual(sink.flush(5.0),True)
+		self.assertEqual((sink.lost,sink.rotated,sink.file,sink.flusher.isAlive()),(1,0,None,True))
+		os.makedirs(os.path.dirname(self.path))
+		for index in range(3):
+			sink.put(self.Record('record %d' % index))
+			self.assertEqual(sink.flush(5.0),True)
+		self.assertEqual(sink.close(),True)
+		self.assertEqual(sink.file,None)
+		self.assertEqual((sink.written,sink.lost),(4,1))
+		self.assertEqual(open(self.path).read(),'record 0\nrecord 1\nrecord 2\n')
+		self.assertEqual(sink.errors,2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,590 @@
+"""
+Persistent segmented storage of log records
+
+The logging server can append every record that it handles to a store on
+disk, so that records which have left its in-memory feed buffer can
+still be searched by time, level and source. A store is a directory of
+append-only segment files that are rotated when they reach a fixed size,
+with the oldest segments removed when the store would otherwise exceed
+its cap on disk usage.
+
+Each stored record is a binary header, giving its length, timestamp,
+level and the number of its source in the store's dictionary of source
+names, followed by the end of its JSON encoding. The rest of its JSON
+is rebuilt from the header when the record is read back. Records are
+stored in the order they arrive with their own timestamps, which need
+not increase, e.g. for records replayed from a spool, forwarded from
+another server, or sent by a producer whose clock is wrong. A segment
+is searched with a sparse index of the offsets of records at regular
+intervals, each with the latest timestamp of any record up to it, so
+that a query only reads from the last offset before its time range
+starts. When a segment is rotated, this index is saved to a file along with the time
+range, highest level and sources of the segment's records, so that a
+query can skip every segment that cannot contain a record it selects.
+A query that has more records to return also returns a cursor giving
+the position of the next record, as the serial number of its segment
+and its offset, so that a client can page through records that share
+a timestamp without skipping or repeating any.
+
+Segments are searched via mmap. The segment that was being written when
+a server stopped abruptly is indexed again when the store is reopened,
+after truncating any record that was only partially written.
+"""
+
+## @package tops.core.network.logging.store
+# Persistent segmented storage of log records
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os
+import os.path
+import struct
+import mmap
+import logging
+
+from bisect import bisect_left
+
+from record import quote,intern_name
+
+class StoreException(Exception):
+	pass
+
+class Segment(object):
+	"""
+	Describes one segment file of a store.
+
+	The index lists (timestamp,offset) pairs in increasing order, where
+	each timestamp is the latest of any record up to and including the
+	one at its offset, and first and last are the earliest and latest
+	timestamps of the segment's records. A segment that has been sealed is no longer appended to.
+	Segments are numbered in the order they were created by the serial
+	number at the end of their file names.
+	"""
+	def __init__(self,path):
+		self.path = path
+		self.serial = int(os.path.basename(path)[8:])
+		self.size = 0
+		self.count = 0
+		self.first = None
+		self.last = None
+		self.maxLevel = 0
+		self.sources = set()
+		self.times = [ ]
+		self.offsets = [ ]
+		self.sealed = False
+
+	def indexPath(self):
+		return self.path + '.idx'
+
+	def add(self,tstamp,levelno,sid,offset,indexBytes):
+		"""
+		Updates our summary with a record written at offset.
+		"""
+		if self.first is None or tstamp < self.first:
+			self.first = tstamp
+		if self.last is None or tstamp > self.last:
+			self.last = tstamp
+		if not self.offsets or offset >= self.offsets[-1] + indexBytes:
+			self.times.append(self.last)
+			self.offsets.append(offset)
+		if levelno > self.maxLevel:
+			self.maxLevel = levelno
+		self.sources.add(sid)
+		self.count += 1
+
+class LogStore(object):
+	"""
+	Appends log records to segments on disk and searches them.
+
+	Records are appended to segments of about segment_bytes and the
+	total size of all segments is limited to max_bytes. A sparse index
+	entry is added every index_bytes within a segment. Appended records
+	are buffered in memory until flush() is called or flushBytes are
+	waiting, and a query flushes them first. The stored, dropped and
+	scanned attributes count records written, records removed with their
+	segments and segments searched by queries.
+	"""
+	# length of the JSON tail, timestamp in ms, level, source number
+	header = struct.Struct('!IqBI')
+	summary = struct.Struct('!qqBIII')
+	entry = struct.Struct('!qI')
+
+	flushBytes = 65536
+
+	def __init__(self,directory,max_bytes=1073741824,segment_bytes=16777216,index_bytes=65536):
+		if segment_bytes < 1 or max_bytes < segment_bytes:
+			raise StoreException('store of %d bytes cannot hold segments of %d bytes' %
+				(max_bytes,segment_bytes))
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.maxBytes = max_bytes
+		self.segmentBytes = segment_bytes
+		self.indexBytes = index_bytes
+		self.segments = [ ]
+		self.current = None
+		self.fd = None
+		self.serial = 0
+		self.nbytes = 0
+		self.pending = [ ]
+		self.pendingBytes = 0
+		self.stored = 0
+		self.dropped = 0
+		self.scanned = 0
+		self.levels = { }
+		self.loadSources()
+		self.recover()
+
+	def loadSources(self):
+		"""
+		Loads our dictionary of source names, numbered in the order they were added.
+		"""
+		self.sourcePath = os.path.join(self.directory,'sources')
+		self.sourceNames = [ ]
+		self.sourceIds = { }
+		self.quotedSources = [ ]
+		if os.path.exists(self.sourcePath):
+			f = open(self.sourcePath,'r+b')
+			try:
+				data = f.read()
+				end = data.rfind('\n') + 1
+				if end < len(data):
+					# drop a name that was only partially written
+					f.truncate(end)
+			finally:
+				f.close()
+			for name in data[:end].splitlines():
+				self.addSource(name)
+		self.sourceFd = os.open(self.sourcePath,os.O_WRONLY|os.O_CREAT|os.O_APPEND,0644)
+
+	def addSource(self,name):
+		name = intern_name(name)
+		sid = len(self.sourceNames)
+		self.sourceNames.append(name)
+		self.sourceIds[name] = sid
+		self.quotedSources.append(quote(name))
+		return sid
+
+	def sourceId(self,name):
+		"""
+		Returns the number of a source name, adding it to our dictionary if necessary.
+		"""
+		try:
+			return self.sourceIds[name]
+		except KeyError:
+			sid = self.addSource(name)
+			os.write(self.sourceFd,self.sourceNames[sid] + '\n')
+			return sid
+
+	def quotedLevel(self,levelno):
+		try:
+			return self.levels[levelno]
+		except KeyError:
+			quoted = quote(logging.getLevelName(levelno).replace(' ','_'))
+			self.levels[levelno] = quoted
+			return quoted
+
+	def recover(self):
+		"""
+		Adds the segments left in our directory by an earlier store.
+		"""
+		names = sorted(name for name in os.listdir(self.directory)
+			if name.startswith('segment-') and not name.endswith('.idx'))
+		for name in names:
+			path = os.path.join(self.directory,name)
+			self.serial = max(self.serial,int(name[8:]))
+			segment = self.loadIndex(path)
+			if segment is None:
+				segment = self.scan(path)
+				self.seal(segment)
+			if not segment.count:
+				self.remove(segment)
+				continue
+			self.segments.append(segment)
+			self.nbytes += segment.size
+
+	def loadIndex(self,path):
+		"""
+		Returns the sealed segment at path described by its index file, or None.
+		"""
+		segment = Segment(path)
+		try:
+			data = open(segment.indexPath(),'rb').read()
+			(segment.first,segment.last,segment.maxLevel,segment.count,nsources,nentries) = (
+				self.summary.unpack_from(data))
+			offset = self.summary.size
+			segment.sources = set(struct.unpack_from('!%dI' % nsources,data,offset))
+			offset += 4*nsources
+			for index in xrange(nentries):
+				(tstamp,position) = self.entry.unpack_from(data,offset)
+				segment.times.append(tstamp)
+				segment.offsets.append(position)
+				offset += self.entry.size
+			segment.size = os.path.getsize(path)
+		except (IOError,OSError,struct.error):
+			return None
+		segment.sealed = True
+		return segment
+
+	def scan(self,path):
+		"""
+		Returns a segment indexed by reading its records.
+
+		Truncates any record at the end that was only partially written.
+		"""
+		segment = Segment(path)
+		f = open(path,'r+b')
+		try:
+			data = f.read()
+			unpack = self.header.unpack_from
+			size = self.header.size
+			offset = 0
+			while offset + size <= len(data):
+				(length,tstamp,levelno,sid) = unpack(data,offset)
+				end = offset + size + length
+				if end > len(data) or sid >= len(self.sourceNames):
+					break
+				segment.add(tstamp,levelno,sid,offset,self.indexBytes)
+				offset = end
+			if offset < len(data):
+				f.truncate(offset)
+		finally:
+			f.close()
+		segment.size = offset
+		return segment
+
+	def seal(self,segment):
+		"""
+		Saves the index of a segment that will no longer be appended to.
+		"""
+		pieces = [
+			self.summary.pack(segment.first or 0,segment.last or 0,segment.maxLevel,
+				segment.count,len(segment.sources),len(segment.offsets)),
+			struct.pack('!%dI' % len(segment.sources),*sorted(segment.sources))
+		]
+		for (tstamp,offset) in zip(segment.times,segment.offsets):
+			pieces.append(self.entry.pack(tstamp,offset))
+		temporary = segment.indexPath() + '.new'
+		f = open(temporary,'wb')
+		try:
+			f.write(''.join(pieces))
+		finally:
+			f.close()
+		os.rename(temporary,segment.indexPath())
+		segment.sealed = True
+
+	def rotate(self):
+		"""
+		Seals the segment that we are appending to.
+		"""
+		self.flush()
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		if self.current is not None:
+			self.seal(self.current)
+			self.current = None
+
+	def append(self,record):
+		"""
+		Appends a record, discarding our oldest segments as necessary.
+		"""
+		tstamp = record.tstamp
+		# the JSON from the body onwards, which a record only encodes once
+		encoded = record.json()
+		tail = encoded[encoded.index(',"body":') + 1:]
+		levelno = min(max(record.levelno,0),255)
+		sid = self.sourceId(record.source)
+		data = self.header.pack(len(tail),tstamp,levelno,sid) + tail
+		if self.current is not None and self.current.size + len(data) > self.segmentBytes:
+			self.rotate()
+		if self.current is None:
+			self.open()
+		self.current.add(tstamp,levelno,sid,self.current.size,self.indexBytes)
+		self.current.size += len(data)
+		self.nbytes += len(data)
+		self.pending.append(data)
+		self.pendingBytes += len(data)
+		self.stored += 1
+		if self.pendingBytes >= self.flushBytes:
+			self.flush()
+
+	def open(self):
+		"""
+		Starts a new segment, making room for it if necessary.
+		"""
+		while self.segments and self.nbytes + self.segmentBytes > self.maxBytes:
+			self.discard()
+		self.serial += 1
+		self.current = Segment(os.path.join(self.directory,'segment-%08d' % self.serial))
+		self.fd = os.open(self.current.path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_APPEND,0644)
+		self.segments.append(self.current)
+
+	def flush(self):
+		"""
+		Writes the records that we have buffered.
+		"""
+		if not self.pending:
+			return
+		data = ''.join(self.pending)
+		self.pending = [ ]
+		self.pendingBytes = 0
+		written = 0
+		while written < len(data):
+			written += os.write(self.fd,buffer(data,written))
+
+	def discard(self):
+		"""
+		Removes our oldest segment.
+		"""
+		segment = self.segments[0]
+		self.segments.remove(segment)
+		self.nbytes -= segment.size
+		self.dropped += segment.count
+		self.remove(segment)
+
+	def remove(self,segment):
+		for path in (segment.path,segment.indexPath()):
+			try:
+				os.unlink(path)
+			except OSError:
+				pass
+
+	def query(self,filt,t0=None,t1=None,limit=1000,newest=False,cursor=None):
+		"""
+		Returns the JSON of the stored records that a LogFilter selects.
+
+		Only records with timestamps from t0 to t1 in milliseconds are
+		selected, if either is given. At most limit records are returned,
+		in the order they were stored, followed by whether more were selected and a cursor
+		for the next page, or None. These are the first records selected,
+		or the last if newest is True. Passing the cursor returned by a
+		query to the same query continues after the last record returned,
+		or before the first if newest is True. Raises ValueError for an
+		invalid cursor.
+		"""
+		(serial,position) = map(int,cursor.split(':')) if cursor else (None,None)
+		self.flush()
+		wanted = set(sid for (sid,name) in enumerate(self.sourceNames) if filt.sourcePattern.matches(name))
+		minLevel = filt.minLevel
+		if t0 is None:
+			t0 = -(1 << 63)
+		if t1 is None:
+			t1 = (1 << 63) - 1
+		segments = [segment for segment in self.segments if not (
+			not segment.size or segment.first > t1 or segment.last < t0 or
+			segment.maxLevel < minLevel or segment.sources.isdisjoint(wanted) or
+			(serial is not None and (segment.serial > serial if newest else segment.serial < serial)))]
+		if not newest:
+			items = [ ]
+			for segment in segments:
+				start = position if segment.serial == serial else 0
+				for (offset,item) in self.select(segment,wanted,minLevel,t0,t1,start):
+					if len(items) == limit:
+						return (items,True,'%d:%d' % (segment.serial,offset))
+					items.append(item)
+			return (items,False,None)
+		items = [ ]
+		for (count,segment) in enumerate(reversed(segments)):
+			end = position if segment.serial == serial else None
+			selected = list(self.select(segment,wanted,minLevel,t0,t1,0,end))
+			items[:0] = [(segment.serial,offset,item) for (offset,item) in selected]
+			if len(items) >= limit:
+				more = len(items) > limit or count + 1 < len(segments)
+				items = items[len(items) - limit:]
+				if more:
+					return ([item for (s,o,item) in items],True,'%d:%d' % items[0][:2])
+				break
+		return ([item for (s,o,item) in items],False,None)
+
+	def select(self,segment,wanted,minLevel,t0,t1,start=0,end=None):
+		"""
+		Generates the offset and JSON of the selected records in one segment, in stored order.
+
+		Only records from offset start and before offset end, if given, are read.
+		"""
+		self.scanned += 1
+		unpack = self.header.unpack_from
+		size = self.header.size
+		f = open(segment.path,'rb')
+		try:
+			data = mmap.mmap(f.fileno(),segment.size,access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		try:
+			# every record up to the last entry before t0 is earlier than t0
+			index = max(bisect_left(segment.times,t0) - 1,0)
+			offset = max(segment.offsets[index],start)
+			if end is None or end > segment.size:
+				end = segment.size
+			while offset < end:
+				(length,tstamp,levelno,sid) = unpack(data,offset)
+				record = offset
+				start = offset + size
+				offset = start + length
+				if tstamp < t0 or tstamp > t1 or levelno < minLevel or sid not in wanted:
+					continue
+				yield (record,'{"tstamp":%d,"level":%s,"source":%s,%s' %
+					(tstamp,self.quotedLevel(levelno),self.quotedSources[sid],data[start:offset]))
+		finally:
+			data.close()
+
+	def close(self):
+		self.rotate()
+		if self.sourceFd is not None:
+			os.close(self.sourceFd)
+			self.sourceFd = None
+
+
+import unittest
+import tempfile
+import shutil
+
+class LogStoreTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory,'store')
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	def record(self,tstamp,source,levelno,body):
+		from logging_pb2 import Message,Header
+		from record import LogRecord
+		msg = Message()
+		msg.levelno = levelno
+		msg.body = body
+		hdr = Header()
+		hdr.name = source
+		record = LogRecord(msg,hdr)
+		record.tstamp = tstamp
+		return record
+	def fill(self,store,count=1000):
+		for index in range(count):
+			source = ('tcc.axis','tcc.listener','hub')[index % 3]
+			store.append(self.record(1000*index,source,(10,20,30,40)[index % 4],'message "%d"' % index))
+	def query(self,store,sourceFilter='*',minLevel='DEBUG',t0=None,t1=None,limit=1000,newest=False,cursor=None):
+		from record import LogFilter
+		from json import loads
+		(items,more,self.cursor) = store.query(LogFilter(sourceFilter,minLevel),t0,t1,limit,newest,cursor)
+		return ([loads(item) for item in items],more)
+	def test00(self):
+		"""Stored records are selected by time, level and source"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		self.fill(store)
+		(items,more) = self.query(store,'tcc.*','WARNING',100000,200000)
+		self.assertEqual(more,False)
+		self.assertEqual([item['body'] for item in items],
+			['message "%d"' % index for index in range(100,201) if index % 3 != 2 and index % 4 >= 2])
+		self.assertEqual((items[0]['source'],items[0]['level'],items[0]['tstamp']),('tcc.axis','WARNING',102000))
+		(items,more) = self.query(store,limit=10)
+		self.assertEqual((len(items),more),(10,True))
+		store.close()
+	def test01(self):
+		"""Queries skip segments that cannot contain selected records"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		self.fill(store,1000)
+		store.append(self.record(1001000,'mcp',50,'fault'))
+		self.assertTrue(len(store.segments) > 5)
+		(items,more) = self.query(store,'*','CRITICAL')
+		self.assertEqual([item['body'] for item in items],['fault'])
+		self.assertEqual(store.scanned,1)
+		(items,more) = self.query(store,'*','DEBUG',990000,995000)
+		self.assertEqual(len(items),6)
+		self.assertEqual(store.scanned,2)
+		store.close()
+	def test02(self):
+		"""A store is recovered after being closed or interrupted"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		self.fill(store,500)
+		store.close()
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		self.fill(store,10)
+		store.flush()
+		# simulate a crash while the last record was being written
+		os.close(store.fd)
+		os.close(store.sourceFd)
+		f = open(store.current.path,'ab')
+		f.write(LogStore.header.pack(100,0,0,0) + 'partial')
+		f.close()
+		before = self.query(store)[0]
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		(items,more) = self.query(store,limit=10000)
+		self.assertEqual(len(items),510)
+		self.assertEqual(items,before)
+		# the records appended after reopening keep their earlier timestamps
+		self.assertEqual((items[499]['tstamp'],items[-1]['tstamp']),(499000,9000))
+		store.close()
+	def test03(self):
+		"""The oldest segments are removed to respect our cap on disk usage"""
+		store = LogStore(self.path,max_bytes=32768,segment_bytes=8192)
+		self.fill(store,2000)
+		store.flush()
+		self.assertTrue(store.nbytes <= 32768)
+		self.assertTrue(store.dropped > 0)
+		(items,more) = self.query(store,limit=10000)
+		self.assertEqual(len(items),2000 - store.dropped)
+		self.assertEqual(items[-1]['body'],'message "1999"')
+		store.close()
+	def test04(self):
+		"""Recent records are paged back from the newest"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=8192,index_bytes=512)
+		self.fill(store,1000)
+		pages = [ ]
+		cursor = None
+		while True:
+			(items,more) = self.query(store,'hub',limit=100,newest=True,cursor=cursor)
+			pages.append([int(item['body'].split('"')[1]) for item in items])
+			if not more:
+				break
+			cursor = self.cursor
+		self.assertEqual(pages[0],range(701,1000,3))
+		self.assertEqual(sum(reversed(pages),[ ]),range(2,1000,3))
+		self.assertTrue(len(pages) in (4,5))
+		self.assertRaises(ValueError,lambda: self.query(store,cursor='x'))
+		store.close()
+	def test05(self):
+		"""Paging does not skip or repeat records that share a timestamp"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=4096,index_bytes=512)
+		for index in range(300):
+			# many share a timestamp and some arrive out of order
+			store.append(self.record(5000 + 1000*(index // 100) if index % 7 else 0,'hub',20,'message "%d"' % index))
+		for newest in (True,False):
+			pages = [ ]
+			cursor = None
+			while True:
+				(items,more) = self.query(store,limit=32,newest=newest,cursor=cursor)
+				pages.append([int(item['body'].split('"')[1]) for item in items])
+				if not more:
+					break
+				cursor = self.cursor
+			if newest:
+				pages.reverse()
+			self.assertEqual(sum(pages,[ ]),range(300))
+			self.assertTrue(len(pages) >= 10)
+		store.close()
+	def test06(self):
+		"""Records keep their own timestamps when they arrive out of order"""
+		store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=4096,index_bytes=256)
+		store.append(self.record(3600000 + 100000,'fast',20,'from the future'))
+		for index in range(200):
+			store.append(self.record(100000 + 1000*index,'hub',20,'message "%d"' % index))
+		store.append(self.record(50000,'spool',20,'replayed'))
+		for reopen in (False,True):
+			if reopen:
+				store.close()
+				store = LogStore(self.path,max_bytes=1 << 20,segment_bytes=4096,index_bytes=256)
+			(items,more) = self.query(store,'hub',t0=99000,t1=102000)
+			self.assertEqual([(item['tstamp'],item['body']) for item in items],
+				[(100000,'message "0"'),(101000,'message "1"'),(102000,'message "2"')])
+			(items,more) = self.query(store,'*',t0=150000,t1=151000)
+			self.assertEqual([item['body'] for item in items],['message "50"','message "51"'])
+			(items,more) = self.query(store,'*',t1=60000)
+			self.assertEqual([(item['tstamp'],item['body']) for item in items],[(50000,'replayed')])
+			(items,more) = self.query(store,'fast')
+			self.assertEqual([item['tstamp'] for item in items],[3700000])
+		store.close()
+
+if __name__ == '__main__':
+	unittest.main()
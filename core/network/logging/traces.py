@@ -0,0 +1,186 @@
+"""
+Exception tracebacks grouped by fingerprint
+
+The logging server can group the exception tracebacks attached to log
+records by a fingerprint of their normalized frames, keeping the text of
+each distinct traceback once with how often, when and where it has been
+seen, so that the faults repeated by a proxy can be listed without
+reading every record. A fingerprint combines the type of the exception
+with the file name and function of each frame, so it does not change
+with line numbers, directories or the message of the exception.
+
+A producer can also avoid resending the full text of a traceback that
+its server already has, by sending its digest instead once the server
+has acknowledged it. A digest identifies the exact text, so a traceback
+with a different message is always sent in full.
+"""
+
+## @package tops.core.network.logging.traces
+# Exception tracebacks grouped by fingerprint
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import re
+import os.path
+import hashlib
+
+from collections import OrderedDict
+
+from record import quote
+
+# a frame of a formatted traceback
+framePattern = re.compile(r'File "([^"]*)", line \d+, in (\S+)')
+
+def exceptionType(text):
+	"""
+	Returns the type of exception named on the last unindented line of a traceback.
+	"""
+	for line in reversed(text.rstrip().splitlines()):
+		if line and not line[0].isspace():
+			return line.split(':',1)[0].strip()
+	return ''
+
+def fingerprint(text):
+	"""
+	Returns the fingerprint of the normalized frames of a traceback.
+	"""
+	parts = [exceptionType(text)]
+	parts.extend(['%s:%s' % (os.path.basename(path),function)
+		for (path,function) in framePattern.findall(text)])
+	joined = '\n'.join(parts)
+	if isinstance(joined,unicode):
+		joined = joined.encode('utf-8')
+	return hashlib.sha1(joined).hexdigest()[:16]
+
+def digest(text):
+	"""
+	Returns the digest that identifies the exact text of a traceback.
+	"""
+	if isinstance(text,unicode):
+		text = text.encode('utf-8')
+	return hashlib.sha1(text).hexdigest()[:16]
+
+class TraceGroup(object):
+	"""
+	The records whose tracebacks share a fingerprint.
+
+	Keeps the text of the first traceback, the number of records and the
+	timestamps in ms of the first and last, and up to maxSources of the
+	sources that logged them.
+	"""
+	__slots__ = ('fingerprint','kind','text','count','first','last','sources')
+
+	maxSources = 10
+
+	def __init__(self,fingerprint,text,tstamp):
+		self.fingerprint = fingerprint
+		self.kind = exceptionType(text)
+		self.text = text
+		self.count = 0
+		self.first = tstamp
+		self.last = tstamp
+		self.sources = [ ]
+
+	def add(self,record):
+		self.count += 1
+		self.last = record.tstamp
+		if len(self.sources) < self.maxSources and record.source not in self.sources:
+			self.sources.append(record.source)
+
+	def json(self):
+		return ('{"fingerprint":"%s","type":%s,"count":%d,"first":%d,"last":%d,"sources":[%s],"text":%s}' %
+			(self.fingerprint,quote(self.kind),self.count,self.first,self.last,
+			','.join([quote(source) for source in self.sources]),quote(self.text)))
+
+class TraceStore(object):
+	"""
+	Groups the tracebacks of log records by their fingerprint.
+
+	At most maxGroups groups are kept, and the group that was seen least
+	recently is forgotten to make room for a new one.
+	"""
+	def __init__(self,maxGroups=10000):
+		self.maxGroups = maxGroups
+		# groups by fingerprint, least recently seen first
+		self.groups = OrderedDict()
+		self.forgotten = 0
+
+	def add(self,record):
+		"""
+		Adds a record to the group of its traceback, if it has one.
+		"""
+		text = record.fields()[1]
+		if not text:
+			return
+		key = fingerprint(text)
+		group = self.groups.pop(key,None)
+		if group is None:
+			if len(self.groups) >= self.maxGroups:
+				self.groups.popitem(last=False)
+				self.forgotten += 1
+			group = TraceGroup(key,text,record.tstamp)
+		self.groups[key] = group
+		group.add(record)
+
+	def top(self,limit=100):
+		"""
+		Returns up to limit groups, most common first.
+		"""
+		return sorted(self.groups.itervalues(),key=lambda group: group.count,reverse=True)[:limit]
+
+	def json(self,limit=100):
+		items = ',\n\t'.join([group.json() for group in self.top(limit)])
+		return '{"items":[%s],"groups":%d,"forgotten":%d}' % (items,len(self.groups),self.forgotten)
+
+
+import unittest
+
+class TraceStoreTests(unittest.TestCase):
+	class Record(object):
+		def __init__(self,tstamp,source,exception):
+			self.tstamp = tstamp
+			self.source = source
+			self.exception = exception
+		def fields(self):
+			return ('failed',self.exception)
+	def traceback(self,line=12,directory='/opt/tops',message='bad shutter'):
+		return ('Traceback (most recent call last):\n'
+			'  File "%s/camera.py", line %d, in expose\n    self.open()\n'
+			'  File "%s/shutter.py", line 40, in open\n    raise ValueError(msg)\n'
+			'ValueError: %s\n' % (directory,line,directory,message))
+	def test00(self):
+		"""Fingerprints ignore line numbers, directories and messages"""
+		first = fingerprint(self.traceback())
+		self.assertEqual(fingerprint(self.traceback(line=13,directory='/usr/lib',message='x')),first)
+		self.assertNotEqual(fingerprint(self.traceback().replace('ValueError','IOError')),first)
+		self.assertNotEqual(fingerprint(self.traceback().replace('in open','in close')),first)
+		self.assertEqual(exceptionType(self.traceback()),'ValueError')
+		self.assertEqual(digest(self.traceback()),digest(unicode(self.traceback())))
+		self.assertNotEqual(digest(self.traceback(message='x')),digest(self.traceback()))
+	def test01(self):
+		"""Records are counted by the group of their traceback"""
+		store = TraceStore(maxGroups=2)
+		for (tstamp,source,exception) in (
+			(100,'tcc.axis',self.traceback()),
+			(200,'tcc',None),
+			(300,'hub',self.traceback(line=20)),
+			(400,'tcc.axis',self.traceback().replace('ValueError','IOError')),
+			(500,'tcc.axis',self.traceback())):
+			store.add(self.Record(tstamp,source,exception))
+		top = store.top()
+		self.assertEqual([(group.kind,group.count,group.first,group.last,group.sources) for group in top],
+			[('ValueError',3,100,500,['tcc.axis','hub']),('IOError',1,400,400,['tcc.axis'])])
+		self.assertEqual(top[0].text,self.traceback())
+		# the least recently seen group is forgotten
+		store.add(self.Record(600,'mcp','KeyError: x'))
+		self.assertEqual(sorted(group.kind for group in store.top()),['KeyError','ValueError'])
+		from json import loads
+		update = loads(store.json(limit=1))
+		self.assertEqual((len(update['items']),update['groups'],update['forgotten']),(1,2,1))
+		self.assertEqual(update['items'][0]['count'],3)
+
+if __name__ == '__main__':
+	unittest.main()
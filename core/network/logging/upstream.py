@@ -0,0 +1,161 @@
+"""
+Forwards log records from one logging server to another
+
+A logging server on each host can forward the records that it handles
+to a central logging server, acting as a single producer whose header
+names it with its own ResourceName prefix. The central server prepends
+this prefix to the source of each forwarded record, so that 'tcc.axis'
+on a site logger named 'apo' is seen centrally as 'apo.tcc.axis', and
+each record keeps the timestamp it was given where it was first logged.
+Local producers keep their cheap UNIX socket connection to their site
+logger, and only one connection per site crosses the network.
+
+The connection uses the same options as any other client, read from the
+[upstream] section of the configuration, so that forwarded records can
+be filtered by source and level, buffered and sent in compressed batches
+from a background thread, and spooled while the central server is
+unreachable.
+"""
+
+## @package tops.core.network.logging.upstream
+# Forwards log records from one logging server to another
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os.path
+
+from tops.core.network.client import Client,ClientException
+from tops.core.network.naming import ResourceName
+from record import LogFilter
+
+import logging_pb2
+
+class UpstreamClient(Client):
+	"""
+	Forwards the log records selected by a LogFilter to an upstream logging server.
+
+	Our header names us with prefix. The options are those of a Client,
+	except that we are buffered by default, so that forwarding a record
+	never waits for the network. A client only reconnects after losing
+	its connection if it has a spool, so one should normally be used.
+	The forwarded attribute counts records sent or queued, and lost
+	counts records that could not be sent or queued.
+	"""
+	Header = logging_pb2.Header
+	Message = logging_pb2.Message
+
+	def __init__(self,prefix,filt,unix_path,tcp_host,tcp_port,**options):
+		options.setdefault('buffered',True)
+		Client.__init__(self,unix_path,tcp_host,tcp_port,**options)
+		self.prefix = ResourceName(prefix)
+		self.filter = filt
+		self.forwarded = 0
+		hdr = self.Header()
+		hdr.name = str(self.prefix)
+		self.sendHeader(hdr)
+
+	def forward(self,record):
+		"""
+		Forwards a record if our filter selects it.
+		"""
+		if not self.filter.selects(record):
+			return
+		(body,exception) = record.fields()
+		msg = self.Message()
+		msg.levelno = record.levelno
+		msg.body = body
+		msg.source = record.source
+		msg.tstamp = record.tstamp
+		if exception:
+			msg.exception = exception
+		try:
+			self.sendMessage(msg)
+			self.forwarded += 1
+		except ClientException:
+			self.lost += 1
+
+	def stats(self):
+		return '%d records forwarded upstream as %s, %d lost' % (self.forwarded,self.prefix,self.lost)
+
+
+import tops.core.utility.config as config
+import tops.core.network.client as client
+
+def connect():
+	"""
+	Returns an UpstreamClient configured by the [upstream] section, or None if it is not enabled.
+	"""
+	if not config.getboolean('upstream','enable'):
+		return None
+	prefix = config.get('upstream','prefix')
+	options = client.getOptions('upstream')
+	options.pop('multiplex',None)
+	if 'spool_dir' in options:
+		options['spool_dir'] = os.path.join(options['spool_dir'],prefix)
+	filt = LogFilter(config.get('upstream','source_filter') or '*',
+		config.get('upstream','min_level') or 'DEBUG')
+	return UpstreamClient(prefix,filt,
+		config.get('upstream','unix_addr'),
+		config.get('upstream','tcp_host'),
+		config.getint('upstream','tcp_port'),
+		**options
+	)
+
+
+import unittest
+import socket
+
+class UpstreamClientTests(unittest.TestCase):
+	def test00(self):
+		"""Records are forwarded in compressed batches with their sources prefixed"""
+		from twisted.internet.protocol import Factory
+		from twisted.test.proto_helpers import StringTransport
+		from server import FeedBuffer,LogServer
+		from record import LogRecord
+		from json import loads
+		(a,b) = socket.socketpair()
+		class PairClient(UpstreamClient):
+			def connect(self):
+				return a
+		upstream = PairClient('apo',LogFilter('tcc.*','INFO'),None,None,None,
+			framing='varint',batch=True,compression='zlib',coalesce_delay=0.05)
+		for (source,levelno,body) in (('tcc',30,'skipped'),('tcc.axis',10,'skipped'),
+			('tcc.axis',20,u'moved 1\u00b5m'),('tcc.listener',40,'failed')):
+			msg = logging_pb2.Message()
+			msg.levelno = levelno
+			msg.body = body
+			(name,dot,msg.source) = source.partition('.')
+			hdr = logging_pb2.Header()
+			hdr.name = name
+			if body == 'failed':
+				msg.exception = 'Traceback: ValueError'
+			record = LogRecord(msg,hdr)
+			record.tstamp = 1000
+			upstream.forward(record)
+		upstream.close()
+		data = ''
+		while True:
+			chunk = b.recv(65536)
+			if not chunk:
+				break
+			data += chunk
+		b.close()
+		# the framing preamble, our header and then both records in one batch
+		self.assertEqual((upstream.forwarded,upstream.lost,upstream.writes),(2,0,3))
+		factory = Factory()
+		factory.feed = FeedBuffer()
+		factory.echo = False
+		central = LogServer()
+		central.factory = factory
+		central.makeConnection(StringTransport())
+		central.dataReceived(data)
+		records = [loads(record.json()) for record in factory.feed.buffer if record.source.startswith('apo.')]
+		self.assertEqual([(r['source'],r['level'],r['body'],r['tstamp']) for r in records],
+			[('apo.tcc.axis','INFO',u'moved 1\u00b5m',1000),('apo.tcc.listener','ERROR','failed',1000)])
+		self.assertEqual(records[1]['exception'],'Traceback: ValueError')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -3,6 +3,11 @@ var displayedMessages = 0;
 var maxMessages = 10;
 var timer = null;
 var uid = null;
+var cursor = null;
+var updateInterval = 1;
+var generation = 0;
+// seconds that the server can hold each request until it has new messages
+var waitSeconds = 25;
 
 function ajaxError(request, textStatus, errorThrown) {
 	// typically only one of textStatus or errorThrown will have info
@@ -54,13 +59,30 @@ function addRecord(index,record) {
 function processRecords(data,textStatus) {
 	var now = new Date();
 	$("#lastUpdate").html(now.toLocaleString()+' '+textStatus);
+	if(data.cursor != undefined) cursor = data.cursor;
 	$.each(data.items,addRecord);
 	// scroll to the bottom of the message area so this new message is visible
 	if(data.items.length > 0) scrollToBottom("#content");
 }
 
 function startUpdate() {
-	$.getJSON('/feed',{'uid':uid},processRecords);
+	// only ask for the records we have not seen yet, and wait for some to arrive
+	var query = {'uid':uid,'wait':waitSeconds};
+	if(cursor != null) query.cursor = cursor;
+	var current = generation;
+	$.ajax({
+		url: '/feed',
+		data: query,
+		dataType: 'json',
+		timeout: 1000*(waitSeconds + 5),
+		success: function(data,textStatus) {
+			// ignore updates that were requested before the options changed
+			if(current != generation) return;
+			processRecords(data,textStatus);
+			// wait a little before asking again so that messages arrive in batches
+			timer = window.setTimeout('startUpdate()',1000*updateInterval);
+		}
+	});
 }
 
 function resetOptions() {
@@ -74,7 +96,7 @@ function updateOptions() {
 	// clear any running update timer
 	stopTimer(timer);
 	// extract the new options from the HTML inputs
-	var updateInterval = $("#updateInterval :checked").val();
+	updateInterval = $("#updateInterval :checked").val();
 	maxMessages = $("#maxMessages :checked").val();
 	var sourceFilter = $("#sourceFilter").val();
 	var minLevel = $("#minLevel :checked").val();
@@ -83,14 +105,16 @@ function updateOptions() {
 		's, max messages = ' + maxMessages + ', source filter is "' + sourceFilter +
 		'", min level = ' + minLevel;
 	addLocalRecord(updateMsg);
-	// tell the server our new options
+	// tell the server our new options, which replay its buffer from the start
+	cursor = null;
 	$.post('/feed',{
 		'uid': uid,
 		'sourceFilter': sourceFilter,
 		'minLevel': minLevel
 	});
-	// (re)start timed updates, converting seconds to ms
-	timer = window.setInterval('startUpdate()',1000*updateInterval);
+	// (re)start updates, abandoning any request that is still waiting
+	generation++;
+	startUpdate();
 }
 
 $(document).ready(
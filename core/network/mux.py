@@ -0,0 +1,576 @@
+"""
+Multiplexed connections for simple telescope operations network clients
+
+A process that produces both log messages and archive updates normally
+opens one connection to each server. With multiplexing, every client in
+the process opens a channel of one shared connection instead, so that
+the frames of all its streams share coalesced writes and a single
+socket. See tops.core.network.framing for the format of channel frames.
+
+The shared connection usually goes to a small relay on the same host,
+which is started as a service by this module and passes each channel on
+to the server that it names. It can instead go to either the logging or
+archiving server, which handles channels for its own service and relays
+any others.
+"""
+
+## @package tops.core.network.mux
+# Multiplexed connections for simple telescope operations network clients
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os.path
+import socket
+import threading
+import time
+
+import twisted.internet.protocol
+import twisted.internet.error
+from twisted.python.failure import Failure
+
+import framing
+from client import BoundedQueue,Flusher,sendPieces
+
+class Channel(object):
+	"""
+	Carries the stream of one client over a multiplexed connection.
+
+	Behaves enough like a connected socket for a client to write its
+	stream with sendall(). Writing to a channel whose connection has
+	been lost raises socket.error so that the client reconnects.
+	"""
+	# this is never a UNIX socket that could announce a shared memory ring
+	family = None
+
+	def __init__(self,multiplexer,id,generation):
+		self.multiplexer = multiplexer
+		self.id = id
+		self.generation = generation
+		self.closed = False
+
+	def sendall(self,data):
+		if not data:
+			return
+		if self.closed or self.generation != self.multiplexer.generation:
+			raise socket.error('multiplexed connection was lost')
+		self.multiplexer.put(self.id,data)
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			if self.generation == self.multiplexer.generation:
+				self.multiplexer.put(self.id,'')
+
+class Multiplexer(object):
+	"""
+	Manages the client side of a multiplexed connection.
+
+	Channel frames are queued and written by a Flusher thread, which
+	coalesces frames queued within coalesce_delay seconds of each other,
+	from any channel, until coalesce_bytes have accumulated. A full queue
+	blocks its clients. Frames that were queued when a write fails are
+	counted by the lost attribute, and every open channel is then lost.
+	A new channel reconnects, if necessary, but not within retry seconds
+	of a failed attempt.
+	"""
+	def __init__(self,unix_path,tcp_host,tcp_port,
+		maxqueue=1000,coalesce_bytes=65536,coalesce_delay=0,retry=1.0):
+		self.unix_addr = unix_path
+		self.tcp_addr = (tcp_host,tcp_port)
+		self.retry = retry
+		self.retryTime = 0
+		self.socket = None
+		self.generation = 0
+		self.channels = 0
+		self.lost = 0
+		self.writes = 0
+		self.lock = threading.Lock()
+		self.queue = BoundedQueue(maxqueue,BoundedQueue.BLOCK,lambda (prefix,data): len(data))
+		self.flusher = Flusher(self.queue,self.flush,coalesce_delay,coalesce_bytes)
+
+	def connect(self):
+		"""
+		Returns a connected socket, trying a UNIX address first.
+		"""
+		if self.unix_addr is not None:
+			try:
+				s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				s.connect(self.unix_addr)
+				return s
+			except socket.error:
+				pass
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.connect(self.tcp_addr)
+		return s
+
+	def open(self,service):
+		"""
+		Returns a new channel for a client of the named service.
+
+		Raises socket.error if we are unable to connect.
+		"""
+		self.lock.acquire()
+		try:
+			if self.socket is None:
+				if time.time() < self.retryTime:
+					raise socket.error('multiplexed connection is waiting to retry')
+				try:
+					self.socket = self.connect()
+				except socket.error:
+					self.retryTime = time.time() + self.retry
+					raise
+				sendPieces(self.socket,[framing.announceMultiplexed()])
+			self.channels += 1
+			channel = Channel(self,self.channels,self.generation)
+		finally:
+			self.lock.release()
+		self.put(channel.id,service)
+		return channel
+
+	def put(self,id,data):
+		self.queue.put((framing.encodeChannel(id,len(data)),data))
+
+	def flush(self,items):
+		"""
+		Writes a batch of channel frames with a single write.
+		"""
+		pieces = [ ]
+		for (prefix,data) in items:
+			pieces.append(prefix)
+			pieces.append(data)
+		self.lock.acquire()
+		try:
+			if self.socket is None:
+				self.lost += len(items)
+				return True
+			try:
+				sendPieces(self.socket,pieces)
+				self.writes += 1
+			except socket.error:
+				self.lost += len(items)
+				self.disconnect()
+		finally:
+			self.lock.release()
+		return True
+
+	def disconnect(self):
+		if self.socket is not None:
+			self.socket.close()
+			self.socket = None
+			self.generation += 1
+			self.retryTime = time.time() + self.retry
+
+	def close(self):
+		"""
+		Closes our connection after writing any queued frames.
+		"""
+		self.queue.close()
+		self.flusher.join()
+		self.lock.acquire()
+		try:
+			self.disconnect()
+		finally:
+			self.lock.release()
+
+
+theMultiplexer = None
+
+def shared():
+	"""
+	Returns the multiplexed connection shared by all clients in this process.
+
+	Creates it, using the configuration of the mux section, the first
+	time it is needed.
+	"""
+	global theMultiplexer
+	if theMultiplexer is None:
+		import tops.core.utility.config as config
+		theMultiplexer = Multiplexer(
+			config.get('mux','unix_addr'),
+			config.get('mux','tcp_host'),
+			config.getint('mux','tcp_port'),
+			maxqueue = config.getint('mux','queue_size') or 1000,
+			coalesce_bytes = config.getint('mux','coalesce_bytes') or 65536,
+			coalesce_delay = config.getfloat('mux','coalesce_delay') or 0,
+			retry = config.getfloat('mux','retry') or 1.0
+		)
+	return theMultiplexer
+
+
+class ChannelTransport(object):
+	"""
+	The transport of a protocol that handles one channel in a server.
+	"""
+	def __init__(self,demultiplexer,id):
+		self.demultiplexer = demultiplexer
+		self.id = id
+		self.disconnecting = False
+
+	def write(self,data):
+		if not self.disconnecting and data:
+			self.demultiplexer.write(self.id,data)
+
+	def loseConnection(self):
+		if not self.disconnecting:
+			self.disconnecting = True
+			self.demultiplexer.close(self.id)
+
+	def getPeer(self):
+		return self.demultiplexer.transport.getPeer()
+
+	def getHost(self):
+		return self.demultiplexer.transport.getHost()
+
+class Relay(twisted.internet.protocol.Protocol):
+	"""
+	Passes one channel on to the server of its service.
+
+	Data that arrives before we are connected is held until we are.
+	"""
+	def __init__(self,demultiplexer,id):
+		self.demultiplexer = demultiplexer
+		self.id = id
+		self.pending = [ ]
+		self.closed = False
+
+	def connectionMade(self):
+		self.transport.writeSequence(self.pending)
+		self.pending = None
+		if self.closed:
+			self.transport.loseConnection()
+
+	def send(self,data):
+		if self.pending is not None:
+			self.pending.append(data)
+		else:
+			self.transport.write(data)
+
+	def dataReceived(self,data):
+		# pass control frames back to our client
+		self.demultiplexer.write(self.id,data)
+
+	def connectionLost(self,reason):
+		if not self.closed:
+			self.closed = True
+			self.demultiplexer.close(self.id)
+
+	def close(self):
+		self.closed = True
+		if self.pending is None:
+			self.transport.loseConnection()
+
+class RelayFactory(twisted.internet.protocol.ClientFactory):
+	def __init__(self,relay):
+		self.relay = relay
+	def buildProtocol(self,addr):
+		return self.relay
+	def clientConnectionFailed(self,connector,reason):
+		print 'Unable to relay channel %d: %s' % (self.relay.id,reason.getErrorMessage())
+		self.relay.connectionLost(reason)
+
+class Demultiplexer(object):
+	"""
+	Splits a multiplexed connection into channels in a server.
+
+	Channels for the service named by section are handled by a protocol
+	built by factory, as if each were a separate connection. Channels for
+	any other service are relayed to that service's server.
+
+	A client does not read our connection, so it can keep writing to a
+	channel after we have closed it. The frames of a closed channel are
+	dropped until the client closes it too, instead of being mistaken
+	for a new channel.
+	"""
+	def __init__(self,transport,factory=None,section=None):
+		self.transport = transport
+		self.factory = factory
+		self.section = section
+		self.buffer = ''
+		self.handlers = { }
+		# channels that we closed before our client did
+		self.closed = set()
+		self.opened = 0
+		self.dropped = 0
+
+	def dataReceived(self,data):
+		buf = self.buffer + data if self.buffer else data
+		offset = 0
+		while True:
+			prefix = framing.decodeChannel(buf,offset)
+			if prefix is None:
+				break
+			(id,length,start) = prefix
+			if start + length > len(buf):
+				break
+			payload = buf[start:start+length]
+			offset = start + length
+			handler = self.handlers.get(id)
+			if id in self.closed:
+				if payload:
+					self.dropped += 1
+				else:
+					self.closed.discard(id)
+			elif handler is None:
+				self.open(id,payload)
+			elif not payload:
+				self.close(id,False)
+			elif isinstance(handler,Relay):
+				handler.send(payload)
+			else:
+				handler.dataReceived(payload)
+		self.buffer = buf[offset:]
+
+	def open(self,id,service):
+		"""
+		Starts handling a new channel for the named service.
+		"""
+		self.opened += 1
+		if service == self.section:
+			handler = self.factory.buildProtocol(None)
+			self.handlers[id] = handler
+			handler.makeConnection(ChannelTransport(self,id))
+		else:
+			try:
+				self.handlers[id] = self.relay(id,service)
+			except Exception,e:
+				print 'Unable to relay channel %d for %r: %s' % (id,service,e)
+				self.handlers[id] = None
+				self.close(id)
+
+	def relay(self,id,service):
+		"""
+		Returns a Relay that is connecting to the server of the named service.
+		"""
+		from twisted.internet import reactor
+		import tops.core.utility.config as config
+		relay = Relay(self,id)
+		path = config.getfilename(service,'unix_addr')
+		if path and os.path.exists(path):
+			reactor.connectUNIX(path,RelayFactory(relay))
+		else:
+			reactor.connectTCP(config.get(service,'tcp_host'),
+				config.getint(service,'tcp_port'),RelayFactory(relay))
+		return relay
+
+	def write(self,id,data):
+		"""
+		Sends data back to the client of a channel.
+		"""
+		if id in self.handlers:
+			self.transport.writeSequence([framing.encodeChannel(id,len(data)),data])
+
+	def close(self,id,notify=True):
+		"""
+		Stops handling a channel, and tells our client unless it closed the channel.
+		"""
+		if id not in self.handlers:
+			return
+		handler = self.handlers.pop(id)
+		if notify:
+			self.transport.write(framing.encodeChannel(id,0))
+			self.closed.add(id)
+		if handler is None:
+			return
+		if isinstance(handler,Relay):
+			handler.close()
+		else:
+			handler.transport.disconnecting = True
+			handler.connectionLost(Failure(twisted.internet.error.ConnectionDone()))
+
+	def connectionLost(self,reason):
+		for id in self.handlers.keys():
+			handler = self.handlers.pop(id)
+			if isinstance(handler,Relay):
+				handler.close()
+			else:
+				handler.connectionLost(reason)
+
+
+class RelayServer(twisted.internet.protocol.Protocol):
+	"""
+	Relays every channel of a multiplexed connection to its server.
+	"""
+	def connectionMade(self):
+		self.demultiplexer = None
+		self.preamble = ''
+		print 'Got a new connection from',self.transport.getPeer()
+
+	def dataReceived(self,data):
+		if self.demultiplexer is None:
+			self.preamble += data
+			expected = framing.announceMultiplexed()
+			if len(self.preamble) < len(expected):
+				return
+			if not self.preamble.startswith(expected):
+				print 'Dropping connection that is not multiplexed'
+				self.transport.loseConnection()
+				return
+			self.demultiplexer = Demultiplexer(self.transport)
+			data = self.preamble[len(expected):]
+		self.demultiplexer.dataReceived(data)
+
+	def connectionLost(self,reason):
+		if self.demultiplexer is not None:
+			print 'Connection with %d channels closed' % self.demultiplexer.opened
+			self.demultiplexer.connectionLost(reason)
+
+
+def initialize():
+	"""
+	Starts the relay main loop.
+	"""
+	from twisted.internet import reactor
+	from twisted.python import log
+	from twisted.python.logfile import LogFile
+	import sys,os
+
+	import tops.core.utility.config as config
+	config.initialize()
+
+	# use file-based logging for ourself (print statements are automatically redirected)
+	logpath = config.getfilename('mux','logfile')
+	if not logpath or logpath == 'stdout':
+		log.startLogging(sys.stdout)
+	else:
+		(logpath,logfile) = os.path.split(logpath)
+		log.startLogging(LogFile(logfile,logpath))
+
+	print 'Executing',__file__,'as PID',os.getpid()
+	factory = twisted.internet.protocol.Factory()
+	factory.protocol = RelayServer
+	reactor.listenTCP(config.getint('mux','tcp_port'),factory)
+	reactor.listenUNIX(config.getfilename('mux','unix_addr'),factory)
+	print 'Waiting for clients...'
+	reactor.run()
+
+
+import unittest
+
+class MuxTests(unittest.TestCase):
+
+	class PairMultiplexer(Multiplexer):
+		"""
+		Connects to one end of a local socket pair.
+		"""
+		def connect(self):
+			(s,self.peer) = socket.socketpair()
+			return s
+
+	class Recorder(twisted.internet.protocol.Protocol):
+		def connectionMade(self):
+			self.factory.received[self] = ''
+		def dataReceived(self,data):
+			self.factory.received[self] += data
+		def connectionLost(self,reason):
+			self.factory.closed.append(self.factory.received[self])
+
+	def read(self,s,nbytes):
+		data = ''
+		while len(data) < nbytes:
+			chunk = s.recv(nbytes - len(data))
+			if not chunk:
+				break
+			data += chunk
+		return data
+
+	def test00(self):
+		"""Channel frames from several clients share coalesced writes"""
+		mux = self.PairMultiplexer(None,None,None,coalesce_delay=0.5,coalesce_bytes=1000)
+		a = mux.open('logger')
+		b = mux.open('archiver')
+		a.sendall('hello')
+		b.sendall('world')
+		a.close()
+		mux.close()
+		expected = ''.join([framing.announceMultiplexed(),
+			framing.encodeChannel(1,6),'logger',framing.encodeChannel(2,8),'archiver',
+			framing.encodeChannel(1,5),'hello',framing.encodeChannel(2,5),'world',
+			framing.encodeChannel(1,0)])
+		self.assertEqual(self.read(mux.peer,len(expected)+1),expected)
+		self.assertEqual((mux.writes,mux.lost),(1,0))
+		# channels are lost with their connection
+		self.assertRaises(socket.error,lambda: b.sendall('more'))
+
+	def test01(self):
+		"""Channels are handled locally or relayed according to their service"""
+		from twisted.test.proto_helpers import StringTransport
+		factory = twisted.internet.protocol.Factory()
+		factory.protocol = self.Recorder
+		factory.received = { }
+		factory.closed = [ ]
+		relayed = [ ]
+		class TestDemultiplexer(Demultiplexer):
+			def relay(self,id,service):
+				relay = Relay(self,id)
+				relayed.append((service,relay))
+				return relay
+		transport = StringTransport()
+		demux = TestDemultiplexer(transport,factory,'logger')
+		stream = ''.join([framing.encodeChannel(1,6),'logger',framing.encodeChannel(2,8),'archiver',
+			framing.encodeChannel(1,5),'hello',framing.encodeChannel(2,5),'world',
+			framing.encodeChannel(1,0)])
+		for offset in range(len(stream)):
+			demux.dataReceived(stream[offset])
+		self.assertEqual(factory.closed,['hello'])
+		self.assertEqual([service for (service,relay) in relayed],['archiver'])
+		relay = relayed[0][1]
+		self.assertEqual(relay.pending,['world'])
+		# the relay sends its server's control frames back to our client
+		relay.makeConnection(StringTransport())
+		self.assertEqual(relay.transport.value(),'world')
+		relay.dataReceived('credit')
+		self.assertEqual(transport.value(),framing.encodeChannel(2,6) + 'credit')
+
+	def test02(self):
+		"""Servers accept multiplexed connections after a handshake"""
+		from twisted.test.proto_helpers import StringTransport
+		from tops.core.network.server import Server
+		class Named(object):
+			def ParseFromString(self,raw):
+				self.name = raw
+		class RecordingServer(Server):
+			Header = Message = Named
+			def handleHeader(self,hdr):
+				self.factory.received.append(hdr.name)
+			def handleMessage(self,msg):
+				self.factory.received.append(msg.name)
+		factory = twisted.internet.protocol.Factory()
+		factory.protocol = RecordingServer
+		factory.section = 'logger'
+		factory.received = [ ]
+		server = factory.buildProtocol(None)
+		server.makeConnection(StringTransport())
+		channel = ''.join(framing.encodeFrames(framing.legacy,['header','message']))
+		server.dataReceived(framing.announceMultiplexed() + framing.encodeChannel(7,6) + 'logger' +
+			framing.encodeChannel(7,len(channel)) + channel)
+		self.assertEqual(factory.received,['header','message'])
+		self.assertEqual(server.demultiplexer.handlers.keys(),[7])
+
+	def test03(self):
+		"""Frames sent after the server closes a channel are not mistaken for a new channel"""
+		from twisted.test.proto_helpers import StringTransport
+		opened = [ ]
+		class TestDemultiplexer(Demultiplexer):
+			def relay(self,id,service):
+				opened.append(service)
+				if service != 'archiver':
+					raise ValueError('no section: %r' % service)
+				return Relay(self,id)
+		demux = TestDemultiplexer(StringTransport())
+		demux.dataReceived(framing.encodeChannel(1,8) + 'archiver' + framing.encodeChannel(2,3) + 'bad')
+		self.assertEqual(demux.handlers.keys(),[1])
+		# the relay fails to connect and the server closes the channel
+		RelayFactory(demux.handlers[1]).clientConnectionFailed(None,
+			Failure(twisted.internet.error.ConnectError('refused')))
+		self.assertEqual(demux.transport.value(),framing.encodeChannel(2,0) + framing.encodeChannel(1,0))
+		demux.dataReceived(framing.encodeChannel(1,8) + '\n\x07header' + framing.encodeChannel(2,4) + 'more')
+		self.assertEqual((opened,demux.handlers,demux.dropped),(['archiver','bad'],{ },2))
+		# once our client closes the channel too, its id can be used again
+		demux.dataReceived(framing.encodeChannel(1,0) + framing.encodeChannel(1,8) + 'archiver')
+		self.assertEqual((opened,demux.handlers.keys(),demux.closed),(['archiver','bad','archiver'],[1],set([2])))
+
+if __name__ == '__main__':
+	initialize()
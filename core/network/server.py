@@ -7,6 +7,43 @@ and archiving. The implementation is intended for Header and Message
 classes that correspond to Google protocol buffers, but any classes that
 provide a ParseFromString() method can be used. There is a
 corresponding client class in this package.
+
+Each connection uses the legacy 16-bit framing unless the client starts
+with a handshake preamble that selects a wider framing. See
+tops.core.network.framing for details.
+
+Received data accumulates in a reusable bytearray per connection. Frame
+boundaries are located in place and each frame is copied exactly once,
+into the string that is passed to stringReceived().
+
+A client on the same host can announce a shared memory ring in its
+handshake. A ring is only accepted on a UNIX socket connection, and only
+if it is a regular file in the directory named by our factory's shm_dir
+attribute, or the system's temporary directory if this is not set. The
+server then polls the ring for frames, every
+ringPollInterval seconds while frames are arriving and every
+ringIdleInterval seconds after ringIdlePolls empty polls. While idle, a
+flag in the ring asks the client to wake us up with a byte on the socket.
+The ring is drained one last time when the socket is closed.
+
+A client that announces compression in its header can send compressed
+frames, which are decompressed transparently before stringReceived().
+The compression ratio and the CPU time spent decompressing are reported
+when the connection is closed.
+
+A client can also ask for flow control by announcing an initial window
+of messages and bytes in its header. The server then sends it credits
+for the messages it has handled whenever half of either window has been
+used. Credits are withheld, so that the client slows down or sheds its
+messages, while our factory's overloaded() method, if it has one,
+returns True, e.g. while the logging server's file sink is falling
+behind or an ingest worker's coordinator is not keeping up, and are
+granted again once it returns False.
+
+A client process can also multiplex the streams of several clients over
+one connection. Channels for the service named by our factory's section
+attribute are then handled by their own protocol instances, built by our
+factory, and any others are relayed. See tops.core.network.mux.
 """
 
 ## @package tops.core.network.server
@@ -17,38 +54,562 @@ corresponding client class in this package.
 #
 # This project is hosted at sdss3.org and tops.googlecode.com
 
-import twisted.protocols.basic
+import twisted.internet.protocol
 import twisted.internet.error
+import twisted.internet.task
+import twisted.internet.address
+from twisted.internet import reactor
+
+import os
+import os.path
+import stat
+import tempfile
 
-class Server(twisted.protocols.basic.Int16StringReceiver):
+import framing
+from framing import FramingException
+import shmring
+import mux
+
+class Server(twisted.internet.protocol.Protocol):
+
+	# the largest frame we will accept with a wide framing
+	maxFrameLength = 64*1024*1024
+
+	# how often we poll a shared memory ring when busy and when idle
+	ringPollInterval = 0.002
+	ringIdleInterval = 0.5
+	ringIdlePolls = 50
+
+	# how often we check whether our factory is still overloaded
+	overloadInterval = 0.1
+	clock = reactor
 
 	def __init__(self):
 		self.hdr = self.Header()
 		self.msgcount = 0
 		self.bytecount = 0
+		self.framing = None
+		self.buffer = bytearray()
+		self.decompressor = None
+		self.creditWindow = None
+		self.creditsPaused = False
+		self.consumedFrames = 0
+		self.consumedBytes = 0
+		self.grants = 0
+		self.creditPauses = 0
+		self.overloadCheck = None
+		self.ring = None
+		self.ringPoller = None
+		self.ringIdle = False
+		self.idlePolls = 0
+		self.demultiplexer = None
 
 	def connectionMade(self):
 		print 'Got a new connection from',self.transport.getPeer()
 
 	def connectionLost(self,reason):
+		if self.demultiplexer is not None:
+			print 'Connection carried %d channels' % self.demultiplexer.opened
+			self.demultiplexer.connectionLost(reason)
+		if self.ring is not None:
+			self.detachRing()
+		if self.overloadCheck is not None:
+			self.overloadCheck.cancel()
+			self.overloadCheck = None
+		if self.decompressor is not None:
+			print 'Connection used',self.decompressor.report()
+		if self.creditWindow is not None:
+			print 'Connection was granted credit %d times and paused %d times' % (
+				self.grants,self.creditPauses)
 		if reason.check(twisted.internet.error.ConnectionDone):
 			print 'Connection closed'
 		else:
 			print 'Connection lost:',reason
 
+	def handshake(self,data):
+		"""
+		Selects our framing from the start of the stream.
+
+		Returns the offset of the first frame, or None if more data is
+		needed to complete the handshake.
+		"""
+		if len(data) < 2:
+			return None
+		if data[0] or data[1]:
+			self.framing = framing.legacy
+			return 0
+		if len(data) < 3:
+			return None
+		if data[2] == framing.SHARED_MEMORY:
+			if not isinstance(self.transport.getPeer(),twisted.internet.address.UNIXAddress):
+				raise FramingException('shared memory ring announced on a network connection')
+			decoded = framing.decodeVarint(data,3)
+			if decoded is None or decoded[1] + decoded[0] > len(data):
+				return None
+			(length,start) = decoded
+			self.attachRing(str(data[start:start+length]))
+			return start + length
+		if data[2] == framing.MULTIPLEXED:
+			self.demultiplexer = mux.Demultiplexer(self.transport,self.factory,
+				getattr(self.factory,'section',None))
+			# frames never arrive directly but we still need a framing
+			self.framing = framing.legacy
+			return 3
+		try:
+			self.framing = framing.codes[data[2]]
+		except KeyError:
+			raise FramingException('unknown framing code %d' % data[2])
+		return 3
+
+	def attachRing(self,path):
+		"""
+		Starts polling the shared memory ring announced by our client.
+		
+		The ring's file is removed as soon as we have mapped it. Raises
+		FramingException unless path is a regular file in ringDirectory().
+		"""
+		directory = os.path.realpath(self.ringDirectory())
+		try:
+			mode = os.lstat(path).st_mode
+		except OSError,e:
+			raise FramingException('unable to attach ring: %s' % e)
+		if not stat.S_ISREG(mode) or os.path.dirname(os.path.realpath(path)) != directory:
+			raise FramingException('refusing ring %r outside %s' % (path,directory))
+		try:
+			self.ring = shmring.RingBuffer(path)
+		except (OSError,shmring.RingException),e:
+			raise FramingException('unable to attach ring: %s' % e)
+		self.ring.unlink()
+		# frames never arrive on the socket but we still need a framing
+		self.framing = framing.legacy
+		print 'Attached shared memory ring of %d bytes' % self.ring.capacity
+		self.schedulePolls(self.ringPollInterval)
+
+	def ringDirectory(self):
+		"""
+		Returns the directory where our clients create shared memory rings.
+		"""
+		return getattr(self.factory,'shm_dir',None) or tempfile.gettempdir()
+
+	def schedulePolls(self,interval):
+		if self.ringPoller is not None and self.ringPoller.running:
+			self.ringPoller.stop()
+		self.ringPoller = twisted.internet.task.LoopingCall(self.pollRing)
+		self.ringPoller.start(interval,now=False)
+
+	def pollRing(self):
+		"""
+		Handles any frames waiting in our ring and adapts our polling rate.
+		"""
+		frames = self.ring.getAll()
+		for raw in frames:
+			self.stringReceived(raw)
+		if frames:
+			self.idlePolls = 0
+			if self.ringIdle:
+				self.wakeRing()
+			return
+		self.idlePolls += 1
+		if self.idlePolls == self.ringIdlePolls:
+			self.ring.setSleeping(True)
+			self.ringIdle = True
+			# check again in case a frame arrived before the flag was raised
+			if len(self.ring):
+				self.wakeRing()
+			else:
+				self.schedulePolls(self.ringIdleInterval)
+
+	def wakeRing(self):
+		self.ring.setSleeping(False)
+		self.ringIdle = False
+		self.idlePolls = 0
+		self.schedulePolls(self.ringPollInterval)
+
+	def detachRing(self):
+		"""
+		Stops polling our ring after handling any frames still in it.
+		"""
+		if self.ringPoller is not None and self.ringPoller.running:
+			self.ringPoller.stop()
+		self.ringPoller = None
+		for raw in self.ring.getAll():
+			self.stringReceived(raw)
+		self.ring.close()
+		self.ring = None
+
+	def dataReceived(self,data):
+		"""
+		Splits the received data into frames.
+		
+		Frames are located directly in our receive buffer, unpacking
+		fixed-size prefixes in place, and only copied out of it, via a
+		memoryview, when they are passed to stringReceived(). Any
+		incomplete frame is kept at the start of the buffer for the next
+		call.
+		"""
+		buf = self.buffer
+		buf.extend(data)
+		offset = 0
+		try:
+			if self.framing is None:
+				offset = self.handshake(buf)
+				if offset is None:
+					return
+			if self.ring is not None:
+				# bytes after a ring announcement are only wake-up calls
+				del buf[:]
+				self.pollRing()
+				if self.ringIdle:
+					self.wakeRing()
+				return
+			if self.demultiplexer is not None:
+				data = str(buf[offset:])
+				del buf[:]
+				self.demultiplexer.dataReceived(data)
+				return
+			wire = self.framing
+			prefixLength = wire.prefixLength
+			if prefixLength:
+				unpack = wire.packer.unpack_from
+				lengthMask = wire.maxLength
+				flagShift = wire.flagShift
+			transport = self.transport
+			stringReceived = self.stringReceived
+			view = memoryview(buf)
+			size = len(buf)
+			try:
+				while not transport.disconnecting:
+					if prefixLength:
+						start = offset + prefixLength
+						if start > size:
+							break
+						(word,) = unpack(buf,offset)
+						length = word & lengthMask
+						flags = word >> flagShift
+					else:
+						prefix = wire.decode(buf,offset)
+						if prefix is None:
+							break
+						(length,flags,start) = prefix
+					if length > self.maxFrameLength:
+						raise FramingException('frame of %d bytes is too long' % length)
+					end = start + length
+					if end > size:
+						break
+					offset = end
+					if flags & framing.FLAG_COMPRESSED:
+						self.receiveCompressed(view[start:end].tobytes(),flags)
+					elif flags & framing.FLAG_BATCH:
+						for (start,length) in framing.splitBatch(buf,start,end):
+							stringReceived(view[start:start+length].tobytes())
+					else:
+						stringReceived(view[start:end].tobytes())
+			finally:
+				# the buffer cannot be resized while it is exported to a view
+				del view
+		except FramingException,e:
+			print 'Dropping connection after framing error:',e
+			del buf[:]
+			self.transport.loseConnection()
+			return
+		del buf[:offset]
+
+	def receiveCompressed(self,data,flags):
+		"""
+		Decompresses a frame and passes on the messages it contains.
+		"""
+		if self.decompressor is None:
+			raise FramingException('compressed frame without compression in header')
+		payload = self.decompressor.decompress(data,self.maxFrameLength)
+		if flags & framing.FLAG_BATCH:
+			for message in framing.decodeBatch(payload):
+				self.stringReceived(message)
+		else:
+			self.stringReceived(payload)
+
 	def stringReceived(self, raw):
 		if self.msgcount == 0:
 			self.hdr.ParseFromString(raw)
+			compression = getattr(self.hdr,'compression',None)
+			if compression:
+				self.decompressor = framing.Decompressor(compression)
+			window = getattr(self.hdr,'credit_frames',0)
+			if window:
+				self.creditWindow = (window,getattr(self.hdr,'credit_bytes',0))
 			self.handleHeader(self.hdr)
 		else:
 			msg = self.Message()
 			msg.ParseFromString(raw)
 			self.handleMessage(msg)
+			if self.creditWindow is not None:
+				self.consumeCredit(len(raw))
 		self.msgcount += 1
 		self.bytecount += len(raw)
-		
+
+	def consumeCredit(self,nbytes):
+		"""
+		Grants more credit after half of our client's window has been used.
+		"""
+		self.consumedFrames += 1
+		self.consumedBytes += nbytes
+		(frames,nbytes) = self.creditWindow
+		if 2*self.consumedFrames >= frames or (nbytes and 2*self.consumedBytes >= nbytes):
+			self.grantCredits()
+
+	def grantCredits(self):
+		if self.creditsPaused or not self.consumedFrames:
+			return
+		if self.isOverloaded():
+			self.pauseCredits()
+			self.overloadCheck = self.clock.callLater(self.overloadInterval,self.checkOverload)
+			return
+		self.transport.write(framing.encodeControl(framing.CONTROL_CREDIT,
+			framing.credit.pack(self.consumedFrames,self.consumedBytes)))
+		self.grants += 1
+		self.consumedFrames = 0
+		self.consumedBytes = 0
+
+	def pauseCredits(self):
+		"""
+		Stops granting credit to a client that asked for flow control.
+		"""
+		if not self.creditsPaused:
+			self.creditsPaused = True
+			self.creditPauses += 1
+
+	def resumeCredits(self):
+		"""
+		Grants any credit that was withheld while we were paused.
+		"""
+		self.creditsPaused = False
+		if self.creditWindow is not None:
+			self.grantCredits()
+
+	def isOverloaded(self):
+		overloaded = getattr(self.factory,'overloaded',None)
+		return overloaded is not None and overloaded()
+
+	def checkOverload(self):
+		"""
+		Resumes granting credit once our factory is no longer overloaded.
+		"""
+		self.overloadCheck = None
+		if self.isOverloaded():
+			self.overloadCheck = self.clock.callLater(self.overloadInterval,self.checkOverload)
+		else:
+			self.resumeCredits()
+
 	def handleHeader(self,hdr):
 		pass
 
 	def handleMessage(self,msg):
-		raise NotImplementedError
\ No newline at end of file
+		raise NotImplementedError
+
+	def summarizeHeader(self,hdr):
+		"""
+		Returns a marshallable summary of a header for an ingest coordinator.
+		
+		Called instead of handleHeader() in an ingest worker process. See
+		tops.core.network.ingest for details.
+		"""
+		return hdr.SerializeToString()
+
+	def applyHeader(self,summary):
+		"""
+		Handles a header summarized by an ingest worker.
+		"""
+		self.hdr.ParseFromString(summary)
+		self.handleHeader(self.hdr)
+
+	def summarizeMessage(self,msg):
+		"""
+		Returns a marshallable summary of a message for an ingest coordinator.
+		
+		Subclasses should do as much of the work of handling a message
+		as possible here, since this runs in parallel in each worker.
+		"""
+		return msg.SerializeToString()
+
+	def applyMessage(self,summary):
+		"""
+		Handles a message summarized by an ingest worker.
+		"""
+		msg = self.Message()
+		msg.ParseFromString(summary)
+		self.handleMessage(msg)
+
+
+import unittest
+
+class ServerTests(unittest.TestCase):
+
+	class Header(object):
+		def ParseFromString(self,raw):
+			self.name = raw
+
+	class RecordingServer(Server):
+		"""
+		Records the header and messages it receives.
+		"""
+		def __init__(self):
+			self.Header = ServerTests.Header
+			self.Message = ServerTests.Header
+			Server.__init__(self)
+			self.received = [ ]
+		def handleHeader(self,hdr):
+			self.received.append(hdr.name)
+		def handleMessage(self,msg):
+			self.received.append(msg.name)
+
+	def feed(self,stream,chunk=1,peer=None,factory=None):
+		from twisted.test.proto_helpers import StringTransport
+		server = self.RecordingServer()
+		server.factory = factory
+		server.makeConnection(StringTransport(peerAddress=peer))
+		for offset in xrange(0,len(stream),chunk):
+			server.dataReceived(stream[offset:offset+chunk])
+		return server
+
+	def test00(self):
+		"""Legacy 16-bit stream delivered one byte at a time"""
+		messages = ['header','one','','three']
+		stream = ''.join(framing.encodeFrames(framing.legacy,messages))
+		self.assertEqual(self.feed(stream).received,messages)
+
+	def test01(self):
+		"""Negotiated wide framings deliver large and batched frames"""
+		messages = ['h'*100000,'one','two','m'*70000,'four']
+		for name in ('int32','varint'):
+			wide = framing.get(name)
+			stream = (framing.preamble(wide) +
+				''.join(framing.encodeFrames(wide,messages[:1])) +
+				''.join(framing.encodeFrames(wide,messages[1:],batch=True)))
+			for chunk in (1000,len(stream)):
+				server = self.feed(stream,chunk)
+				self.assertEqual(server.received,messages)
+				self.assertEqual(server.msgcount,len(messages))
+
+	def test02(self):
+		"""Unknown framing drops the connection"""
+		server = self.feed('\x00\x00\x7fjunk')
+		self.assertEqual(server.received,[])
+		self.assertEqual(server.transport.disconnecting,True)
+
+	def test04(self):
+		"""Compressed frames are decompressed after the header announces them"""
+		class CompressedHeader(ServerTests.Header):
+			compression = 'zlib'
+		wide = framing.get('varint')
+		compressor = framing.Compressor()
+		stream = (framing.preamble(wide) + ''.join(framing.encodeFrames(wide,['header'])) +
+			''.join(framing.encodeFrames(wide,['one'],compressor=compressor)) +
+			''.join(framing.encodeFrames(wide,['two','three'],compressor=compressor)) +
+			''.join(framing.encodeFrames(wide,['four'])))
+		from twisted.test.proto_helpers import StringTransport
+		server = self.RecordingServer()
+		server.hdr = CompressedHeader()
+		server.makeConnection(StringTransport())
+		server.dataReceived(stream)
+		self.assertEqual(server.received,['header','one','two','three','four'])
+		self.assertEqual(server.decompressor.compressedBytes,compressor.compressedBytes)
+		# compressed frames are rejected unless announced
+		self.assertEqual(self.feed(stream).transport.disconnecting,True)
+		# and dropped when they expand past the frame limit
+		server = self.RecordingServer()
+		server.hdr = CompressedHeader()
+		server.maxFrameLength = 1000
+		server.makeConnection(StringTransport())
+		server.dataReceived(framing.preamble(wide) + ''.join(framing.encodeFrames(wide,['header'])) +
+			''.join(framing.encodeFrames(wide,['x'*5000],compressor=framing.Compressor())))
+		self.assertEqual((server.received,server.transport.disconnecting),(['header'],True))
+
+	def test05(self):
+		"""Credits are granted as a flow controlled client's window is used"""
+		class CreditHeader(ServerTests.Header):
+			credit_frames = 4
+			credit_bytes = 0
+		from twisted.test.proto_helpers import StringTransport
+		from twisted.internet.task import Clock
+		factory = twisted.internet.protocol.Factory()
+		overloaded = [False]
+		factory.overloaded = lambda: overloaded[0]
+		server = self.RecordingServer()
+		server.factory = factory
+		server.clock = Clock()
+		server.hdr = CreditHeader()
+		server.makeConnection(StringTransport())
+		server.dataReceived(''.join(framing.encodeFrames(framing.legacy,['header','a','bb','ccc'])))
+		grant = framing.encodeControl(framing.CONTROL_CREDIT,framing.credit.pack(2,3))
+		self.assertEqual(server.transport.value(),grant)
+		# credit is withheld while our consumers are overloaded
+		overloaded[0] = True
+		server.dataReceived(''.join(framing.encodeFrames(framing.legacy,['dddd','e'])))
+		server.clock.advance(1)
+		self.assertEqual(server.transport.value(),grant)
+		overloaded[0] = False
+		server.clock.advance(server.overloadInterval)
+		self.assertEqual(server.transport.value(),grant +
+			framing.encodeControl(framing.CONTROL_CREDIT,framing.credit.pack(3,8)))
+		self.assertEqual((server.grants,server.creditPauses,server.clock.getDelayedCalls()),(2,1,[]))
+
+	def test03(self):
+		"""Frames are read from an announced shared memory ring"""
+		import tempfile
+		import os
+		import twisted.python.failure
+		directory = tempfile.mkdtemp()
+		try:
+			factory = twisted.internet.protocol.Factory()
+			factory.shm_dir = directory
+			peer = twisted.internet.address.UNIXAddress(None)
+			ring = shmring.RingBuffer.create(directory,4096)
+			server = self.feed(framing.announceRing(ring.path),chunk=3,peer=peer,factory=factory)
+			self.assertEqual(os.listdir(directory),[])
+			for message in ('header','one','two'):
+				ring.put(message)
+			server.pollRing()
+			self.assertEqual(server.received,['header','one','two'])
+			# idle polls put the ring to sleep until a wake-up byte arrives
+			for index in range(server.ringIdlePolls):
+				server.pollRing()
+			self.assertEqual(ring.isSleeping(),True)
+			ring.put('three')
+			ring.setSleeping(False)
+			server.dataReceived('\x00')
+			self.assertEqual(server.ringIdle,False)
+			ring.put('four')
+			server.connectionLost(twisted.python.failure.Failure(
+				twisted.internet.error.ConnectionDone()))
+			self.assertEqual(server.received,['header','one','two','three','four'])
+			self.assertEqual(server.ring,None)
+			ring.close()
+		finally:
+			os.rmdir(directory)
+
+	def test06(self):
+		"""Rings announced on a network connection or outside our directory are refused"""
+		import tempfile
+		import shutil
+		directory = tempfile.mkdtemp()
+		try:
+			factory = twisted.internet.protocol.Factory()
+			factory.shm_dir = os.path.join(directory,'shm')
+			os.mkdir(factory.shm_dir)
+			unix = twisted.internet.address.UNIXAddress(None)
+			ring = shmring.RingBuffer.create(factory.shm_dir,4096)
+			outside = os.path.join(directory,'victim')
+			open(outside,'w').write('x'*4096)
+			link = os.path.join(factory.shm_dir,'link')
+			os.symlink(outside,link)
+			for (path,peer) in ((ring.path,None),(outside,unix),(link,unix),(factory.shm_dir,unix),
+				(os.path.join(factory.shm_dir,'..','victim'),unix),(os.path.join(factory.shm_dir,'missing'),unix)):
+				server = self.feed(framing.announceRing(path),peer=peer,factory=factory)
+				self.assertEqual((server.ring,server.transport.disconnecting),(None,True))
+			self.assertEqual(sorted(os.listdir(factory.shm_dir)),sorted(['link',os.path.basename(ring.path)]))
+			self.assertEqual(open(outside).read(),'x'*4096)
+			ring.close()
+		finally:
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	unittest.main()
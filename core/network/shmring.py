@@ -0,0 +1,252 @@
+"""
+Shared-memory ring buffers for same-host producers
+
+Implements a single-producer single-consumer ring of variable-length
+frames in a memory-mapped file. A producer on the same host as a server
+creates a ring and announces its path over its socket connection, then
+writes each frame into the ring instead of the socket. The server maps
+the same file and polls it for new frames.
+
+The file starts with a header page that holds the ring capacity, the
+total number of bytes ever written (the tail) and consumed (the head),
+and a flag that the consumer raises while it is polling slowly. Each
+counter is only ever written by one side and is stored in its own cache
+line. A producer publishes a frame by writing its length and payload
+and only then advancing the tail, so a consumer never sees a partial
+frame. A producer that finds the sleeping flag raised should clear it
+and send a single wake-up byte through its socket.
+"""
+
+## @package tops.core.network.shmring
+# Shared-memory ring buffers for same-host producers
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os
+import os.path
+import mmap
+import struct
+
+class RingException(Exception):
+	pass
+
+class RingBuffer(object):
+	"""
+	A ring of frames in a memory-mapped file.
+
+	Only one process should call put() and only one should call
+	getAll() for any given ring.
+	"""
+	magic = 'TOPSRING'
+	header = struct.Struct('!8sQ')
+	counter = struct.Struct('=Q')
+	prefix = struct.Struct('=I')
+	# offsets of the counters and data within the file
+	tailOffset = 64
+	headOffset = 128
+	sleepingOffset = 192
+	dataOffset = 256
+
+	# used to generate unique file names within one process
+	serial = 0
+
+	def __init__(self,path,capacity=None):
+		"""
+		Creates a new ring with the specified capacity in bytes.
+
+		If no capacity is specified, maps the existing ring at path instead.
+		"""
+		created = bool(capacity)
+		if created:
+			fd = os.open(path,os.O_RDWR|os.O_CREAT|os.O_EXCL,0600)
+		else:
+			fd = os.open(path,os.O_RDWR|os.O_NOFOLLOW)
+		try:
+			if created:
+				os.ftruncate(fd,self.dataOffset + capacity)
+			else:
+				capacity = os.fstat(fd).st_size - self.dataOffset
+				if capacity <= 0:
+					raise RingException('%s is not a ring buffer' % path)
+			self.map = mmap.mmap(fd,self.dataOffset + capacity)
+		finally:
+			os.close(fd)
+		if created:
+			self.header.pack_into(self.map,0,self.magic,capacity)
+		else:
+			(magic,size) = self.header.unpack_from(self.map,0)
+			if magic != self.magic or size != capacity:
+				self.map.close()
+				raise RingException('%s is not a ring buffer' % path)
+		self.path = path
+		self.capacity = capacity
+		self.tail = self.counter.unpack_from(self.map,self.tailOffset)[0]
+		self.head = self.counter.unpack_from(self.map,self.headOffset)[0]
+
+	@classmethod
+	def create(cls,directory,capacity):
+		"""
+		Returns a new ring with a unique file name in the specified directory.
+		"""
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		while True:
+			cls.serial += 1
+			path = os.path.join(directory,'ring-%d-%d' % (os.getpid(),cls.serial))
+			try:
+				return cls(path,capacity)
+			except OSError:
+				if not os.path.exists(path):
+					raise
+
+	def __len__(self):
+		"""
+		Returns the number of bytes waiting to be consumed.
+		"""
+		return self.counter.unpack_from(self.map,self.tailOffset)[0] - self.head
+
+	def _write(self,position,data):
+		start = self.dataOffset + position % self.capacity
+		end = start + len(data)
+		limit = self.dataOffset + self.capacity
+		if end <= limit:
+			self.map[start:end] = data
+		else:
+			split = limit - start
+			self.map[start:limit] = data[:split]
+			self.map[self.dataOffset:self.dataOffset + len(data) - split] = data[split:]
+
+	def _read(self,position,length):
+		start = self.dataOffset + position % self.capacity
+		end = start + length
+		limit = self.dataOffset + self.capacity
+		if end <= limit:
+			return self.map[start:end]
+		return self.map[start:limit] + self.map[self.dataOffset:end - self.capacity]
+
+	def put(self,data):
+		"""
+		Appends a frame to the ring.
+
+		Returns False, without blocking, if there is not enough free
+		space for the frame. Called by the producer.
+		"""
+		length = len(data)
+		needed = 4 + length
+		tail = self.tail
+		capacity = self.capacity
+		if tail + needed - self.counter.unpack_from(self.map,self.headOffset)[0] > capacity:
+			if needed > capacity:
+				raise RingException('frame of %d bytes is too large for this ring' % length)
+			return False
+		start = self.dataOffset + tail % capacity
+		if start + needed <= self.dataOffset + capacity:
+			# the usual case where the frame does not wrap around
+			self.prefix.pack_into(self.map,start,length)
+			self.map[start+4:start+needed] = data
+		else:
+			self._write(tail,self.prefix.pack(length))
+			self._write(tail + 4,data)
+		self.tail = tail + needed
+		# publish the frame only after it has been completely written
+		self.counter.pack_into(self.map,self.tailOffset,self.tail)
+		return True
+
+	def getAll(self):
+		"""
+		Removes and returns a list of all frames in the ring.
+
+		Called by the consumer.
+		"""
+		tail = self.counter.unpack_from(self.map,self.tailOffset)[0]
+		head = self.head
+		frames = [ ]
+		while head < tail:
+			(length,) = self.prefix.unpack(self._read(head,self.prefix.size))
+			head += self.prefix.size
+			frames.append(self._read(head,length))
+			head += length
+		if frames:
+			self.head = head
+			self.counter.pack_into(self.map,self.headOffset,head)
+		return frames
+
+	def isSleeping(self):
+		return self.counter.unpack_from(self.map,self.sleepingOffset)[0] != 0
+
+	def setSleeping(self,sleeping):
+		self.counter.pack_into(self.map,self.sleepingOffset,sleeping and 1 or 0)
+
+	def close(self):
+		self.map.close()
+
+	def unlink(self):
+		"""
+		Removes our file, which remains mapped until we are closed.
+		"""
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+
+import unittest
+import tempfile
+import shutil
+
+class RingBufferTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	def test00(self):
+		"""Frames written by a producer are read in order by a consumer"""
+		producer = RingBuffer.create(self.directory,1024)
+		consumer = RingBuffer(producer.path)
+		self.assertEqual(consumer.capacity,1024)
+		frames = ['','a','bb'*100,'ccc']
+		for frame in frames:
+			self.assertEqual(producer.put(frame),True)
+		self.assertEqual(len(consumer),4*4 + 204)
+		self.assertEqual(consumer.getAll(),frames)
+		self.assertEqual(consumer.getAll(),[])
+		self.assertEqual(len(consumer),0)
+		producer.close()
+		consumer.close()
+	def test01(self):
+		"""Frames wrap around the end of the ring"""
+		producer = RingBuffer.create(self.directory,100)
+		consumer = RingBuffer(producer.path)
+		for index in range(50):
+			frame = chr(65 + index % 26)*(index % 37)
+			self.assertEqual(producer.put(frame),True)
+			self.assertEqual(consumer.getAll(),[frame])
+		self.assertEqual(producer.tail,consumer.head)
+		self.assertTrue(producer.tail > 3*producer.capacity)
+	def test02(self):
+		"""A full ring rejects frames until the consumer catches up"""
+		producer = RingBuffer.create(self.directory,64)
+		consumer = RingBuffer(producer.path)
+		self.assertEqual(producer.put('x'*28),True)
+		self.assertEqual(producer.put('y'*28),True)
+		self.assertEqual(producer.put('z'),False)
+		self.assertEqual(consumer.getAll(),['x'*28,'y'*28])
+		self.assertEqual(producer.put('z'),True)
+		self.assertRaises(RingException,lambda: producer.put('w'*61))
+	def test03(self):
+		"""Sleeping flag is shared and invalid files are rejected"""
+		producer = RingBuffer.create(self.directory,64)
+		consumer = RingBuffer(producer.path)
+		consumer.setSleeping(True)
+		self.assertEqual(producer.isSleeping(),True)
+		producer.setSleeping(False)
+		self.assertEqual(consumer.isSleeping(),False)
+		bogus = os.path.join(self.directory,'bogus')
+		open(bogus,'w').write('x'*512)
+		self.assertRaises(RingException,lambda: RingBuffer(bogus))
+
+if __name__ == '__main__':
+	unittest.main()
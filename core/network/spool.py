@@ -0,0 +1,332 @@
+"""
+Disk-backed store-and-forward spools for producers
+
+A producer that cannot reach its server appends the packets that it
+would have sent to a spool, and replays them in bulk once it reconnects.
+A spool is a directory of append-only segment files that are rotated
+when they reach a maximum size. Each segment starts with the header of
+the connection that its packets belong to, followed by the packets
+themselves, each prefixed with its length. Segments are removed as soon
+as they have been replayed, and the oldest segments are discarded when
+the spool would otherwise exceed its cap on disk usage.
+
+Segments that were left behind by an earlier process are recovered when
+a spool is opened, after truncating any packet that was only partially
+written, so that a producer that is restarted can still deliver them.
+"""
+
+## @package tops.core.network.spool
+# Disk-backed store-and-forward spools for producers
+#
+# @author agent, agent@local
+# @date Created 18-Oct-2026
+#
+# This project is hosted at sdss3.org and tops.googlecode.com
+
+import os
+import os.path
+import struct
+
+class SpoolException(Exception):
+	pass
+
+class Segment(object):
+	"""
+	Describes one segment file of a spool.
+
+	The offset is where the next packet to replay starts and packets
+	counts the packets that have not been replayed yet.
+	"""
+	def __init__(self,path,header,size,offset,packets):
+		self.path = path
+		self.header = header
+		self.size = size
+		self.offset = offset
+		self.packets = packets
+
+class Spool(object):
+	"""
+	Stores packets on disk until they can be replayed to a server.
+
+	Packets are appended to segments of about segment_bytes and the
+	total size of all segments is limited to max_bytes. The spooled,
+	replayed and dropped attributes count packets over the lifetime of
+	the spool. Only one thread should use a spool at a time.
+	"""
+	prefix = struct.Struct('!I')
+
+	# the number of bytes read from a segment at a time during replay
+	chunkBytes = 1048576
+
+	def __init__(self,directory,max_bytes=67108864,segment_bytes=4194304):
+		if segment_bytes < 1 or max_bytes < segment_bytes:
+			raise SpoolException('spool of %d bytes cannot hold segments of %d bytes' %
+				(max_bytes,segment_bytes))
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.maxBytes = max_bytes
+		self.segmentBytes = segment_bytes
+		self.header = None
+		self.segments = [ ]
+		self.current = None
+		self.fd = None
+		self.serial = 0
+		self.nbytes = 0
+		self.packets = 0
+		self.spooled = 0
+		self.replayed = 0
+		self.dropped = 0
+		self.recover()
+
+	def __len__(self):
+		"""
+		Returns the number of packets waiting to be replayed.
+		"""
+		return self.packets
+
+	def recover(self):
+		"""
+		Adds the segments left in our directory by an earlier spool.
+		"""
+		for name in sorted(os.listdir(self.directory)):
+			if not name.startswith('segment-'):
+				continue
+			path = os.path.join(self.directory,name)
+			self.serial = max(self.serial,int(name[8:]))
+			f = open(path,'r+b')
+			try:
+				data = f.read()
+				(records,end) = self.parse(data)
+				if not records:
+					# not even the header was completely written
+					f.close()
+					os.unlink(path)
+					continue
+				if end < len(data):
+					f.truncate(end)
+			finally:
+				f.close()
+			offset = self.prefix.size + len(records[0])
+			self.segments.append(Segment(path,records[0],end,offset,len(records) - 1))
+			self.nbytes += end
+			self.packets += len(records) - 1
+
+	def parse(self,data):
+		"""
+		Returns a list of the complete records in data and where they end.
+		"""
+		records = [ ]
+		unpack = self.prefix.unpack_from
+		size = self.prefix.size
+		start = 0
+		while start + size <= len(data):
+			(length,) = unpack(data,start)
+			end = start + size + length
+			if end > len(data):
+				break
+			records.append(data[start + size:end])
+			start = end
+		return (records,start)
+
+	def setHeader(self,header):
+		"""
+		Sets the header of the connection that later packets belong to.
+
+		Packets appended after the header changes start a new segment.
+		"""
+		if header != self.header:
+			self.header = header
+			self.rotate()
+
+	def rotate(self):
+		"""
+		Closes the segment that we are appending to.
+		"""
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		self.current = None
+
+	def append(self,packets):
+		"""
+		Appends a list of packets with a single write.
+
+		Returns False if the packets were dropped because they alone
+		would exceed our cap on disk usage. Otherwise, discards our
+		oldest segments as necessary to make room for them.
+		"""
+		if self.header is None:
+			raise SpoolException('must set a header before spooling packets')
+		pieces = [ ]
+		for packet in packets:
+			pieces.append(self.prefix.pack(len(packet)))
+			pieces.append(packet)
+		data = ''.join(pieces)
+		if self.current is not None and self.current.size >= self.segmentBytes:
+			self.rotate()
+		record = self.prefix.pack(len(self.header)) + self.header
+		while True:
+			needed = len(data) if self.current is not None else len(record) + len(data)
+			if needed > self.maxBytes:
+				self.dropped += len(packets)
+				return False
+			if not self.segments or self.nbytes + needed <= self.maxBytes:
+				break
+			self.discard()
+		if self.current is None:
+			self.serial += 1
+			path = os.path.join(self.directory,'segment-%08d' % self.serial)
+			self.fd = os.open(path,os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_APPEND,0600)
+			self.current = Segment(path,self.header,0,len(record),0)
+			self.segments.append(self.current)
+			data = record + data
+		written = 0
+		while written < len(data):
+			written += os.write(self.fd,buffer(data,written))
+		self.current.size += len(data)
+		self.current.packets += len(packets)
+		self.nbytes += len(data)
+		self.packets += len(packets)
+		self.spooled += len(packets)
+		return True
+
+	def discard(self):
+		"""
+		Removes our oldest segment without replaying its packets.
+		"""
+		segment = self.segments[0]
+		if segment is self.current:
+			self.rotate()
+		self.remove(segment)
+		self.dropped += segment.packets
+		self.packets -= segment.packets
+
+	def remove(self,segment):
+		self.segments.remove(segment)
+		self.nbytes -= segment.size
+		try:
+			os.unlink(segment.path)
+		except OSError:
+			pass
+
+	def firstHeader(self):
+		"""
+		Returns the header of the oldest packets to replay, or None.
+		"""
+		for segment in self.segments:
+			if segment.packets:
+				return segment.header
+		return None
+
+	def replay(self,send):
+		"""
+		Replays all spooled packets, oldest first.
+
+		Each segment is read sequentially in large chunks, and each
+		chunk of packets is passed to send(header,packets) along with
+		the header that they belong to. Segments are removed once all of
+		their packets have been sent. If send raises an exception, the
+		packets that it was passed remain spooled and will be replayed
+		first next time.
+		"""
+		self.rotate()
+		while self.segments:
+			segment = self.segments[0]
+			f = open(segment.path,'rb')
+			try:
+				f.seek(segment.offset)
+				pending = ''
+				while segment.packets:
+					data = f.read(self.chunkBytes)
+					if not data:
+						raise SpoolException('%s is missing %d packets' % (segment.path,segment.packets))
+					if pending:
+						data = pending + data
+					(packets,end) = self.parse(data)
+					pending = data[end:]
+					if packets:
+						send(segment.header,packets)
+						segment.offset += end
+						segment.packets -= len(packets)
+						self.packets -= len(packets)
+						self.replayed += len(packets)
+			finally:
+				f.close()
+			self.remove(segment)
+
+	def close(self):
+		self.rotate()
+
+
+import unittest
+import tempfile
+import shutil
+
+class SpoolTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	def replayed(self,spool):
+		sent = [ ]
+		spool.replay(lambda header,packets: sent.append((header,packets)))
+		return sent
+	def test00(self):
+		"""Packets are replayed in order across segments with their header"""
+		spool = Spool(self.directory,1000,50)
+		spool.setHeader('hdr')
+		for index in range(20):
+			spool.append(['packet%02d' % index])
+		self.assertEqual(len(spool),20)
+		self.assertTrue(len(spool.segments) > 1)
+		sent = self.replayed(spool)
+		self.assertEqual(set([header for (header,packets) in sent]),set(['hdr']))
+		self.assertEqual(sum([packets for (header,packets) in sent],[]),
+			['packet%02d' % index for index in range(20)])
+		self.assertEqual((len(spool),spool.nbytes,spool.replayed),(0,0,20))
+		self.assertEqual(os.listdir(self.directory),[])
+	def test01(self):
+		"""Oldest segments are discarded to respect the cap on disk usage"""
+		spool = Spool(self.directory,100,40)
+		spool.setHeader('h')
+		for index in range(20):
+			self.assertEqual(spool.append(['%02d' % index]),True)
+		self.assertTrue(spool.nbytes <= 100)
+		self.assertEqual(spool.dropped + len(spool),20)
+		packets = sum([packets for (header,packets) in self.replayed(spool)],[])
+		self.assertEqual(packets,['%02d' % index for index in range(spool.dropped,20)])
+		self.assertEqual(spool.append(['x'*100]),False)
+	def test02(self):
+		"""Segments are recovered by a new spool after a partial write"""
+		spool = Spool(self.directory)
+		spool.setHeader('old')
+		spool.append(['a','b'])
+		spool.setHeader('new')
+		spool.append(['c'])
+		spool.close()
+		f = open(spool.segments[-1].path,'ab')
+		f.write(struct.pack('!I',10) + 'trunc')
+		f.close()
+		spool = Spool(self.directory)
+		self.assertEqual(len(spool),3)
+		self.assertEqual(spool.firstHeader(),'old')
+		self.assertEqual(self.replayed(spool),[('old',['a','b']),('new',['c'])])
+	def test03(self):
+		"""Packets that fail to send are replayed next time"""
+		spool = Spool(self.directory)
+		spool.setHeader('h')
+		spool.chunkBytes = 8
+		spool.append(['one','two','three'])
+		sent = [ ]
+		def send(header,packets):
+			if len(sent) == 1:
+				raise IOError('connection lost')
+			sent.append(packets)
+		self.assertRaises(IOError,lambda: spool.replay(send))
+		self.assertEqual(len(spool),2)
+		self.assertEqual(self.replayed(spool),[('h',['two']),('h',['three'])])
+		self.assertRaises(SpoolException,lambda: Spool(self.directory,10,20))
+
+if __name__ == '__main__':
+	unittest.main()
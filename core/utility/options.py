@@ -46,6 +46,10 @@ def initialize(prog_name=None):
 		"--readkey", action="store_true", dest="readkey",
 		help="read private data key from stdin"
 	)
+	theParser.add_option(
+		"--worker", action="store", type="int", dest="worker",
+		help="run as the numbered ingest worker of an already running service"
+	)
 	theParser.set_defaults(verbose=False,readkey=False)
 	global theOptions,theArgs
 	(theOptions,theArgs) = theParser.parse_args()